@@ -0,0 +1,141 @@
+"""
+Indexes of the analytics queries.
+
+Every raw analytics query filters tyk_analytics_data on a request_date range
+and joins key_tbl on value = api_key to read the group columns, so they need
+
+- tyk_analytics_data (request_date, api_key): the date range is read from
+  the index instead of the whole table
+- key_tbl (value, tier, ref_app, user_id): the join is answered from the
+  index alone, without reading key_tbl rows
+
+create adds the indexes that are missing (CONCURRENTLY on Postgres, so
+ingestion is not blocked while they build, InnoDB builds them online).
+check runs EXPLAIN on the /analytics and /top-users queries, as sent from the
+raw rows alone and, once the rollup table exists, from the rollup with raw
+edge days, and reports whether the plan uses each index. Plans depend on the data, run check
+against a database of production size, a small table is often scanned.
+
+$ python analytics_indexes.py create
+$ python analytics_indexes.py check
+$ python analytics_indexes.py check --group-by ref_app --start-date 2024-12-01 --end-date 2024-12-31
+"""
+
+import argparse
+import logging
+import sys
+from datetime import date, timedelta
+
+from sqlalchemy import inspect, text
+
+import analytics_repository as repository
+import analytics_rollup
+import database
+import settings
+
+_settings = settings.get_settings()
+
+# (name, table, columns)
+INDEXES = [
+    ("idx_tyk_analytics_data_date_key", "tyk_analytics_data", ("request_date", "api_key")),
+    ("idx_key_tbl_value_groups", "key_tbl", ("value", "tier", "ref_app", "user_id"))
+]
+
+logger = logging.getLogger(__name__)
+
+
+def create_indexes() -> list[str]:
+    """
+    Create the indexes that do not exist yet. Returns the names of the created ones.
+    """
+    dialect = database.get_dialect()
+    created = []
+    for name, table, columns in INDEXES:
+        with database.connect() as connection:
+            existing = {index["name"] for index in inspect(connection).get_indexes(table)}
+        if name in existing:
+            logger.info("Index exists index=%s", name)
+            continue
+
+        logger.info("Creating index index=%s table=%s columns=%s", name, table, ", ".join(columns))
+        if dialect == "postgresql":
+            # CREATE INDEX CONCURRENTLY cannot run in a transaction
+            with database.get_engine().connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+                connection.execute(text(f"CREATE INDEX CONCURRENTLY {name} ON {table} ({', '.join(columns)})"))
+        else:
+            with database.connect() as connection:
+                connection.execute(text(f"CREATE INDEX {name} ON {table} ({', '.join(columns)})"))
+                connection.commit()
+        created.append(name)
+    return created
+
+
+def check_indexes(group_by_column: str, start_date_str: str, end_date_str: str) -> dict:
+    """
+    EXPLAIN the analytics and top users queries of a range, as sent when the
+    rollup does not cover the range (raw) and when it covers part of it
+    (rollup, the raw rows of the uncovered days are read next to the rollup).
+    Returns {query name: {"plan": [lines], "indexes": {index name: used}}}.
+    """
+    raw = [("raw", start_date_str, end_date_str)]
+    queries = {
+        "analytics": repository.analytics_query(group_by_column, start_date_str, end_date_str, segments=raw),
+        "analytics_user": repository.analytics_query(group_by_column, start_date_str, end_date_str, user_id=1,
+                                                     segments=raw),
+        "top_users": repository.top_users_query(group_by_column, start_date_str, end_date_str, segments=raw)
+    }
+    if group_by_column in analytics_rollup.ROLLUP_GROUP_COLUMNS and _has_table(analytics_rollup.ROLLUP_TABLE):
+        # The rollup tables have their own primary keys, the indexes serve the raw segment
+        rollup = [("rollup", start_date_str, end_date_str), ("raw", start_date_str, end_date_str)]
+        queries.update({
+            "analytics_rollup": repository.analytics_query(group_by_column, start_date_str, end_date_str,
+                                                           segments=rollup),
+            "top_users_rollup": repository.top_users_query(group_by_column, start_date_str, end_date_str,
+                                                           segments=rollup)
+        })
+
+    explain = "EXPLAIN QUERY PLAN" if database.get_dialect() == "sqlite" else "EXPLAIN"
+    report = {}
+    for query_name, (query, query_params) in queries.items():
+        with database.connect() as connection:
+            rows = connection.execute(text(f"{explain} {query}"), query_params).fetchall()
+        plan = [" ".join(str(value) for value in row if value is not None) for row in rows]
+        plan_text = "\n".join(plan)
+        report[query_name] = {
+            "plan": plan,
+            "indexes": {name: name in plan_text for name, _, _ in INDEXES}
+        }
+    return report
+
+
+def _has_table(table: str) -> bool:
+    with database.connect() as connection:
+        return inspect(connection).has_table(table)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=_settings.log_level,
+                        format="%(asctime)s %(levelname)s %(name)s %(message)s")
+
+    today = date.today()
+    parser = argparse.ArgumentParser(description="Create and check the indexes of the analytics queries")
+    parser.add_argument("command", choices=["create", "check"])
+    parser.add_argument("--group-by", default="tier", choices=list(repository.GROUP_COLUMNS))
+    parser.add_argument("--start-date", default=(today - timedelta(days=7)).isoformat(), help="YYYY-MM-DD")
+    parser.add_argument("--end-date", default=today.isoformat(), help="YYYY-MM-DD")
+    parser.add_argument("--verbose", action="store_true", help="print the plans")
+    args = parser.parse_args()
+
+    if args.command == "create":
+        created = create_indexes()
+        print(f"Created {len(created)} indexes {', '.join(created)}")
+    else:
+        report = check_indexes(args.group_by, args.start_date, args.end_date)
+        unused = 0
+        for query_name, result in report.items():
+            for index_name, used in result["indexes"].items():
+                print(f"{query_name:<20}{index_name:<36}{'used' if used else 'NOT USED'}")
+                unused += not used
+            if args.verbose or not all(result["indexes"].values()):
+                print("\n".join(f"    {line}" for line in result["plan"]))
+        sys.exit(1 if unused else 0)
@@ -0,0 +1,431 @@
+"""
+Ingestion of Tyk's analytics records into tyk_analytics_data.
+
+With "enable_analytics" the gateway pushes one msgpack encoded record per
+request to a Redis list (analytics-tyk-system-analytics in Tyk's Redis,
+ANALYTICS_INGEST_KEY), where they expire after storage_expiration_time. This
+worker drains that list in batches of up to ANALYTICS_INGEST_BATCH_SIZE
+records, decodes them and writes request_date, api_key, response_code and
+request_time in one transaction per batch: COPY on Postgres, multi-row
+inserts (executemany) on MySQL and SQLite. A batch is written when it is
+full or ANALYTICS_INGEST_FLUSH_INTERVAL seconds after its first record.
+
+Checkpointing: records are moved atomically from Tyk's list to a processing
+list of the consumer, under a batch id. The id of the last written batch is
+stored with its rows (tyk_analytics_ingest_state), then the processing list
+is deleted. After a crash the processing list is written again, unless its
+batch id shows it was already written, so no record is lost or written twice.
+
+Backpressure: records are claimed only while the previous batch can be
+written. When the database is down or slow, writes are retried with
+exponential backoff (up to ANALYTICS_INGEST_MAX_RETRY_DELAY seconds) and the
+records wait in Tyk's list, the memory of the worker stays bounded by one batch.
+Run more consumers with distinct ANALYTICS_INGEST_CONSUMER names to write in
+parallel, each claims its own records.
+
+init creates the state table and adds the response code and request time
+columns to tyk_analytics_data when they are missing, run refuses to start
+before init.
+
+$ python analytics_ingest.py init
+$ python analytics_ingest.py run
+$ python analytics_ingest.py run --drain
+"""
+
+import argparse
+import csv
+import io
+import logging
+import signal
+import sys
+import threading
+import time
+import uuid
+from datetime import date, datetime
+
+import msgpack
+import redis
+from sqlalchemy import inspect, text
+
+import database
+import settings
+
+_settings = settings.get_settings()
+
+INGEST_REDIS_URL = _settings.analytics_ingest_redis_url
+INGEST_KEY = _settings.analytics_ingest_key
+INGEST_CONSUMER = _settings.analytics_ingest_consumer
+INGEST_BATCH_SIZE = _settings.analytics_ingest_batch_size
+INGEST_FLUSH_INTERVAL = _settings.analytics_ingest_flush_interval
+INGEST_MAX_RETRY_DELAY = _settings.analytics_ingest_max_retry_delay
+
+ANALYTICS_TABLE = "tyk_analytics_data"
+STATE_TABLE = "tyk_analytics_ingest_state"
+
+# Columns written to tyk_analytics_data, in the order of the rows built by _to_rows
+ANALYTICS_COLUMNS = ("request_date", "api_key", _settings.analytics_status_column,
+                     _settings.analytics_latency_column)
+
+# Types of the columns the baseline tyk_analytics_data lacks, init adds the missing ones
+ANALYTICS_COLUMN_TYPES = {
+    _settings.analytics_status_column: "INTEGER",
+    _settings.analytics_latency_column: "INTEGER"
+}
+
+DDL_STATEMENTS = [
+    f"""
+    CREATE TABLE IF NOT EXISTS {STATE_TABLE} (
+        consumer VARCHAR(64) NOT NULL PRIMARY KEY,
+        batch_id VARCHAR(64),
+        ingested_rows BIGINT NOT NULL,
+        ingested_at TIMESTAMP
+    )
+    """
+]
+
+# Moves up to ARGV[1] records from Tyk's list (KEYS[1]) to the processing list (KEYS[2]).
+# The batch id (KEYS[3]) is set by the first claim of a batch. RPUSH takes at most a few
+# thousand arguments from Lua, so records are pushed 1000 at a time.
+_CLAIM_SCRIPT = """
+local items = redis.call('lrange', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items > 0 then
+    redis.call('ltrim', KEYS[1], #items, -1)
+    for i = 1, #items, 1000 do
+        redis.call('rpush', KEYS[2], unpack(items, i, math.min(i + 999, #items)))
+    end
+    redis.call('set', KEYS[3], ARGV[2], 'NX')
+end
+return {redis.call('get', KEYS[3]), redis.call('llen', KEYS[1]), items}
+"""
+
+# Field names of a record, normalized (lower case, no underscores) as they differ between Tyk versions
+_FIELDS = {
+    "api_key": "apikey",
+    "response_code": "responsecode",
+    "request_time": "requesttime",
+    "year": "year",
+    "month": "month",
+    "day": "day",
+    "timestamp": "timestamp"
+}
+
+logger = logging.getLogger(__name__)
+
+
+class AnalyticsIngester:
+    """
+    Drains the analytics records of one consumer from Redis into the database.
+    """
+
+    def __init__(self, redis_client, key: str = INGEST_KEY, consumer: str = INGEST_CONSUMER,
+                 batch_size: int = INGEST_BATCH_SIZE, flush_interval: float = INGEST_FLUSH_INTERVAL,
+                 max_retry_delay: float = INGEST_MAX_RETRY_DELAY):
+        self.redis_client = redis_client
+        self.key = key
+        self.consumer = consumer
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retry_delay = max_retry_delay
+        self.processing_key = f"{key}:processing:{consumer}"
+        self.batch_id_key = f"{self.processing_key}:batch"
+        self._claim = redis_client.register_script(_CLAIM_SCRIPT)
+        self._stopped = threading.Event()
+
+        self._batch_id = None
+        self._rows = []
+        self._records = 0
+        self._skipped = 0
+        self._started_at = None
+        self.backlog = 0
+        self.stats = {"batches": 0, "records": 0, "rows": 0, "skipped": 0}
+
+    def stop(self) -> None:
+        """
+        Ask run() to write the records it holds and return.
+        """
+        self._stopped.set()
+
+    def run(self, drain: bool = False) -> dict:
+        """
+        Ingest until stop() is called, or with drain=True until Tyk's list is empty.
+        Returns the totals of the run.
+        """
+        self.recover()
+        poll_interval = min(1.0, self.flush_interval)
+        while not self._stopped.is_set():
+            if self._records < self.batch_size:
+                claimed = self.claim(self.batch_size - self._records)
+                if claimed:
+                    continue
+
+            due = self._started_at is not None and time.monotonic() - self._started_at >= self.flush_interval
+            if self._records >= self.batch_size or (self._records and (due or drain)):
+                self.flush()
+            elif drain:
+                break
+            else:
+                self._stopped.wait(poll_interval)
+
+        if self._records:
+            self.flush()
+        return self.stats
+
+    def recover(self) -> None:
+        """
+        Pick up the batch of a previous run that stopped before deleting its processing list.
+        """
+        batch_id = self.redis_client.get(self.batch_id_key)
+        items = self.redis_client.lrange(self.processing_key, 0, -1)
+        if batch_id is None and not items:
+            return
+
+        batch_id = batch_id.decode() if batch_id is not None else uuid.uuid4().hex
+        if batch_id == _read_state(self.consumer):
+            logger.info("Batch already ingested, discarding its processing list consumer=%s batch_id=%s records=%d",
+                        self.consumer, batch_id, len(items))
+            self._release()
+            return
+
+        logger.info("Resuming batch consumer=%s batch_id=%s records=%d", self.consumer, batch_id, len(items))
+        self._batch_id = batch_id
+        self._add(items)
+
+    def claim(self, count: int) -> int:
+        """
+        Move up to count records from Tyk's list to the current batch. Returns the number claimed.
+        """
+        batch_id, self.backlog, items = self._claim(keys=[self.key, self.processing_key, self.batch_id_key],
+                                                    args=[count, uuid.uuid4().hex])
+        if items:
+            self._batch_id = batch_id.decode()
+            self._add(items)
+        return len(items)
+
+    def flush(self) -> None:
+        """
+        Write the current batch and its checkpoint in one transaction, retrying until it succeeds.
+        """
+        delay = 1.0
+        while True:
+            try:
+                started = time.perf_counter()
+                _write_batch(self._rows, self.consumer, self._batch_id)
+                elapsed = time.perf_counter() - started
+                break
+            except Exception as e:
+                if self._stopped.is_set():
+                    # The batch stays in its processing list and is written by the next run
+                    logger.warning("Batch not written on stop consumer=%s records=%d error=%s",
+                                   self.consumer, self._records, e)
+                    raise
+                logger.warning("Batch write failed, retrying in %.0fs consumer=%s records=%d error=%s",
+                               delay, self.consumer, self._records, e)
+                self._stopped.wait(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+
+        self._release()
+        self.stats["batches"] += 1
+        self.stats["records"] += self._records
+        self.stats["rows"] += len(self._rows)
+        self.stats["skipped"] += self._skipped
+        logger.info("Batch ingested consumer=%s records=%d rows=%d skipped=%d write_ms=%.1f backlog=%d",
+                    self.consumer, self._records, len(self._rows), self._skipped, elapsed * 1000, self.backlog)
+
+        self._batch_id = None
+        self._rows = []
+        self._records = 0
+        self._skipped = 0
+        self._started_at = None
+
+    def _add(self, items: list) -> None:
+        if self._started_at is None:
+            self._started_at = time.monotonic()
+        rows, skipped = _to_rows(items)
+        self._rows.extend(rows)
+        self._records += len(items)
+        self._skipped += skipped
+
+    def _release(self) -> None:
+        # Both keys in one transaction, a processing list is never left without its batch id
+        pipeline = self.redis_client.pipeline(transaction=True)
+        pipeline.delete(self.processing_key, self.batch_id_key)
+        pipeline.execute()
+
+
+def create_tables() -> None:
+    """
+    Create the state table and add the columns of ANALYTICS_COLUMN_TYPES
+    that tyk_analytics_data does not have yet.
+    """
+    with database.connect() as connection:
+        for statement in DDL_STATEMENTS:
+            connection.execute(text(statement))
+        existing = {column["name"] for column in inspect(connection).get_columns(ANALYTICS_TABLE)}
+        for column, column_type in ANALYTICS_COLUMN_TYPES.items():
+            if column not in existing:
+                logger.info("Adding column table=%s column=%s", ANALYTICS_TABLE, column)
+                connection.execute(text(f"ALTER TABLE {ANALYTICS_TABLE} ADD COLUMN {column} {column_type}"))
+        connection.commit()
+
+
+def check_tables() -> None:
+    """
+    Raise when the tables are not ready for the worker, before it claims any record.
+    """
+    with database.connect() as connection:
+        inspector = inspect(connection)
+        if not inspector.has_table(STATE_TABLE):
+            raise RuntimeError(f"{STATE_TABLE} does not exist, run python analytics_ingest.py init")
+        existing = {column["name"] for column in inspector.get_columns(ANALYTICS_TABLE)}
+    missing = [column for column in ANALYTICS_COLUMNS if column not in existing]
+    if missing:
+        raise RuntimeError(f"{ANALYTICS_TABLE} has no column {', '.join(missing)}, "
+                           f"run python analytics_ingest.py init")
+
+
+def get_redis_client():
+    return redis.Redis.from_url(INGEST_REDIS_URL)
+
+
+def _to_rows(items: list) -> (list[tuple], int):
+    """
+    Decode msgpack records into (request_date, api_key, response_code, request_time)
+    rows. Records without a key or date cannot be attributed and are skipped.
+    """
+    rows = []
+    skipped = 0
+    fields = None
+    dates = {}
+    for item in items:
+        try:
+            record = msgpack.unpackb(item, raw=False, strict_map_key=False)
+        except Exception as e:
+            logger.warning("Undecodable analytics record skipped error=%s", e)
+            skipped += 1
+            continue
+        if not isinstance(record, dict):
+            skipped += 1
+            continue
+
+        if fields is None or fields["api_key"] not in record:
+            # Field names are looked up once per batch, records of one gateway share them
+            fields = _field_names(record)
+
+        api_key = record.get(fields["api_key"])
+        request_date = _to_request_date(record, fields, dates)
+        if not api_key or request_date is None:
+            skipped += 1
+            continue
+        rows.append((request_date, api_key, record.get(fields["response_code"]), record.get(fields["request_time"])))
+    return rows, skipped
+
+
+def _field_names(record: dict) -> dict:
+    names = {str(name).lower().replace("_", ""): name for name in record}
+    return {field: names.get(normalized, normalized) for field, normalized in _FIELDS.items()}
+
+
+def _to_request_date(record: dict, fields: dict, dates: dict) -> str:
+    year, month, day = record.get(fields["year"]), record.get(fields["month"]), record.get(fields["day"])
+    if year and month and day:
+        # Formatted once per day of a batch
+        request_date = dates.get((year, month, day))
+        if request_date is None:
+            request_date = dates[(year, month, day)] = date(year, month, day).isoformat()
+        return request_date
+
+    timestamp = record.get(fields["timestamp"])
+    if isinstance(timestamp, msgpack.Timestamp):
+        return timestamp.to_datetime().date().isoformat()
+    if isinstance(timestamp, (datetime, date)):
+        return timestamp.isoformat()[:10]
+    if isinstance(timestamp, str) and len(timestamp) >= 10:
+        return timestamp[:10]
+    return None
+
+
+def _write_batch(rows: list[tuple], consumer: str, batch_id: str) -> None:
+    with database.connect() as connection:
+        _write_state(connection, consumer, batch_id, len(rows))
+        if rows:
+            if database.get_dialect() == "postgresql":
+                _copy_rows(connection, rows)
+            else:
+                _insert_rows(connection, rows)
+        connection.commit()
+
+
+def _copy_rows(connection, rows: list[tuple]) -> None:
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="\n").writerows(rows)
+    buffer.seek(0)
+    # COPY runs on the same DBAPI connection, so in the transaction of the checkpoint
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY {ANALYTICS_TABLE} ({', '.join(ANALYTICS_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+                           buffer)
+    finally:
+        cursor.close()
+
+
+def _insert_rows(connection, rows: list[tuple]) -> None:
+    # executemany, which PyMySQL and mysql-connector send as multi-row INSERT statements
+    placeholders = ", ".join(f":c{index}" for index in range(len(ANALYTICS_COLUMNS)))
+    statement = text(f"INSERT INTO {ANALYTICS_TABLE} ({', '.join(ANALYTICS_COLUMNS)}) VALUES ({placeholders})")
+    connection.execute(statement, [{f"c{index}": value for index, value in enumerate(row)} for row in rows])
+
+
+def _read_state(consumer: str) -> str:
+    with database.connect() as connection:
+        return connection.execute(text(f"SELECT batch_id FROM {STATE_TABLE} WHERE consumer = :consumer"),
+                                  {"consumer": consumer}).scalar()
+
+
+def _write_state(connection, consumer: str, batch_id: str, rows: int) -> None:
+    params = {
+        "consumer": consumer,
+        "batch_id": batch_id,
+        "rows": rows,
+        "ingested_at": datetime.now()
+    }
+    result = connection.execute(text(f"""
+        UPDATE {STATE_TABLE}
+        SET batch_id = :batch_id, ingested_rows = ingested_rows + :rows, ingested_at = :ingested_at
+        WHERE consumer = :consumer
+    """), params)
+    if result.rowcount == 0:
+        connection.execute(text(f"""
+            INSERT INTO {STATE_TABLE} (consumer, batch_id, ingested_rows, ingested_at)
+            VALUES (:consumer, :batch_id, :rows, :ingested_at)
+        """), params)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=_settings.log_level,
+                        format="%(asctime)s %(levelname)s %(name)s %(message)s")
+
+    parser = argparse.ArgumentParser(description="Ingest Tyk's analytics records from Redis into tyk_analytics_data")
+    parser.add_argument("command", choices=["init", "run"])
+    parser.add_argument("--consumer", default=INGEST_CONSUMER, help="name of this consumer, one per running worker")
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE, help="records per transaction")
+    parser.add_argument("--flush-interval", type=float, default=INGEST_FLUSH_INTERVAL,
+                        help="seconds a record waits at most for its batch to fill")
+    parser.add_argument("--drain", action="store_true", help="stop once Tyk's list is empty")
+    args = parser.parse_args()
+
+    if args.command == "init":
+        create_tables()
+        print("Ingest tables created")
+    else:
+        try:
+            check_tables()
+        except RuntimeError as e:
+            sys.exit(str(e))
+        ingester = AnalyticsIngester(get_redis_client(), consumer=args.consumer, batch_size=args.batch_size,
+                                     flush_interval=args.flush_interval)
+        # Write the batch in hand before exiting on SIGTERM / Ctrl-C
+        signal.signal(signal.SIGTERM, lambda signum, frame: ingester.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: ingester.stop())
+        stats = ingester.run(drain=args.drain)
+        print(f"Ingested {stats['rows']} rows from {stats['records']} records in {stats['batches']} batches, "
+              f"skipped {stats['skipped']}")
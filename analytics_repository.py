@@ -2,128 +2,773 @@
 functions that start with an underscore are meant be private to this module
 """
 
-import os
+import asyncio
+import functools
+import re
+import time
+
+import numpy as np
 import pandas as pd
-from dotenv import load_dotenv
 from pandas.core.frame import DataFrame
-from sqlalchemy import create_engine, text
-
-# Load environment variables from .env file
-load_dotenv()
-
-# Database connection parameters
-db_config = {
-    'host': os.getenv('DB_HOST'),
-    'port': os.getenv('DB_PORT'),
-    'user': os.getenv('DB_USER'),
-    'password': os.getenv('DB_PASSWORD'),
-    'database': os.getenv('DB_DATABASE')
-}
+from sqlalchemy import text
 
-def _get_db_url() -> str :
-    suffix = f"{db_config['user']}:{db_config['password']}@{db_config['host']}:{db_config['port']}/{db_config['database']}"
+import analytics_rollup
+import database
+import latency_sketch
+import metrics
+import settings
 
-    if db_config["port"] == "3306":
-        print("Generating connect url for MySql")
-        return "mysql+pymysql://" + suffix
-    elif db_config["port"] == "5432":
-        print("Generating connect url for PostGre")
-        return "postgresql://" + suffix
-    else:
-        raise ValueError(f"Invalid port: {db_config['port']}. Expected 3306 for MySQL or 5432 for PostgreSQL.")
+# Arrow backed strings for the text columns, used only when pyarrow is installed
+ARROW_STRINGS = settings.get_settings().analytics_arrow_strings
+
+# key_tbl columns analytics can be grouped by. Column names are part of the SQL text, values never are
+GROUP_COLUMNS = settings.get_settings().analytics_group_columns
+for _column in GROUP_COLUMNS:
+    if not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", _column):
+        raise ValueError(f"Invalid column in ANALYTICS_GROUP_COLUMNS: {_column!r}")
+
+# Distinct SQL texts kept as text() statements, one per dialect, group column and filter shape
+STATEMENT_CACHE_SIZE = 512
 
-def _execute_sql_query(query : str, params : dict = None) -> DataFrame:
-    db_url = _get_db_url()
-    engine = create_engine(db_url)
+try:
+    import pyarrow  # noqa: F401
+except ImportError:  # optional dependency
+    ARROW_STRINGS = False
 
-    with engine.connect() as connection:
-        # Use text() to create a prepared statement
-        result = connection.execute(text(query), params or {})
-        df = pd.DataFrame(result.fetchall(), columns=result.keys())
 
+def _execute_sql_query(query : str, params : dict = None, dtypes : dict = None,
+                       query_name : str = "query") -> DataFrame:
+    started = time.perf_counter()
+    # Connections come from the process wide pool, see database.get_engine
+    with database.connect() as connection:
+        result = connection.execute(_statement(query), params or {})
+        columns, rows = list(result.keys()), result.fetchall()
+    metrics.observe_db_query(query_name, time.perf_counter() - started)
+
+    return _to_data_frame(columns, rows, dtypes)
+
+async def _execute_sql_query_async(query : str, params : dict = None, dtypes : dict = None,
+                                   query_name : str = "query") -> DataFrame:
+    started = time.perf_counter()
+    # Async engine (asyncmy / asyncpg) for the ASGI app, see database.get_async_engine
+    async with database.connect_async() as connection:
+        result = await connection.execute(_statement(query), params or {})
+        columns, rows = list(result.keys()), result.fetchall()
+    metrics.observe_db_query(query_name, time.perf_counter() - started)
+
+    return _to_data_frame(columns, rows, dtypes)
+
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _statement(query : str):
+    """
+    text() statement of a query, built once per distinct SQL text. Every value
+    is a bound parameter, so the text only varies with the dialect, the group
+    column and the shape of the filters (rollup segments, user filter, months),
+    and the database and SQLAlchemy can reuse the plan and compiled form.
+    """
+    return text(query)
+
+def _check_group_column(group_by_column: str) -> None:
+    if group_by_column not in GROUP_COLUMNS:
+        raise ValueError(f"Invalid group by column: {group_by_column}. Expected one of {list(GROUP_COLUMNS)}")
+
+def _to_data_frame(columns : list[str], rows : list, dtypes : dict = None) -> DataFrame:
+    """
+    Build the frame column by column with the dtype of each column known up
+    front, instead of letting pandas infer object columns from the rows.
+    dtypes maps a column to "int64", "category", "date" (a 'YYYY-MM-DD' or
+    'YYYY-MM' string) or "string". Columns without a dtype are inferred.
+    """
+    dtypes = dtypes or {}
+    # Transpose the rows once, one tuple of values per column
+    column_values = list(zip(*rows)) if rows else [()] * len(columns)
+
+    # Positional keys, so a name selected twice (for eg. user_id when grouping by user_id) keeps both columns
+    data = {position: _to_column(values, dtypes.get(name))
+            for position, (name, values) in enumerate(zip(columns, column_values))}
+    df = pd.DataFrame(data, columns=range(len(columns)))
+    df.columns = columns
     return df
 
+def _to_column(values : tuple, dtype : str):
+    if dtype == "int64":
+        return np.fromiter(values, dtype=np.int64, count=len(values))
+    if dtype == "category":
+        # Few distinct tier / ref_app values repeated over every date, stored once each
+        return pd.Categorical(values)
+    if dtype == "date":
+        # DATE columns arrive as date objects, month labels already as strings
+        values = [value if isinstance(value, str) else value.isoformat() for value in values]
+        return pd.Categorical(values)
+    if dtype == "string":
+        return pd.array(values, dtype="string[pyarrow]") if ARROW_STRINGS else np.array(values, dtype=object)
+    return list(values)
+
+def _analytics_dtypes(group_by_column: str) -> dict:
+    return {"request_date": "date", group_by_column: "category", "cntr": "int64"}
+
+# Name of the group column in the top users queries, grouping by user_id would select user_id twice
+TOP_USERS_GROUP_COLUMN = "group_value"
+
+def _top_users_dtypes() -> dict:
+    return {TOP_USERS_GROUP_COLUMN: "category", "user_id": "int64", "first_name": "string",
+            "last_name": "string", "email": "string", "cntr": "int64"}
+
 def get_analytics(group_by_column: str,
                   start_date_str: str, end_date_str: str,
-                  user_id: int = None) -> DataFrame:
-    # Step 1: Execute the SQL query with dynamic date parameters
+                  user_id: int = None,
+                  aggregate_month: bool = False,
+                  fill_months: list[str] = None) -> DataFrame:
+    """
+    Daily request counts per group, or monthly counts with request_date as
+    'YYYY-MM' when aggregate_month is set. fill_months (only with
+    aggregate_month) returns every (month, group) pair, missing ones with
+    cntr 0, so the caller does not have to fill gaps.
+    """
+    query, query_params = _get_analytics_query(group_by_column, start_date_str, end_date_str, user_id,
+                                               aggregate_month, fill_months)
+
+    # Fetch data from database into a DataFrame
+    return _execute_sql_query(query, query_params, _analytics_dtypes(group_by_column), "analytics")
+
+async def get_analytics_async(group_by_column: str,
+                              start_date_str: str, end_date_str: str,
+                              user_id: int = None,
+                              aggregate_month: bool = False,
+                              fill_months: list[str] = None) -> DataFrame:
+    # Building the query may read the rollup coverage, keep that off the event loop
+    query, query_params = await asyncio.to_thread(_get_analytics_query, group_by_column, start_date_str,
+                                                  end_date_str, user_id, aggregate_month, fill_months)
+    return await _execute_sql_query_async(query, query_params, _analytics_dtypes(group_by_column), "analytics")
+
+def analytics_query(group_by_column: str,
+                    start_date_str: str, end_date_str: str,
+                    user_id: int = None,
+                    segments: list[tuple] = None) -> (str, dict):
+    """
+    SQL text and parameters get_analytics sends for a daily range, for eg. to
+    EXPLAIN it. segments ("rollup" | "raw", start, end), as returned by
+    analytics_rollup.split_range, pick the source of each part of the range,
+    by default the current rollup coverage decides.
+    """
+    return _get_analytics_query(group_by_column, start_date_str, end_date_str, user_id, segments=segments)
+
+def _get_analytics_query(group_by_column: str,
+                         start_date_str: str, end_date_str: str,
+                         user_id: int = None,
+                         aggregate_month: bool = False,
+                         fill_months: list[str] = None,
+                         segments: list[tuple] = None) -> (str, dict):
+    _check_group_column(group_by_column)
+
+    # Step 1: Build the SQL query with dynamic date parameters
+    if segments is None:
+        segments = analytics_rollup.split_range(start_date_str, end_date_str, group_by_column)
+    if len(segments) > 1 or segments[0][0] == "rollup":
+        query, query_params = _get_rollup_analytics_query(group_by_column, segments, user_id, aggregate_month)
+        date_column = _month_expression("s.request_date") if aggregate_month else "s.request_date"
+        order_by = f"ORDER BY {date_column}, s.{group_by_column}"
+    else:
+        if user_id:
+            user_id_filter = "and b.user_id = :user_id"
+        else:
+            user_id_filter = ""
+
+        date_column = _month_expression("a.request_date") if aggregate_month else "a.request_date"
+        query = f"""
+        SELECT
+            {date_column} AS request_date,
+            b.{group_by_column},
+            COUNT(*) AS cntr
+        FROM tyk_analytics_data a, key_tbl b
+        WHERE a.request_date BETWEEN :start_date AND :end_date
+        {user_id_filter}
+        and b.value = a.api_key
+        GROUP BY {date_column}, b.{group_by_column}
+        """
+        order_by = f"ORDER BY {date_column}, b.{group_by_column}"
+
+        query_params = {
+            "start_date" : start_date_str,
+            "end_date" : end_date_str
+        }
+        if user_id:
+            query_params["user_id"] = int(user_id)
+
+    if aggregate_month and fill_months:
+        query = _fill_missing_months(query, query_params, group_by_column, fill_months)
+    else:
+        query = f"{query} {order_by};"
+
+    return query, query_params
+
+def get_multi_analytics(group_by_columns: list[str], date_ranges: list[tuple], user_id: int = None) -> dict:
+    """
+    Daily request counts for several groupings and date ranges from one
+    query, {group_by_column: DataFrame(request_date, group_by_column, cntr)}.
+    Postgres computes every grouping with GROUPING SETS, other databases
+    return the counts per day and combination of the group columns and the
+    groupings are summed up here.
+    """
+    query, query_params = _get_multi_analytics_query(group_by_columns, date_ranges, user_id)
+    data_frame = _execute_sql_query(query, query_params, _multi_analytics_dtypes(group_by_columns), "multi_analytics")
+    return _split_groupings(data_frame, group_by_columns)
+
+async def get_multi_analytics_async(group_by_columns: list[str], date_ranges: list[tuple],
+                                    user_id: int = None) -> dict:
+    query, query_params = await asyncio.to_thread(_get_multi_analytics_query, group_by_columns, date_ranges, user_id)
+    data_frame = await _execute_sql_query_async(query, query_params, _multi_analytics_dtypes(group_by_columns),
+                                                "multi_analytics")
+    return _split_groupings(data_frame, group_by_columns)
+
+def _multi_analytics_dtypes(group_by_columns: list[str]) -> dict:
+    dtypes = {"request_date": "date", "cntr": "int64", "grouping_id": "int64"}
+    dtypes.update({column: "category" for column in group_by_columns})
+    return dtypes
+
+def _get_multi_analytics_query(group_by_columns: list[str], date_ranges: list[tuple],
+                               user_id: int = None) -> (str, dict):
+    for column in group_by_columns:
+        _check_group_column(column)
+
+    # Overlapping ranges (for eg. this month and the last 30 days) are read once
+    use_rollup = all(column in analytics_rollup.ROLLUP_GROUP_COLUMNS for column in group_by_columns)
+    segments = []
+    for span_start, span_end in _merge_date_ranges(date_ranges):
+        if use_rollup:
+            segments.extend(analytics_rollup.split_range(span_start, span_end, group_by_columns[0]))
+        else:
+            segments.append(("raw", span_start, span_end))
+
+    selects = []
+    query_params = {}
+    for index, (source, segment_start, segment_end) in enumerate(segments):
+        query_params[f"start_date_{index}"] = segment_start
+        query_params[f"end_date_{index}"] = segment_end
+
+        if source == "rollup":
+            columns = ", ".join(f"r.{column} AS {column}" for column in group_by_columns)
+            selects.append(f"""
+            SELECT r.request_date, {columns}, r.cntr
+            FROM {analytics_rollup.ROLLUP_TABLE} r
+            WHERE r.request_date BETWEEN :start_date_{index} AND :end_date_{index}
+            {"and r.user_id = :user_id" if user_id else ""}
+            """)
+        else:
+            columns = ", ".join(f"b.{column} AS {column}" for column in group_by_columns)
+            group_columns = ", ".join(f"b.{column}" for column in group_by_columns)
+            selects.append(f"""
+            SELECT a.request_date, {columns}, COUNT(*) AS cntr
+            FROM tyk_analytics_data a, key_tbl b
+            WHERE a.request_date BETWEEN :start_date_{index} AND :end_date_{index}
+            {"and b.user_id = :user_id" if user_id else ""}
+            and b.value = a.api_key
+            GROUP BY a.request_date, {group_columns}
+            """)
     if user_id:
-        user_id_filter = f"and b.user_id={user_id}"
+        query_params["user_id"] = int(user_id)
+
+    columns = ", ".join(f"s.{column}" for column in group_by_columns)
+    if database.get_dialect() == "postgresql":
+        # One grouping set per column, GROUPING() tells which set a row belongs to
+        grouping_sets = ", ".join(f"(s.request_date, s.{column})" for column in group_by_columns)
+        query = f"""
+        SELECT s.request_date, {columns}, CAST(SUM(s.cntr) AS BIGINT) AS cntr, GROUPING({columns}) AS grouping_id
+        FROM ({" UNION ALL ".join(selects)}) s
+        GROUP BY GROUPING SETS ({grouping_sets});
+        """
+    else:
+        query = f"""
+        SELECT s.request_date, {columns}, CAST(SUM(s.cntr) AS {_bigint_type()}) AS cntr
+        FROM ({" UNION ALL ".join(selects)}) s
+        GROUP BY s.request_date, {columns};
+        """
+    return query, query_params
+
+def _merge_date_ranges(date_ranges: list[tuple]) -> list[tuple]:
+    # 'YYYY-MM-DD' strings sort and compare as dates
+    merged = []
+    for start_date_str, end_date_str in sorted(date_ranges):
+        if merged and start_date_str <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end_date_str))
+        else:
+            merged.append((start_date_str, end_date_str))
+    return merged
+
+def _split_groupings(data_frame: DataFrame, group_by_columns: list[str]) -> dict:
+    frames = {}
+    for position, column in enumerate(group_by_columns):
+        if "grouping_id" in data_frame.columns:
+            # GROUPING() sets the bit of every column left out of the set, the first column is the highest bit
+            grouping_id = sum(1 << (len(group_by_columns) - 1 - other)
+                              for other in range(len(group_by_columns)) if other != position)
+            rows = data_frame.loc[data_frame["grouping_id"] == grouping_id, ["request_date", column, "cntr"]]
+            frame = rows.sort_values(["request_date", column])
+        else:
+            frame = (data_frame.groupby(["request_date", column], observed=True, sort=True, dropna=False)["cntr"]
+                     .sum()
+                     .reset_index())
+        frames[column] = frame.reset_index(drop=True)
+    return frames
+
+def get_latency(group_by_column: str, start_date_str: str, end_date_str: str,
+                user_id: int = None, aggregate_month: bool = False) -> DataFrame:
+    """
+    Latency sketch buckets per day (or 'YYYY-MM' month) and group,
+    (request_date, group_by_column, bucket, cntr), see latency_sketch.py.
+    """
+    query, query_params = _get_latency_query("latency", group_by_column, start_date_str, end_date_str,
+                                             user_id, aggregate_month)
+    return _execute_sql_query(query, query_params, _latency_dtypes(group_by_column, "bucket"), "latency")
+
+async def get_latency_async(group_by_column: str, start_date_str: str, end_date_str: str,
+                            user_id: int = None, aggregate_month: bool = False) -> DataFrame:
+    query, query_params = await asyncio.to_thread(_get_latency_query, "latency", group_by_column, start_date_str,
+                                                  end_date_str, user_id, aggregate_month)
+    return await _execute_sql_query_async(query, query_params, _latency_dtypes(group_by_column, "bucket"), "latency")
+
+def get_status_codes(group_by_column: str, start_date_str: str, end_date_str: str,
+                     user_id: int = None, aggregate_month: bool = False) -> DataFrame:
+    """
+    Request counts per day (or 'YYYY-MM' month), group and response code,
+    (request_date, group_by_column, response_code, cntr). Requests without
+    a response code have response_code 0.
+    """
+    query, query_params = _get_latency_query("status", group_by_column, start_date_str, end_date_str,
+                                             user_id, aggregate_month)
+    return _execute_sql_query(query, query_params, _latency_dtypes(group_by_column, "response_code"), "status_codes")
+
+async def get_status_codes_async(group_by_column: str, start_date_str: str, end_date_str: str,
+                                 user_id: int = None, aggregate_month: bool = False) -> DataFrame:
+    query, query_params = await asyncio.to_thread(_get_latency_query, "status", group_by_column, start_date_str,
+                                                  end_date_str, user_id, aggregate_month)
+    return await _execute_sql_query_async(query, query_params, _latency_dtypes(group_by_column, "response_code"),
+                                          "status_codes")
+
+def _latency_dtypes(group_by_column: str, value_column: str) -> dict:
+    return {"request_date": "date", group_by_column: "category", value_column: "int64", "cntr": "int64"}
+
+def _get_latency_query(kind: str, group_by_column: str, start_date_str: str, end_date_str: str,
+                       user_id: int = None, aggregate_month: bool = False) -> (str, dict):
+    _check_group_column(group_by_column)
+
+    # kind is "latency" (sketch buckets) or "status" (response codes), both rolled up by the latency rollup
+    if kind == "latency":
+        rollup_table, value_column = analytics_rollup.LATENCY_ROLLUP_TABLE, "bucket"
+        raw_value = latency_sketch.bucket_expression(f"a.{analytics_rollup.LATENCY_COLUMN}")
+        raw_filter = f"and a.{analytics_rollup.LATENCY_COLUMN} IS NOT NULL"
     else:
-        user_id_filter = ""
+        rollup_table, value_column = analytics_rollup.STATUS_ROLLUP_TABLE, "response_code"
+        raw_value = f"COALESCE(a.{analytics_rollup.STATUS_COLUMN}, 0)"
+        raw_filter = ""
 
+    segments = analytics_rollup.split_range(start_date_str, end_date_str, group_by_column,
+                                            analytics_rollup.LATENCY_ROLLUP_NAME)
+    selects = []
+    query_params = {}
+    for index, (source, segment_start, segment_end) in enumerate(segments):
+        query_params[f"start_date_{index}"] = segment_start
+        query_params[f"end_date_{index}"] = segment_end
+
+        if source == "rollup":
+            selects.append(f"""
+            SELECT r.request_date, r.{group_by_column} AS {group_by_column}, r.{value_column} AS {value_column}, r.cntr
+            FROM {rollup_table} r
+            WHERE r.request_date BETWEEN :start_date_{index} AND :end_date_{index}
+            {"and r.user_id = :user_id" if user_id else ""}
+            """)
+        else:
+            # Same buckets as the rollup, computed by the database so only the counts are fetched
+            selects.append(f"""
+            SELECT a.request_date, b.{group_by_column} AS {group_by_column}, {raw_value} AS {value_column},
+                   COUNT(*) AS cntr
+            FROM tyk_analytics_data a, key_tbl b
+            WHERE a.request_date BETWEEN :start_date_{index} AND :end_date_{index}
+            {raw_filter}
+            {"and b.user_id = :user_id" if user_id else ""}
+            and b.value = a.api_key
+            GROUP BY a.request_date, b.{group_by_column}, {raw_value}
+            """)
+    if user_id:
+        query_params["user_id"] = int(user_id)
+
+    date_column = _month_expression("s.request_date") if aggregate_month else "s.request_date"
     query = f"""
     SELECT
-        a.request_date,
-        b.{group_by_column},
-        COUNT(*) AS cntr
-    FROM tyk_analytics_data a, key_tbl b
-    WHERE a.request_date BETWEEN :start_date AND :end_date
-    {user_id_filter}
-    and b.value = a.api_key
-    GROUP BY a.request_date, b.{group_by_column}
-    ORDER BY a.request_date, b.{group_by_column};
-    """
-
-    query_params = {
-        "start_date" : start_date_str,
-        "end_date" : end_date_str
-    }
+        {date_column} AS request_date,
+        s.{group_by_column},
+        CAST(s.{value_column} AS {_bigint_type()}) AS {value_column},
+        CAST(SUM(s.cntr) AS {_bigint_type()}) AS cntr
+    FROM ({" UNION ALL ".join(selects)}) s
+    GROUP BY {date_column}, s.{group_by_column}, s.{value_column}
+    ORDER BY {date_column}, s.{group_by_column}, s.{value_column};
+    """
+    return query, query_params
+
+def get_top_users(
+                group_by_column: str,
+                start_date_str: str, end_date_str: str,
+                limit:int = 10, offset:int = 0,
+                group_by_filter: str = None,
+                after: tuple = None) -> DataFrame:
+    """
+    One page of users ordered by usage (cntr DESC, user_id, group).
+    after is a (cntr, user_id, group) keyset cursor taken from the last row of
+    the previous page, the group keeps it unique when a user has the same
+    usage in several groups. When it is given the page starts right after that row and
+    offset is ignored, so deep pages cost the same as the first one.
+    The group of each row is in the TOP_USERS_GROUP_COLUMN column.
+    """
+    query, query_params = _get_top_users_query(group_by_column, start_date_str, end_date_str,
+                                               limit, offset, group_by_filter, after)
 
     # Fetch data from database into a DataFrame
-    df = _execute_sql_query(query,query_params)
+    return _execute_sql_query(query, query_params, _top_users_dtypes(), "top_users")
 
-    return df
+async def get_top_users_async(
+                group_by_column: str,
+                start_date_str: str, end_date_str: str,
+                limit:int = 10, offset:int = 0,
+                group_by_filter: str = None,
+                after: tuple = None) -> DataFrame:
+    query, query_params = await asyncio.to_thread(_get_top_users_query, group_by_column, start_date_str,
+                                                  end_date_str, limit, offset, group_by_filter, after)
+    return await _execute_sql_query_async(query, query_params, _top_users_dtypes(), "top_users")
 
-def get_top_users(
+def top_users_query(group_by_column: str,
+                    start_date_str: str, end_date_str: str,
+                    limit: int = 10,
+                    group_by_filter: str = None,
+                    segments: list[tuple] = None) -> (str, dict):
+    """
+    SQL text and parameters of the first get_top_users page, for eg. to
+    EXPLAIN it. segments as in analytics_query.
+    """
+    return _get_top_users_query(group_by_column, start_date_str, end_date_str, limit,
+                                group_by_filter=group_by_filter, segments=segments)
+
+def _get_top_users_query(
                 group_by_column: str,
                 start_date_str: str, end_date_str: str,
                 limit:int = 10, offset:int = 0,
-                group_by_filter: str = None) -> DataFrame:
+                group_by_filter: str = None,
+                after: tuple = None,
+                segments: list[tuple] = None) -> (str, dict):
+    paginated_data_query, query_params = _get_paginated_data_query(group_by_column, start_date_str, end_date_str,
+                                                                   group_by_filter, segments)
 
-    if group_by_filter:
-        having_clause = f" having b.{group_by_column} = :filter_value"
+    if after is not None:
+        query_params["after_cntr"], query_params["after_user_id"], after_group = after
+        # Groups without a value sort first, the rows after one are the groups with a value
+        if after_group is None:
+            after_group_filter = f"pd.{TOP_USERS_GROUP_COLUMN} IS NOT NULL"
+        else:
+            after_group_filter = f"pd.{TOP_USERS_GROUP_COLUMN} > :after_group"
+            query_params["after_group"] = after_group
+        keyset_filter = f"""
+        AND (pd.cntr < :after_cntr
+             OR (pd.cntr = :after_cntr AND ud.user_id > :after_user_id)
+             OR (pd.cntr = :after_cntr AND ud.user_id = :after_user_id AND {after_group_filter}))
+        """
+        offset = 0
     else:
-        having_clause = ""
+        keyset_filter = ""
 
     query = f"""
-        with paginated_data as (
-          select
-          b.{group_by_column},b.user_id,count(*) as cntr
-          from tyk_analytics_data a, key_tbl b
-          where a.request_date between :start_date AND :end_date
-          and b.value = a.api_key
-          group by b.{group_by_column},b.user_id
-          {having_clause}
-        ),
+        with paginated_data as ({paginated_data_query}),
         user_data as (
           select u.user_id,u.first_name,u.last_name,u.email
           from user_tbl u
         )
         SELECT 
-            pd.{group_by_column},
+            pd.{TOP_USERS_GROUP_COLUMN},
             ud.user_id,
             ud.first_name,
             ud.last_name,
             ud.email,
-            pd.cntr,
-            (SELECT COUNT(*) FROM paginated_data) AS total_records
+            pd.cntr
         FROM paginated_data pd, user_data ud
         WHERE pd.user_id = ud.user_id
-        ORDER BY pd.cntr DESC,ud.user_id
+        {keyset_filter}
+        ORDER BY pd.cntr DESC,ud.user_id,
+                 CASE WHEN pd.{TOP_USERS_GROUP_COLUMN} IS NULL THEN 0 ELSE 1 END,pd.{TOP_USERS_GROUP_COLUMN}
         LIMIT :rows_per_page OFFSET :starting_row;
     """
 
-    query_params = {
-        "start_date" : start_date_str,
-        "end_date" : end_date_str,
-        "rows_per_page": limit,
-        "starting_row": offset
-    }
+    query_params["rows_per_page"] = limit
+    query_params["starting_row"] = offset
+
+    return query, query_params
+
+def count_top_users(group_by_column: str,
+                    start_date_str: str, end_date_str: str,
+                    group_by_filter: str = None) -> int:
+    query, query_params = _get_count_top_users_query(group_by_column, start_date_str, end_date_str, group_by_filter)
+    df = _execute_sql_query(query, query_params, query_name="count_top_users")
+    return int(df['total_records'].iloc[0])
+
+async def count_top_users_async(group_by_column: str,
+                                start_date_str: str, end_date_str: str,
+                                group_by_filter: str = None) -> int:
+    query, query_params = await asyncio.to_thread(_get_count_top_users_query, group_by_column, start_date_str,
+                                                  end_date_str, group_by_filter)
+    df = await _execute_sql_query_async(query, query_params, query_name="count_top_users")
+    return int(df['total_records'].iloc[0])
+
+def _get_count_top_users_query(group_by_column: str,
+                               start_date_str: str, end_date_str: str,
+                               group_by_filter: str = None) -> (str, dict):
+    paginated_data_query, query_params = _get_paginated_data_query(group_by_column, start_date_str, end_date_str,
+                                                                   group_by_filter)
+
+    query = f"""
+        with paginated_data as ({paginated_data_query})
+        SELECT COUNT(*) AS total_records FROM paginated_data;
+    """
+    return query, query_params
+
+def _get_paginated_data_query(group_by_column: str,
+                              start_date_str: str, end_date_str: str,
+                              group_by_filter: str = None,
+                              segments: list[tuple] = None) -> (str, dict):
+    _check_group_column(group_by_column)
+
+    # Usage per (group, user) over the range, read from the rollup where it covers the range
+    if segments is None:
+        segments = analytics_rollup.split_range(start_date_str, end_date_str, group_by_column)
+    if len(segments) > 1 or segments[0][0] == "rollup":
+        paginated_data_query, query_params = _get_rollup_top_users_query(group_by_column, segments, group_by_filter)
+    else:
+        if group_by_filter:
+            having_clause = f" having b.{group_by_column} = :filter_value"
+        else:
+            having_clause = ""
+
+        paginated_data_query = f"""
+          select
+          b.{group_by_column} as {TOP_USERS_GROUP_COLUMN},b.user_id,count(*) as cntr
+          from tyk_analytics_data a, key_tbl b
+          where a.request_date between :start_date AND :end_date
+          and b.value = a.api_key
+          group by b.{group_by_column},b.user_id
+          {having_clause}
+        """
+
+        query_params = {
+            "start_date" : start_date_str,
+            "end_date" : end_date_str
+        }
 
     if group_by_filter:
         query_params["filter_value"] = group_by_filter
 
-    # Fetch data from database into a DataFrame
-    df = _execute_sql_query(query,query_params)
-    return df
+    return paginated_data_query, query_params
+
+# Columns of each export level, in output order
+EXPORT_COLUMNS = {
+    "day": ["request_date", "api_key", "user_id", "tier", "ref_app", "cntr"],
+    "key": ["api_key", "user_id", "tier", "ref_app", "cntr"],
+    "user": ["user_id", "first_name", "last_name", "email", "cntr"]
+}
+
+def stream_export(level: str, start_date_str: str, end_date_str: str,
+                  user_id: int = None, batch_size: int = 1000):
+    """
+    Yield the export rows of a level ("day", "key" or "user") in lists of at
+    most batch_size rows, columns as in EXPORT_COLUMNS. Rows are read with a
+    server side cursor, so memory does not grow with the size of the range.
+    """
+    query, query_params = _get_export_query(level, start_date_str, end_date_str, user_id)
+
+    with database.connect() as connection:
+        result = connection.execution_options(stream_results=True, yield_per=batch_size).execute(
+            _statement(query), query_params)
+        for rows in result.partitions():
+            yield rows
+
+async def stream_export_async(level: str, start_date_str: str, end_date_str: str,
+                              user_id: int = None, batch_size: int = 1000):
+    query, query_params = await asyncio.to_thread(_get_export_query, level, start_date_str, end_date_str, user_id)
+
+    async with database.connect_async() as connection:
+        result = await connection.stream(_statement(query), query_params)
+        async for rows in result.partitions(batch_size):
+            yield rows
+
+def _get_export_query(level: str, start_date_str: str, end_date_str: str, user_id: int = None) -> (str, dict):
+    # Per key daily counts, from the rollup where it covers the range
+    segments = analytics_rollup.split_range(start_date_str, end_date_str, "user_id")
+    selects = []
+    query_params = {}
+    for index, (source, segment_start, segment_end) in enumerate(segments):
+        query_params[f"start_date_{index}"] = segment_start
+        query_params[f"end_date_{index}"] = segment_end
+
+        if source == "rollup":
+            user_id_filter = "and r.user_id = :user_id" if user_id else ""
+            selects.append(f"""
+            SELECT r.request_date, r.api_key, r.user_id, r.tier, r.ref_app, r.cntr
+            FROM {analytics_rollup.ROLLUP_TABLE} r
+            WHERE r.request_date BETWEEN :start_date_{index} AND :end_date_{index}
+            {user_id_filter}
+            """)
+        else:
+            user_id_filter = "and b.user_id = :user_id" if user_id else ""
+            selects.append(f"""
+            SELECT a.request_date, a.api_key, b.user_id, b.tier, b.ref_app, COUNT(*) AS cntr
+            FROM tyk_analytics_data a, key_tbl b
+            WHERE a.request_date BETWEEN :start_date_{index} AND :end_date_{index}
+            {user_id_filter}
+            and b.value = a.api_key
+            GROUP BY a.request_date, a.api_key, b.user_id, b.tier, b.ref_app
+            """)
+
+    if user_id:
+        query_params["user_id"] = int(user_id)
+
+    daily_query = " UNION ALL ".join(selects)
+    if level == "day":
+        query = f"""
+        SELECT s.request_date, s.api_key, s.user_id, s.tier, s.ref_app, s.cntr
+        FROM ({daily_query}) s
+        ORDER BY s.request_date, s.api_key;
+        """
+    elif level == "key":
+        query = f"""
+        SELECT s.api_key, s.user_id, s.tier, s.ref_app, CAST(SUM(s.cntr) AS {_bigint_type()}) AS cntr
+        FROM ({daily_query}) s
+        GROUP BY s.api_key, s.user_id, s.tier, s.ref_app
+        ORDER BY s.api_key, s.tier, s.ref_app;
+        """
+    elif level == "user":
+        # Left join, so usage of a user missing from user_tbl is still exported
+        query = f"""
+        SELECT s.user_id, u.first_name, u.last_name, u.email, CAST(SUM(s.cntr) AS {_bigint_type()}) AS cntr
+        FROM ({daily_query}) s
+        LEFT JOIN user_tbl u ON u.user_id = s.user_id
+        GROUP BY s.user_id, u.first_name, u.last_name, u.email
+        ORDER BY s.user_id;
+        """
+    else:
+        raise ValueError(f"Invalid export level: {level}. Expected one of {list(EXPORT_COLUMNS)}")
+
+    return query, query_params
+
+def _get_rollup_analytics_query(group_by_column: str, segments: list[tuple], user_id: int = None,
+                                aggregate_month: bool = False) -> (str, dict):
+    # Days covered by the rollup read its per key daily counts, the uncovered edges aggregate raw rows
+    selects = []
+    query_params = {}
+    for index, (source, segment_start, segment_end) in enumerate(segments):
+        query_params[f"start_date_{index}"] = segment_start
+        query_params[f"end_date_{index}"] = segment_end
+
+        if source == "rollup":
+            user_id_filter = "and r.user_id = :user_id" if user_id else ""
+            selects.append(f"""
+            SELECT r.request_date, r.{group_by_column} AS {group_by_column}, r.cntr
+            FROM {analytics_rollup.ROLLUP_TABLE} r
+            WHERE r.request_date BETWEEN :start_date_{index} AND :end_date_{index}
+            {user_id_filter}
+            """)
+        else:
+            user_id_filter = "and b.user_id = :user_id" if user_id else ""
+            selects.append(f"""
+            SELECT a.request_date, b.{group_by_column} AS {group_by_column}, COUNT(*) AS cntr
+            FROM tyk_analytics_data a, key_tbl b
+            WHERE a.request_date BETWEEN :start_date_{index} AND :end_date_{index}
+            {user_id_filter}
+            and b.value = a.api_key
+            GROUP BY a.request_date, b.{group_by_column}
+            """)
+    if user_id:
+        query_params["user_id"] = int(user_id)
+
+    date_column = _month_expression("s.request_date") if aggregate_month else "s.request_date"
+    query = f"""
+    SELECT
+        {date_column} AS request_date,
+        s.{group_by_column},
+        CAST(SUM(s.cntr) AS {_bigint_type()}) AS cntr
+    FROM ({" UNION ALL ".join(selects)}) s
+    GROUP BY {date_column}, s.{group_by_column}
+    """
+    return query, query_params
+
+def _get_rollup_top_users_query(group_by_column: str, segments: list[tuple], group_by_filter: str = None) -> (str, dict):
+    selects = []
+    query_params = {}
+    for index, (source, segment_start, segment_end) in enumerate(segments):
+        query_params[f"start_date_{index}"] = segment_start
+        query_params[f"end_date_{index}"] = segment_end
+
+        if source == "rollup":
+            selects.append(f"""
+              select r.{group_by_column} as {TOP_USERS_GROUP_COLUMN}, r.user_id as user_id, r.cntr
+              from {analytics_rollup.ROLLUP_TABLE} r
+              where r.request_date between :start_date_{index} AND :end_date_{index}
+            """)
+        else:
+            selects.append(f"""
+              select b.{group_by_column} as {TOP_USERS_GROUP_COLUMN}, b.user_id as user_id, count(*) as cntr
+              from tyk_analytics_data a, key_tbl b
+              where a.request_date between :start_date_{index} AND :end_date_{index}
+              and b.value = a.api_key
+              group by b.{group_by_column},b.user_id
+            """)
+
+    if group_by_filter:
+        having_clause = f" having s.{TOP_USERS_GROUP_COLUMN} = :filter_value"
+    else:
+        having_clause = ""
+
+    paginated_data_query = f"""
+          select
+          s.{TOP_USERS_GROUP_COLUMN},s.user_id,CAST(SUM(s.cntr) AS {_bigint_type()}) as cntr
+          from ({" union all ".join(selects)}) s
+          group by s.{TOP_USERS_GROUP_COLUMN},s.user_id
+          {having_clause}
+    """
+    return paginated_data_query, query_params
+
+def _bigint_type() -> str:
+    # SUM() returns DECIMAL on MySQL and NUMERIC on Postgres, cast it back to an integer
+    return "SIGNED" if database.get_dialect() == "mysql" else "BIGINT"
+
+def _month_expression(date_column: str) -> str:
+    # 'YYYY-MM' label of the month, computed by the database
+    if database.get_dialect() == "mysql":
+        return f"DATE_FORMAT({date_column}, '%Y-%m')"
+    if database.get_dialect() == "sqlite":
+        return f"strftime('%Y-%m', {date_column})"
+    return f"to_char(date_trunc('month', {date_column}), 'YYYY-MM')"
+
+def _null_safe_equals(left: str, right: str) -> str:
+    # Equality that also matches NULL with NULL, keys without a group value form a group of their own
+    if database.get_dialect() == "mysql":
+        return f"{left} <=> {right}"
+    if database.get_dialect() == "sqlite":
+        return f"{left} IS {right}"
+    return f"{left} IS NOT DISTINCT FROM {right}"
+
+def _fill_missing_months(aggregate_query: str, query_params: dict, group_by_column: str, months: list[str]) -> str:
+    # Cross join a calendar of the requested months with the groups found, and left join the counts
+    calendar = " UNION ALL ".join(f"SELECT :month_{index} AS request_date" for index in range(len(months)))
+    for index, month in enumerate(months):
+        query_params[f"month_{index}"] = month
+
+    return f"""
+    WITH monthly_data AS ({aggregate_query}),
+    calendar AS ({calendar}),
+    group_data AS (SELECT DISTINCT {group_by_column} FROM monthly_data)
+    SELECT
+        c.request_date,
+        g.{group_by_column},
+        COALESCE(m.cntr, 0) AS cntr
+    FROM calendar c
+    CROSS JOIN group_data g
+    LEFT JOIN monthly_data m
+      ON m.request_date = c.request_date
+     AND {_null_safe_equals(f"m.{group_by_column}", f"g.{group_by_column}")}
+    ORDER BY c.request_date, g.{group_by_column};
+    """
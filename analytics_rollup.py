@@ -0,0 +1,320 @@
+"""
+Daily rollup of tyk_analytics_data.
+
+tyk_analytics_daily_rollup keeps one row per (request_date, api_key) with the
+user_id, tier and ref_app of the key and the request count for that day.
+analytics_repository reads the rollup for the days it covers and falls back to
+the raw rows only for the uncovered edges of a range.
+
+tyk_analytics_latency_rollup and tyk_analytics_status_rollup (the "latency"
+rollup) keep the latency sketch buckets (see latency_sketch.py) and the
+response code counts of each key and day, for /analytics?mode=latency.
+
+Each rollup is refreshed incrementally from its own high-water mark kept in
+tyk_analytics_rollup_state. Only closed days (before today) are rolled up, as
+the current day still receives traffic. tier, ref_app and user_id are taken
+from key_tbl when a day is rolled up, so a later plan change does not move
+the traffic of past days to the new tier.
+
+Run from cron once a day (after midnight), for eg.
+$ python analytics_rollup.py init
+$ python analytics_rollup.py refresh
+$ python analytics_rollup.py refresh --rebuild-from 2024-12-01
+$ python analytics_rollup.py refresh --rollup daily
+"""
+
+import argparse
+import logging
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import text
+
+import database
+import latency_sketch
+import settings
+
+_settings = settings.get_settings()
+
+ROLLUP_ENABLED = _settings.analytics_rollup_enabled
+# How long a worker trusts the coverage it read from tyk_analytics_rollup_state
+ROLLUP_COVERAGE_TTL = _settings.analytics_rollup_coverage_ttl
+ROLLUP_CHUNK_DAYS = _settings.analytics_rollup_chunk_days
+
+ROLLUP_TABLE = "tyk_analytics_daily_rollup"
+STATE_TABLE = "tyk_analytics_rollup_state"
+ROLLUP_NAME = "daily"
+LATENCY_ROLLUP_TABLE = "tyk_analytics_latency_rollup"
+STATUS_ROLLUP_TABLE = "tyk_analytics_status_rollup"
+LATENCY_ROLLUP_NAME = "latency"
+ROLLUP_NAMES = (ROLLUP_NAME, LATENCY_ROLLUP_NAME)
+
+# Columns of the detailed records in tyk_analytics_data, the request time in milliseconds
+LATENCY_COLUMN = _settings.analytics_latency_column
+STATUS_COLUMN = _settings.analytics_status_column
+
+# key_tbl columns stored in the rollup, analytics grouped by anything else always read raw rows
+ROLLUP_GROUP_COLUMNS = ("tier", "ref_app", "user_id")
+
+DDL_STATEMENTS = [
+    f"""
+    CREATE TABLE IF NOT EXISTS {ROLLUP_TABLE} (
+        request_date DATE NOT NULL,
+        api_key VARCHAR(255) NOT NULL,
+        user_id BIGINT,
+        tier VARCHAR(255),
+        ref_app VARCHAR(255),
+        cntr BIGINT NOT NULL,
+        PRIMARY KEY (request_date, api_key)
+    )
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS {LATENCY_ROLLUP_TABLE} (
+        request_date DATE NOT NULL,
+        api_key VARCHAR(255) NOT NULL,
+        user_id BIGINT,
+        tier VARCHAR(255),
+        ref_app VARCHAR(255),
+        bucket INTEGER NOT NULL,
+        cntr BIGINT NOT NULL,
+        PRIMARY KEY (request_date, api_key, bucket)
+    )
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS {STATUS_ROLLUP_TABLE} (
+        request_date DATE NOT NULL,
+        api_key VARCHAR(255) NOT NULL,
+        user_id BIGINT,
+        tier VARCHAR(255),
+        ref_app VARCHAR(255),
+        response_code INTEGER NOT NULL,
+        cntr BIGINT NOT NULL,
+        PRIMARY KEY (request_date, api_key, response_code)
+    )
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS {STATE_TABLE} (
+        rollup_name VARCHAR(64) NOT NULL PRIMARY KEY,
+        covered_from DATE,
+        covered_through DATE,
+        refreshed_at TIMESTAMP
+    )
+    """
+]
+
+logger = logging.getLogger(__name__)
+
+# rollup name -> {"value": coverage, "read_at": time.monotonic() of the read}
+_coverage = {}
+_coverage_lock = threading.Lock()
+
+
+def create_tables() -> None:
+    with database.connect() as connection:
+        for statement in DDL_STATEMENTS:
+            connection.execute(text(statement))
+        connection.commit()
+
+
+def get_coverage(rollup_name: str = ROLLUP_NAME) -> (date, date):
+    """
+    Return (covered_from, covered_through) of the rollup, or None when the
+    rollup is disabled, empty or not created yet.
+    """
+    if not ROLLUP_ENABLED:
+        return None
+
+    with _coverage_lock:
+        cached = _coverage.get(rollup_name)
+        if cached is not None and time.monotonic() - cached["read_at"] < ROLLUP_COVERAGE_TTL:
+            return cached["value"]
+
+        try:
+            coverage = _read_state(rollup_name)
+        except Exception as e:
+            logger.warning("Rollup coverage unavailable, using raw analytics rows. rollup=%s error=%s", rollup_name, e)
+            coverage = None
+
+        _coverage[rollup_name] = {"value": coverage, "read_at": time.monotonic()}
+        return coverage
+
+
+def split_range(start_date_str: str, end_date_str: str, group_by_column: str,
+                rollup_name: str = ROLLUP_NAME) -> list[tuple]:
+    """
+    Split a date range into ("rollup" | "raw", start, end) segments.
+    Days covered by the rollup are read from it, the edges before and after
+    come from the raw rows.
+    """
+    coverage = get_coverage(rollup_name) if group_by_column in ROLLUP_GROUP_COLUMNS else None
+    if coverage is None:
+        return [("raw", start_date_str, end_date_str)]
+
+    start_date = _to_date(start_date_str)
+    end_date = _to_date(end_date_str)
+    covered_from, covered_through = coverage
+
+    if end_date < covered_from or start_date > covered_through:
+        return [("raw", start_date_str, end_date_str)]
+
+    segments = []
+    if start_date < covered_from:
+        segments.append(("raw", start_date.isoformat(), (covered_from - timedelta(days=1)).isoformat()))
+    segments.append(("rollup", max(start_date, covered_from).isoformat(), min(end_date, covered_through).isoformat()))
+    if end_date > covered_through:
+        segments.append(("raw", (covered_through + timedelta(days=1)).isoformat(), end_date.isoformat()))
+    return segments
+
+
+def refresh(until: date = None, rebuild_from: date = None, chunk_days: int = ROLLUP_CHUNK_DAYS,
+            rollup_name: str = ROLLUP_NAME) -> int:
+    """
+    Roll up every closed day after the high-water mark, up to and including
+    until (default yesterday). rebuild_from moves the high-water mark back
+    so late arriving rows are picked up. Returns the number of days rolled up.
+    """
+    until = until or date.today() - timedelta(days=1)
+    coverage = _read_state(rollup_name)
+
+    if coverage is None:
+        covered_from = _first_raw_date()
+        if covered_from is None:
+            logger.info("No raw analytics rows, nothing to roll up")
+            return 0
+        next_date = covered_from
+    else:
+        covered_from, covered_through = coverage
+        next_date = covered_through + timedelta(days=1)
+
+    if rebuild_from is not None:
+        covered_from = min(covered_from, rebuild_from)
+        next_date = min(next_date, rebuild_from)
+
+    days = 0
+    while next_date <= until:
+        chunk_end = min(next_date + timedelta(days=chunk_days - 1), until)
+        # Each chunk replaces its days and moves the high-water mark in one transaction
+        with database.connect() as connection:
+            params = {"start_date": next_date, "end_date": chunk_end}
+            for table, insert_statement in _rollup_statements(rollup_name):
+                connection.execute(text(f"DELETE FROM {table} WHERE request_date BETWEEN :start_date AND :end_date"),
+                                   params)
+                connection.execute(text(insert_statement), params)
+            _write_state(connection, covered_from, chunk_end, rollup_name)
+            connection.commit()
+
+        logger.info("Rolled up %s to %s rollup=%s", next_date, chunk_end, rollup_name)
+        days += (chunk_end - next_date).days + 1
+        next_date = chunk_end + timedelta(days=1)
+
+    return days
+
+
+def _rollup_statements(rollup_name: str) -> list[tuple]:
+    # (table, INSERT ... SELECT of the days between :start_date and :end_date) of each table of a rollup
+    if rollup_name == ROLLUP_NAME:
+        return [(ROLLUP_TABLE, f"""
+            INSERT INTO {ROLLUP_TABLE} (request_date, api_key, user_id, tier, ref_app, cntr)
+            SELECT a.request_date, a.api_key, b.user_id, b.tier, b.ref_app, COUNT(*)
+            FROM tyk_analytics_data a, key_tbl b
+            WHERE a.request_date BETWEEN :start_date AND :end_date
+            and b.value = a.api_key
+            GROUP BY a.request_date, a.api_key, b.user_id, b.tier, b.ref_app
+        """)]
+
+    if rollup_name == LATENCY_ROLLUP_NAME:
+        bucket = latency_sketch.bucket_expression(f"a.{LATENCY_COLUMN}")
+        response_code = f"COALESCE(a.{STATUS_COLUMN}, 0)"
+        return [(LATENCY_ROLLUP_TABLE, f"""
+            INSERT INTO {LATENCY_ROLLUP_TABLE} (request_date, api_key, user_id, tier, ref_app, bucket, cntr)
+            SELECT a.request_date, a.api_key, b.user_id, b.tier, b.ref_app, {bucket}, COUNT(*)
+            FROM tyk_analytics_data a, key_tbl b
+            WHERE a.request_date BETWEEN :start_date AND :end_date
+            and a.{LATENCY_COLUMN} IS NOT NULL
+            and b.value = a.api_key
+            GROUP BY a.request_date, a.api_key, b.user_id, b.tier, b.ref_app, {bucket}
+        """), (STATUS_ROLLUP_TABLE, f"""
+            INSERT INTO {STATUS_ROLLUP_TABLE} (request_date, api_key, user_id, tier, ref_app, response_code, cntr)
+            SELECT a.request_date, a.api_key, b.user_id, b.tier, b.ref_app, {response_code}, COUNT(*)
+            FROM tyk_analytics_data a, key_tbl b
+            WHERE a.request_date BETWEEN :start_date AND :end_date
+            and b.value = a.api_key
+            GROUP BY a.request_date, a.api_key, b.user_id, b.tier, b.ref_app, {response_code}
+        """)]
+
+    raise ValueError(f"Invalid rollup: {rollup_name}. Expected one of {list(ROLLUP_NAMES)}")
+
+
+def _read_state(rollup_name: str = ROLLUP_NAME) -> (date, date):
+    with database.connect() as connection:
+        row = connection.execute(text(f"""
+            SELECT covered_from, covered_through FROM {STATE_TABLE} WHERE rollup_name = :rollup_name
+        """), {"rollup_name": rollup_name}).first()
+
+    if row is None or row.covered_from is None or row.covered_through is None:
+        return None
+    return _to_date(row.covered_from), _to_date(row.covered_through)
+
+
+def _write_state(connection, covered_from: date, covered_through: date, rollup_name: str = ROLLUP_NAME) -> None:
+    params = {
+        "rollup_name": rollup_name,
+        "covered_from": covered_from,
+        "covered_through": covered_through,
+        "refreshed_at": datetime.now()
+    }
+    result = connection.execute(text(f"""
+        UPDATE {STATE_TABLE}
+        SET covered_from = :covered_from, covered_through = :covered_through, refreshed_at = :refreshed_at
+        WHERE rollup_name = :rollup_name
+    """), params)
+    if result.rowcount == 0:
+        connection.execute(text(f"""
+            INSERT INTO {STATE_TABLE} (rollup_name, covered_from, covered_through, refreshed_at)
+            VALUES (:rollup_name, :covered_from, :covered_through, :refreshed_at)
+        """), params)
+
+
+def _first_raw_date() -> date:
+    with database.connect() as connection:
+        first_date = connection.execute(text("SELECT MIN(request_date) FROM tyk_analytics_data")).scalar()
+    return _to_date(first_date) if first_date is not None else None
+
+
+def _to_date(value) -> date:
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(str(value)[:10], "%Y-%m-%d").date()
+
+
+def _parse_date(value: str) -> date:
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=_settings.log_level,
+                        format="%(asctime)s %(levelname)s %(name)s %(message)s")
+
+    parser = argparse.ArgumentParser(description="Maintain the daily analytics rollup")
+    parser.add_argument("command", choices=["init", "refresh"])
+    parser.add_argument("--until", type=_parse_date, default=None,
+                        help="last day to roll up, YYYY-MM-DD (default yesterday)")
+    parser.add_argument("--rebuild-from", type=_parse_date, default=None,
+                        help="recompute days from this date, YYYY-MM-DD")
+    parser.add_argument("--chunk-days", type=int, default=ROLLUP_CHUNK_DAYS,
+                        help="days per transaction")
+    parser.add_argument("--rollup", choices=list(ROLLUP_NAMES) + ["all"], default="all",
+                        help="rollup to refresh, daily request counts or latency and response codes (default all)")
+    args = parser.parse_args()
+
+    if args.command == "init":
+        create_tables()
+        print("Rollup tables created")
+    else:
+        for name in (ROLLUP_NAMES if args.rollup == "all" else [args.rollup]):
+            rolled_up = refresh(until=args.until, rebuild_from=args.rebuild_from, chunk_days=args.chunk_days,
+                                rollup_name=name)
+            print(f"Rolled up {rolled_up} days rollup={name}")
@@ -0,0 +1,697 @@
+"""
+Analytics part of the service layer: /analytics (request counts and latency),
+/analytics/multi, /top-users and the exports.
+
+It pulls in pandas, numpy and the database drivers, so service.py imports it
+only on first use (see service.__getattr__) and a worker that never serves
+analytics never pays for it. service.warm_up() imports it ahead of time.
+"""
+
+import asyncio
+import base64
+import csv
+import io
+import json
+import logging
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from pandas.core.frame import DataFrame
+
+import analytics_repository as repository
+import analytics_rollup
+import latency_sketch
+import metrics
+import result_cache
+import settings
+import single_flight
+from api_response import ApiResponse
+from json_provider import dumps_bytes
+
+_settings = settings.get_settings()
+
+INTERNAL_SERVER_ERROR = "500"
+
+# Columns /analytics and /top-users can group by
+ANALYTICS_GROUP_COLUMNS = repository.GROUP_COLUMNS
+
+# Groupings and date ranges of one /analytics/multi request, all computed from a single query
+MULTI_ANALYTICS_GROUP_COLUMNS = tuple(column for column in analytics_rollup.ROLLUP_GROUP_COLUMNS
+                                      if column in ANALYTICS_GROUP_COLUMNS)
+MULTI_ANALYTICS_MAX_RANGES = _settings.multi_analytics_max_ranges
+
+# /analytics modes: request counts, or latency percentiles and response codes
+ANALYTICS_MODES = ("requests", "latency")
+STATUS_CLASSES = ("1xx", "2xx", "3xx", "4xx", "5xx", "other")
+
+# Streaming exports, rows are fetched from the database EXPORT_BATCH_SIZE at a time
+EXPORT_BATCH_SIZE = _settings.export_batch_size
+EXPORT_LEVELS = tuple(repository.EXPORT_COLUMNS)
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv"
+}
+
+logger = logging.getLogger(__name__)
+
+_analytics_cache = result_cache.create_cache("analytics")
+_top_users_cache = result_cache.create_cache("top_users")
+_top_users_total_cache = result_cache.create_cache("top_users_total")
+_multi_analytics_cache = result_cache.create_cache("multi_analytics")
+_latency_analytics_cache = result_cache.create_cache("latency_analytics")
+
+# Concurrent identical requests that miss the cache share one computation
+_analytics_flight = single_flight.create_group("analytics")
+_top_users_flight = single_flight.create_group("top_users")
+_multi_analytics_flight = single_flight.create_group("multi_analytics")
+_latency_analytics_flight = single_flight.create_group("latency_analytics")
+
+
+def get_analytics(group_by_column:str, start_date_str:str, end_date_str:str,user_id: int = None) -> dict:
+    return _cached(_analytics_cache, _analytics_flight,
+                   _analytics_cache_key(group_by_column, start_date_str, end_date_str, user_id),
+                   result_cache.ttl_for_range(end_date_str),
+                   lambda: _compute_analytics(group_by_column, start_date_str, end_date_str, user_id))
+
+async def get_analytics_async(group_by_column:str, start_date_str:str, end_date_str:str,user_id: int = None) -> dict:
+    return await _cached_async(_analytics_cache, _analytics_flight,
+                               _analytics_cache_key(group_by_column, start_date_str, end_date_str, user_id),
+                               result_cache.ttl_for_range(end_date_str),
+                               lambda: _compute_analytics_async(group_by_column, start_date_str, end_date_str,
+                                                                user_id))
+
+def _cached(cache, flight, cache_key:str, ttl:int, compute) -> dict:
+    """
+    The cached result of cache_key, else compute() shared by the concurrent
+    callers of cache_key. _cached_async is the same for a coroutine compute.
+    """
+    result = cache.get(cache_key)
+    if result is None:
+        result = flight.do(cache_key, lambda: _store(cache, cache_key, ttl, compute()))
+    return result
+
+async def _cached_async(cache, flight, cache_key:str, ttl:int, compute) -> dict:
+    result = cache.get(cache_key)
+    if result is None:
+        async def compute_and_store() -> dict:
+            return _store(cache, cache_key, ttl, await compute())
+
+        result = await flight.do_async(cache_key, compute_and_store)
+    return result
+
+def _store(cache, cache_key:str, ttl:int, result:dict) -> dict:
+    # Only successful results are cached, failures are retried on the next call.
+    # Cached before the flight ends, so later callers hit the cache
+    if result["status_code"] == "200":
+        cache.set(cache_key, result, ttl)
+    return result
+
+def _request_failed(e:Exception) -> dict:
+    return ApiResponse(error="Request failed",
+                       statuscode=INTERNAL_SERVER_ERROR,
+                       response=str(e)).to_dictionary()
+
+def _analytics_cache_key(group_by_column:str, start_date_str:str, end_date_str:str,user_id: int = None) -> str:
+    return result_cache.make_key("analytics", group_by=group_by_column,
+                                 start_date=start_date_str, end_date=end_date_str,
+                                 user_id=user_id)
+
+def _analytics_range(start_date_str:str, end_date_str:str) -> (int, bool, list[str]):
+    days_count = _count_dates_between(start_date_str, end_date_str)
+    # Ranges over 30 days are grouped by month and zero filled in the database
+    aggregate_month = days_count > 30
+    return days_count, aggregate_month, _get_date_range(start_date_str, end_date_str, aggregate_month)
+
+def _compute_analytics(group_by_column:str, start_date_str:str, end_date_str:str,user_id: int = None) -> dict:
+    try:
+        days_count, aggregate_month, unique_dates = _analytics_range(start_date_str, end_date_str)
+        with metrics.stage("analytics", "query"):
+            analytics_data_frame = repository.get_analytics(group_by_column, start_date_str, end_date_str, user_id,
+                                                            aggregate_month=aggregate_month,
+                                                            fill_months=unique_dates if aggregate_month else None)
+        return _to_analytics_response(analytics_data_frame, group_by_column, start_date_str, end_date_str,
+                                      days_count, unique_dates).to_dictionary()
+    except Exception as e:
+        return _request_failed(e)
+
+async def _compute_analytics_async(group_by_column:str, start_date_str:str, end_date_str:str,user_id: int = None) -> dict:
+    try:
+        days_count, aggregate_month, unique_dates = _analytics_range(start_date_str, end_date_str)
+        with metrics.stage("analytics", "query"):
+            analytics_data_frame = await repository.get_analytics_async(group_by_column, start_date_str, end_date_str,
+                                                                        user_id,
+                                                                        aggregate_month=aggregate_month,
+                                                                        fill_months=unique_dates if aggregate_month else None)
+        return _to_analytics_response(analytics_data_frame, group_by_column, start_date_str, end_date_str,
+                                      days_count, unique_dates).to_dictionary()
+    except Exception as e:
+        return _request_failed(e)
+
+def _to_analytics_response(analytics_data_frame:DataFrame, group_by_column:str,
+                           start_date_str:str, end_date_str:str,
+                           days_count:int, unique_dates:list[str]) -> ApiResponse:
+    if analytics_data_frame.empty:
+        logger.info("No records found group_by=%s start_date=%s end_date=%s", group_by_column, start_date_str, end_date_str)
+        return ApiResponse(message="No Data Found",
+                           response=None,
+                           statuscode="200")
+
+    logger.debug("analytics stage=source rows=%d\n%s", len(analytics_data_frame), analytics_data_frame)
+
+    # request_date already arrives as 'YYYY-mm-dd' (or 'YYYY-mm') labels, see repository._to_data_frame
+    with metrics.stage("analytics", "fill_missing"):
+        corrected_df = _insert_missing_rows(analytics_data_frame, group_by_column,unique_dates)
+    logger.debug("analytics stage=corrected rows=%d\n%s", len(corrected_df), corrected_df)
+
+    with metrics.stage("analytics", "pivot"):
+        analytics_data = _get_analytics_data(corrected_df, group_by_column, days_count)
+
+    return ApiResponse(message="Success",
+                       response=analytics_data,
+                       statuscode="200")
+
+def get_multi_analytics(group_by_columns:list[str], date_ranges:list[tuple], user_id: int = None) -> dict:
+    """
+    Analytics of every grouping over every date range, for eg. tier and
+    ref_app for this month and last month, from one database query. Each
+    result has the analytics_data shape of get_analytics.
+    """
+    return _cached(_multi_analytics_cache, _multi_analytics_flight,
+                   _multi_analytics_cache_key(group_by_columns, date_ranges, user_id),
+                   _multi_analytics_ttl(date_ranges),
+                   lambda: _compute_multi_analytics(group_by_columns, date_ranges, user_id))
+
+async def get_multi_analytics_async(group_by_columns:list[str], date_ranges:list[tuple], user_id: int = None) -> dict:
+    return await _cached_async(_multi_analytics_cache, _multi_analytics_flight,
+                               _multi_analytics_cache_key(group_by_columns, date_ranges, user_id),
+                               _multi_analytics_ttl(date_ranges),
+                               lambda: _compute_multi_analytics_async(group_by_columns, date_ranges, user_id))
+
+def _multi_analytics_cache_key(group_by_columns:list[str], date_ranges:list[tuple], user_id: int = None) -> str:
+    return result_cache.make_key("multi_analytics", group_by=",".join(group_by_columns),
+                                 ranges=",".join(f"{start}:{end}" for start, end in date_ranges),
+                                 user_id=user_id)
+
+def _multi_analytics_ttl(date_ranges:list[tuple]) -> int:
+    # The range ending last decides, a range that includes today keeps the short TTL
+    return result_cache.ttl_for_range(max(end for _, end in date_ranges))
+
+def _compute_multi_analytics(group_by_columns:list[str], date_ranges:list[tuple], user_id: int = None) -> dict:
+    try:
+        with metrics.stage("multi_analytics", "query"):
+            frames = repository.get_multi_analytics(group_by_columns, date_ranges, user_id)
+        return _to_multi_analytics_response(frames, group_by_columns, date_ranges).to_dictionary()
+    except Exception as e:
+        return _request_failed(e)
+
+async def _compute_multi_analytics_async(group_by_columns:list[str], date_ranges:list[tuple],
+                                         user_id: int = None) -> dict:
+    try:
+        with metrics.stage("multi_analytics", "query"):
+            frames = await repository.get_multi_analytics_async(group_by_columns, date_ranges, user_id)
+        return _to_multi_analytics_response(frames, group_by_columns, date_ranges).to_dictionary()
+    except Exception as e:
+        return _request_failed(e)
+
+def _to_multi_analytics_response(frames:dict, group_by_columns:list[str], date_ranges:list[tuple]) -> ApiResponse:
+    results = []
+    for start_date_str, end_date_str in date_ranges:
+        days_count, aggregate_month, unique_dates = _analytics_range(start_date_str, end_date_str)
+
+        for group_by_column in group_by_columns:
+            daily = frames[group_by_column]
+            request_dates = daily['request_date'].astype(str)
+            in_range = (request_dates >= start_date_str) & (request_dates <= end_date_str)
+            data_frame = daily[in_range].assign(request_date=request_dates[in_range])
+            if isinstance(data_frame[group_by_column].dtype, pd.CategoricalDtype):
+                data_frame[group_by_column] = data_frame[group_by_column].cat.remove_unused_categories()
+
+            # Same 'YYYY-MM' labels as the monthly query of get_analytics
+            if aggregate_month:
+                data_frame['request_date'] = data_frame['request_date'].str[:7]
+                data_frame = (data_frame.groupby(['request_date', group_by_column], observed=True, sort=True,
+                                                 dropna=False)['cntr']
+                              .sum()
+                              .reset_index())
+
+            api_response = _to_analytics_response(data_frame.reset_index(drop=True), group_by_column,
+                                                  start_date_str, end_date_str, days_count, unique_dates)
+            results.append({
+                "group_by": group_by_column,
+                "start_date": start_date_str,
+                "end_date": end_date_str,
+                "message": api_response.message,
+                "data": api_response.response
+            })
+
+    return ApiResponse(message="Success",
+                       response={"results": results},
+                       statuscode="200")
+
+def get_latency_analytics(group_by_column:str, start_date_str:str, end_date_str:str, user_id: int = None) -> dict:
+    """
+    p50/p95/p99 latency and response code counts per group and day (per
+    month for ranges over 30 days), from the merged latency sketches.
+    """
+    return _cached(_latency_analytics_cache, _latency_analytics_flight,
+                   _latency_analytics_cache_key(group_by_column, start_date_str, end_date_str, user_id),
+                   result_cache.ttl_for_range(end_date_str),
+                   lambda: _compute_latency_analytics(group_by_column, start_date_str, end_date_str, user_id))
+
+async def get_latency_analytics_async(group_by_column:str, start_date_str:str, end_date_str:str,
+                                      user_id: int = None) -> dict:
+    return await _cached_async(_latency_analytics_cache, _latency_analytics_flight,
+                               _latency_analytics_cache_key(group_by_column, start_date_str, end_date_str, user_id),
+                               result_cache.ttl_for_range(end_date_str),
+                               lambda: _compute_latency_analytics_async(group_by_column, start_date_str,
+                                                                        end_date_str, user_id))
+
+def _latency_analytics_cache_key(group_by_column:str, start_date_str:str, end_date_str:str, user_id: int = None) -> str:
+    return result_cache.make_key("latency_analytics", group_by=group_by_column,
+                                 start_date=start_date_str, end_date=end_date_str,
+                                 user_id=user_id)
+
+def _compute_latency_analytics(group_by_column:str, start_date_str:str, end_date_str:str, user_id: int = None) -> dict:
+    try:
+        _, aggregate_month, unique_dates = _analytics_range(start_date_str, end_date_str)
+        with metrics.stage("latency_analytics", "query"):
+            latency_data_frame = repository.get_latency(group_by_column, start_date_str, end_date_str, user_id,
+                                                        aggregate_month=aggregate_month)
+            status_data_frame = repository.get_status_codes(group_by_column, start_date_str, end_date_str, user_id,
+                                                            aggregate_month=aggregate_month)
+        return _to_latency_response(latency_data_frame, status_data_frame, group_by_column,
+                                    unique_dates).to_dictionary()
+    except Exception as e:
+        return _request_failed(e)
+
+async def _compute_latency_analytics_async(group_by_column:str, start_date_str:str, end_date_str:str,
+                                           user_id: int = None) -> dict:
+    try:
+        _, aggregate_month, unique_dates = _analytics_range(start_date_str, end_date_str)
+        with metrics.stage("latency_analytics", "query"):
+            latency_data_frame, status_data_frame = await asyncio.gather(
+                repository.get_latency_async(group_by_column, start_date_str, end_date_str, user_id,
+                                             aggregate_month=aggregate_month),
+                repository.get_status_codes_async(group_by_column, start_date_str, end_date_str, user_id,
+                                                  aggregate_month=aggregate_month))
+        return _to_latency_response(latency_data_frame, status_data_frame, group_by_column,
+                                    unique_dates).to_dictionary()
+    except Exception as e:
+        return _request_failed(e)
+
+def _to_latency_response(latency_data_frame:DataFrame, status_data_frame:DataFrame,
+                         group_by_column:str, unique_dates:list[str]) -> ApiResponse:
+    if status_data_frame.empty:
+        logger.info("No records found mode=latency group_by=%s", group_by_column)
+        return ApiResponse(message="No Data Found",
+                           response=None,
+                           statuscode="200")
+
+    with metrics.stage("latency_analytics", "percentiles"):
+        # Plain python keys, so the frames line up with the date and group labels
+        key_columns = ['request_date', group_by_column]
+        latency_data_frame = latency_data_frame.astype({column: object for column in key_columns})
+        status_data_frame = status_data_frame.astype({column: object for column in key_columns})
+        status_data_frame['status_class'] = _status_classes(status_data_frame['response_code'])
+
+        status_classes = [status_class for status_class in STATUS_CLASSES
+                          if status_class in set(status_data_frame['status_class'])]
+        # Keys without a group value are a group of their own (None, first) as in /analytics, so the
+        # trend adds up to the totals. The frames are keyed by the position of each group in group_labels
+        group_values = pd.concat([latency_data_frame[group_by_column], status_data_frame[group_by_column]])
+        group_labels = (([None] if group_values.isna().any() else [])
+                        + sorted(group_values.dropna().unique().tolist()))
+        latency_data_frame[group_by_column] = _group_positions(latency_data_frame[group_by_column], group_labels)
+        status_data_frame[group_by_column] = _group_positions(status_data_frame[group_by_column], group_labels)
+        positions = list(range(len(group_labels)))
+
+        # Metrics of every (date, group), then of every group, date and of the whole range
+        grid = pd.MultiIndex.from_product([unique_dates, positions], names=key_columns)
+        daily = _latency_metrics(latency_data_frame, status_data_frame, key_columns, grid, status_classes)
+        groups = _latency_metrics(latency_data_frame, status_data_frame, [group_by_column],
+                                  pd.Index(positions, name=group_by_column), status_classes)
+        status_codes = status_data_frame.groupby([group_by_column, 'response_code'])['cntr'].sum()
+
+        everything = {'_total': "total"}
+        total_daily = _latency_metrics(latency_data_frame.assign(**everything), status_data_frame.assign(**everything),
+                                       ['request_date', '_total'],
+                                       pd.MultiIndex.from_product([unique_dates, ["total"]]), status_classes)
+        total = _latency_metrics(latency_data_frame.assign(**everything), status_data_frame.assign(**everything),
+                                 ['_total'], pd.Index(["total"]), status_classes)
+        total_status_codes = status_data_frame.groupby('response_code')['cntr'].sum()
+
+        columns = list(daily.columns)
+        latency_data = {
+            "range": unique_dates,
+            "percentiles": list(latency_sketch.PERCENTILES),
+            "relative_accuracy": latency_sketch.RELATIVE_ACCURACY,
+            "status_classes": status_classes,
+            "total": _to_lists(total_daily, columns),
+            "trend": [
+                {
+                    "group": group,
+                    "summary": _latency_summary(groups.iloc[position], status_codes.loc[position]),
+                    "data": _to_lists(daily.xs(position, level=group_by_column), columns)
+                }
+                for position, group in enumerate(group_labels)
+            ]
+        }
+
+    final_result = {
+        "data": {
+            "summary": _latency_summary(total.iloc[0], total_status_codes),
+            "latency_data": latency_data
+        }
+    }
+    return ApiResponse(message="Success",
+                       response=final_result,
+                       statuscode="200")
+
+def _group_positions(values, group_labels:list) -> pd.Series:
+    # Position of each group value in group_labels, where None stands for the missing values
+    positions = {label: position for position, label in enumerate(group_labels) if label is not None}
+    missing = group_labels.index(None) if None in group_labels else -1
+    return values.map(positions).where(values.notna(), missing).astype("int64")
+
+def _latency_metrics(latency_data_frame:DataFrame, status_data_frame:DataFrame, key_columns:list[str],
+                     index, status_classes:list[str]) -> DataFrame:
+    # requests, p50_ms, p95_ms, p99_ms and the count of each status class, one row per entry of index
+    percentiles = latency_sketch.summarize(latency_data_frame, key_columns).set_index(key_columns)
+    status = status_data_frame.pivot_table(index=key_columns, columns='status_class', values='cntr',
+                                           aggfunc='sum', fill_value=0)
+
+    result = pd.DataFrame(index=index)
+    result['requests'] = status.sum(axis=1).reindex(index, fill_value=0).to_numpy()
+    for percentile in latency_sketch.PERCENTILES:
+        result[f'p{percentile}_ms'] = percentiles[f'p{percentile}'].reindex(index).round(1).to_numpy()
+    for status_class in status_classes:
+        counts = status[status_class] if status_class in status.columns else pd.Series(dtype='int64')
+        result[status_class] = counts.reindex(index, fill_value=0).to_numpy()
+    return result
+
+def _latency_summary(row, status_codes) -> dict:
+    summary = {"total_requests": int(row['requests'])}
+    for percentile in latency_sketch.PERCENTILES:
+        value = row[f'p{percentile}_ms']
+        summary[f'p{percentile}_ms'] = None if pd.isna(value) else float(value)
+    summary["status_codes"] = {str(code): int(count) for code, count in status_codes.items()}
+    return summary
+
+def _to_lists(data_frame:DataFrame, columns:list[str]) -> dict:
+    # One list per metric, in date order. Days without latencies have None percentiles
+    return {column: [None if pd.isna(value) else value for value in data_frame[column].tolist()]
+            for column in columns}
+
+def _status_classes(response_codes) -> np.ndarray:
+    codes = response_codes.to_numpy()
+    classes = np.array([f"{hundred}xx" for hundred in range(1, 6)] + ["other"], dtype=object)
+    # 100-599 map to 1xx-5xx, anything else (0 when Tyk recorded no code) to other
+    positions = np.where((codes >= 100) & (codes < 600), codes // 100 - 1, 5)
+    return classes[positions]
+
+def get_top_users(group_by_column:str, start_date_str:str, end_date_str:str,
+                  limit:int,offset:int, group_by_filter:str = None,
+                  cursor:str = None) -> dict:
+    return _cached(_top_users_cache, _top_users_flight,
+                   _top_users_cache_key(group_by_column, start_date_str, end_date_str,
+                                        limit, offset, group_by_filter, cursor),
+                   result_cache.ttl_for_range(end_date_str),
+                   lambda: _compute_top_users(group_by_column, start_date_str, end_date_str,
+                                              limit, offset, group_by_filter, cursor))
+
+async def get_top_users_async(group_by_column:str, start_date_str:str, end_date_str:str,
+                              limit:int,offset:int, group_by_filter:str = None,
+                              cursor:str = None) -> dict:
+    return await _cached_async(_top_users_cache, _top_users_flight,
+                               _top_users_cache_key(group_by_column, start_date_str, end_date_str,
+                                                    limit, offset, group_by_filter, cursor),
+                               result_cache.ttl_for_range(end_date_str),
+                               lambda: _compute_top_users_async(group_by_column, start_date_str, end_date_str,
+                                                                limit, offset, group_by_filter, cursor))
+
+def _top_users_cache_key(group_by_column:str, start_date_str:str, end_date_str:str,
+                         limit:int,offset:int, group_by_filter:str = None,
+                         cursor:str = None) -> str:
+    return result_cache.make_key("top_users", group_by=group_by_column,
+                                 start_date=start_date_str, end_date=end_date_str,
+                                 limit=limit, offset=offset, filter_by=group_by_filter,
+                                 cursor=cursor)
+
+def _compute_top_users(group_by_column:str, start_date_str:str, end_date_str:str,
+                       limit:int,offset:int, group_by_filter:str = None,
+                       cursor:str = None) -> dict:
+    try:
+        after = _decode_cursor(cursor) if cursor else None
+    except ValueError:
+        return _invalid_cursor()
+
+    try:
+        with metrics.stage("top_users", "query"):
+            top_users_data_frame = repository.get_top_users(group_by_column, start_date_str, end_date_str,
+                                                 limit,offset,group_by_filter,after)
+        total_users = None
+        if not top_users_data_frame.empty:
+            with metrics.stage("top_users", "count"):
+                total_users = _get_total_users(group_by_column, start_date_str, end_date_str, group_by_filter)
+        return _to_top_users_response(top_users_data_frame, total_users, limit)
+    except Exception as e:
+        return _request_failed(e)
+
+async def _compute_top_users_async(group_by_column:str, start_date_str:str, end_date_str:str,
+                                   limit:int,offset:int, group_by_filter:str = None,
+                                   cursor:str = None) -> dict:
+    try:
+        after = _decode_cursor(cursor) if cursor else None
+    except ValueError:
+        return _invalid_cursor()
+
+    try:
+        with metrics.stage("top_users", "query"):
+            top_users_data_frame = await repository.get_top_users_async(group_by_column, start_date_str, end_date_str,
+                                                                        limit,offset,group_by_filter,after)
+        total_users = None
+        if not top_users_data_frame.empty:
+            with metrics.stage("top_users", "count"):
+                total_users = await _get_total_users_async(group_by_column, start_date_str, end_date_str,
+                                                           group_by_filter)
+        return _to_top_users_response(top_users_data_frame, total_users, limit)
+    except Exception as e:
+        return _request_failed(e)
+
+def _invalid_cursor() -> dict:
+    return ApiResponse(error="Invalid 'cursor' in request parameter",
+                       statuscode="400").to_dictionary()
+
+def _to_top_users_response(top_users_data_frame:DataFrame, total_users:int, limit:int) -> dict:
+    if top_users_data_frame.empty:
+        return ApiResponse(message="No Data Found",
+                           response=None,
+                           statuscode="200").to_dictionary()
+
+    with metrics.stage("top_users", "format"):
+        top_users_data = _get_top_users(top_users_data_frame,total_users,limit)
+    return ApiResponse(message="Success",
+                       response=top_users_data,
+                       statuscode="200").to_dictionary()
+
+def _get_total_users(group_by_column:str, start_date_str:str, end_date_str:str, group_by_filter:str = None) -> int:
+    # The total does not depend on the page, so it is counted once per (range, group, filter)
+    cache_key = _total_users_cache_key(group_by_column, start_date_str, end_date_str, group_by_filter)
+    total_users = _top_users_total_cache.get(cache_key)
+    if total_users is None:
+        total_users = repository.count_top_users(group_by_column, start_date_str, end_date_str, group_by_filter)
+        _top_users_total_cache.set(cache_key, total_users, result_cache.ttl_for_range(end_date_str))
+    return total_users
+
+async def _get_total_users_async(group_by_column:str, start_date_str:str, end_date_str:str,
+                                 group_by_filter:str = None) -> int:
+    cache_key = _total_users_cache_key(group_by_column, start_date_str, end_date_str, group_by_filter)
+    total_users = _top_users_total_cache.get(cache_key)
+    if total_users is None:
+        total_users = await repository.count_top_users_async(group_by_column, start_date_str, end_date_str,
+                                                             group_by_filter)
+        _top_users_total_cache.set(cache_key, total_users, result_cache.ttl_for_range(end_date_str))
+    return total_users
+
+def _total_users_cache_key(group_by_column:str, start_date_str:str, end_date_str:str, group_by_filter:str = None) -> str:
+    return result_cache.make_key("top_users_total", group_by=group_by_column,
+                                 start_date=start_date_str, end_date=end_date_str,
+                                 filter_by=group_by_filter)
+
+def _get_analytics_data(data_frame:DataFrame,group_by_column:str,total_days:int ) -> dict:
+
+    # Calculate total_requests and average_daily_requests
+    total_requests = int(data_frame['cntr'].sum())
+    average_daily_requests = int(total_requests // total_days)
+
+    # Pivot once into a request_date x group matrix, keeping the order in which dates and groups appear
+    date_labels = data_frame['request_date'].unique()
+    group_labels = data_frame[group_by_column].unique()
+    counts = (data_frame.pivot(index='request_date', columns=group_by_column, values='cntr')
+              .reindex(index=date_labels, columns=group_labels)
+              .fillna(0)
+              .to_numpy(dtype='int64'))
+
+    # Rows of the matrix sum to the cumulative series, columns are the trend of each group.
+    # tolist() on the numpy arrays yields plain python ints
+    analytics_data = {
+        "range": date_labels.tolist(),
+        "cumulative": counts.sum(axis=1).tolist(),
+        "trend": [
+            {"group": group, "data": data}
+            for group, data in zip(group_labels.tolist(), counts.T.tolist())
+        ]
+    }
+
+    # Create the final output structure
+    final_result = {
+        "data": {
+            "summary": {
+                "total_requests": total_requests,
+                "average_daily_requests": average_daily_requests
+            },
+            "analytics_data": analytics_data
+        }
+    }
+
+    return final_result
+
+def _insert_missing_rows(data_frame:DataFrame, group_by_column:str,unique_dates:list[str]) -> DataFrame:
+
+    #Get unique values for group_by_column
+    unique_groups = data_frame[group_by_column].unique()
+
+    # Cartesian grid of every (date, group) pair; pairs absent from the frame are the missing rows
+    key_columns = ['request_date', group_by_column]
+    full_index = pd.MultiIndex.from_product([unique_dates, unique_groups], names=key_columns)
+    counts = data_frame.set_index(key_columns)['cntr']
+
+    missing_index = full_index.difference(counts.index)
+    if missing_index.empty:
+        return data_frame  #return original if no new changes
+
+    # Insert the missing pairs with cntr as 0 in one reindex
+    corrected_df = counts.reindex(counts.index.append(missing_index), fill_value=0).reset_index()
+    return corrected_df.sort_values(by=key_columns).reset_index(drop=True)
+
+def _count_dates_between(start_date_str, end_date_str) -> int:
+    # Convert the date strings to datetime objects
+    start_date = datetime.strptime(start_date_str, "%Y-%m-%d")
+    end_date = datetime.strptime(end_date_str, "%Y-%m-%d")
+
+    # Calculate the difference in days
+    delta = (end_date - start_date).days
+
+    return delta
+
+def _get_top_users(data_frame: DataFrame, total_users: int, limit: int) -> dict:
+    result_dict = {
+        "data": {
+            "total_users": total_users,
+            "users": [],
+            "next_cursor": None
+        }
+    }
+
+    # Populate the users list
+    for _, row in data_frame.iterrows():
+        # Keys without a group value read back as NaN
+        group = row[repository.TOP_USERS_GROUP_COLUMN]
+        user_info = {
+            "group": None if pd.isna(group) else group,
+            "user_id": int(row['user_id']),
+            "first_name": row['first_name'],
+            "last_name": row['last_name'],
+            "email": row['email'],
+            "usage": int(row['cntr'])
+        }
+        result_dict["data"]["users"].append(user_info)
+
+    # A full page may have a next one, which starts after the last (usage, user_id, group) of this page
+    if len(result_dict["data"]["users"]) == limit:
+        last_user = result_dict["data"]["users"][-1]
+        result_dict["data"]["next_cursor"] = _encode_cursor(last_user["usage"], last_user["user_id"],
+                                                            last_user["group"])
+
+    return result_dict
+
+def _encode_cursor(cntr: int, user_id: int, group) -> str:
+    # numpy scalars of integer group columns as plain ints
+    group = group.item() if hasattr(group, "item") else group
+    return base64.urlsafe_b64encode(json.dumps([cntr, user_id, group]).encode()).decode().rstrip("=")
+
+def _decode_cursor(cursor: str) -> tuple:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        cntr, user_id, group = json.loads(base64.urlsafe_b64decode(padded))
+        if group is not None and not isinstance(group, (str, int)):
+            raise ValueError(f"Invalid cursor group {group}")
+        return int(cntr), int(user_id), group
+    except Exception as e:
+        raise ValueError(f"Invalid cursor {cursor}") from e
+
+def export_analytics(level:str, export_format:str, start_date_str:str, end_date_str:str, user_id: int = None):
+    """
+    Generator of the encoded export, one chunk per batch of rows.
+    The parameters must be validated before the response starts, as an error
+    raised here can only abort the stream.
+    """
+    columns = repository.EXPORT_COLUMNS[level]
+    if export_format == "csv":
+        yield _encode_csv_rows([columns])
+
+    try:
+        for rows in repository.stream_export(level, start_date_str, end_date_str, user_id, EXPORT_BATCH_SIZE):
+            yield _encode_export_rows(export_format, columns, rows)
+    except Exception:
+        logger.exception("Export failed level=%s start_date=%s end_date=%s", level, start_date_str, end_date_str)
+        raise
+
+async def export_analytics_async(level:str, export_format:str, start_date_str:str, end_date_str:str,
+                                 user_id: int = None):
+    columns = repository.EXPORT_COLUMNS[level]
+    if export_format == "csv":
+        yield _encode_csv_rows([columns])
+
+    try:
+        async for rows in repository.stream_export_async(level, start_date_str, end_date_str, user_id,
+                                                         EXPORT_BATCH_SIZE):
+            yield _encode_export_rows(export_format, columns, rows)
+    except Exception:
+        logger.exception("Export failed level=%s start_date=%s end_date=%s", level, start_date_str, end_date_str)
+        raise
+
+def export_filename(level:str, export_format:str, start_date_str:str, end_date_str:str) -> str:
+    return f"analytics_{level}_{start_date_str}_{end_date_str}.{export_format}"
+
+def _encode_export_rows(export_format:str, columns:list[str], rows:list) -> bytes:
+    if export_format == "csv":
+        return _encode_csv_rows(rows)
+    return b"".join(dumps_bytes(dict(zip(columns, row))) + b"\n" for row in rows)
+
+def _encode_csv_rows(rows:list) -> bytes:
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="\n").writerows(rows)
+    return buffer.getvalue().encode("utf-8")
+
+def _get_date_range(start_date_str:str, end_date_str:str,aggregate_month:bool = False) -> list[str] :
+    if aggregate_month:
+        date_range = pd.date_range(start=start_date_str, end=end_date_str).strftime('%Y-%m').unique().tolist()
+    else:
+        date_range = pd.date_range(start=start_date_str, end=end_date_str).strftime('%Y-%m-%d').tolist()
+    return date_range
+
+if __name__ == "__main__":
+
+    group_by_column_name = "tier";
+    #group_by_column_name = "ref_app";
+    start_date_str = "2024-12-01"
+    end_date_str = "2025-01-02"
+
+    result = get_analytics(group_by_column_name, start_date_str,end_date_str)
+    print("analytics_data=\n", json.dumps(result, indent=4))
+
+    filter_by = None  #"chrome_extension"
+    result = get_top_users(group_by_column_name, start_date_str, end_date_str,limit=10,offset=0,group_by_filter=filter_by)
+    print("top users=\n", json.dumps(result, indent=4))
@@ -0,0 +1,196 @@
+"""
+ASGI serving mode.
+
+Same routes and response shapes as controller.py, served by Quart with async
+views. Tyk calls go through httpx and analytics queries through SQLAlchemy's
+async engine, so a worker keeps serving other requests while it waits on
+Tyk or the database.
+
+Install the extra dependencies and run with an ASGI server, for eg.
+$ pip install -r requirements-async.txt
+$ hypercorn asgi:app --bind 0.0.0.0:5002 --workers 4
+"""
+
+import logging
+import sys
+import time
+
+from quart import Quart, request, jsonify, Response, g
+
+import http_caching
+import metrics
+import request_params
+import result_cache
+import service
+import settings
+import tyk_client
+import tyk_redis
+from api_response import ApiResponse
+from json_provider import FastJSONProvider
+
+logging.basicConfig(level=settings.get_settings().log_level,
+                    format="%(asctime)s %(levelname)s %(name)s %(message)s")
+
+app = Quart(__name__)
+app.json = FastJSONProvider(app)
+
+
+@app.before_request
+async def start_request_timer() -> None:
+    g.request_started = time.perf_counter()
+    metrics.start_request()
+
+
+@app.after_request
+async def add_request_timing(response: Response) -> Response:
+    elapsed = time.perf_counter() - g.request_started
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    metrics.REQUEST_DURATION.observe(elapsed, request.method, route, str(response.status_code))
+    response.headers["Server-Timing"] = metrics.server_timing_header(elapsed)
+    return response
+
+
+@app.before_serving
+async def warm_up() -> None:
+    if settings.get_settings().warm_up:
+        service.warm_up()
+
+
+@app.after_serving
+async def close_pools() -> None:
+    await tyk_client.close_async_client()
+    await tyk_redis.close_async_client()
+    # Nothing to dispose of when no analytics route ran, the import of database is skipped
+    database = sys.modules.get("database")
+    if database is not None:
+        await database.dispose_async_engines()
+
+
+@app.route('/create-key', methods=['POST'])
+async def create_key() -> (Response,str):
+    params, error = request_params.parse_create_key(await request.get_json())
+    result = request_params.bad_request(error) if error else await service.create_key_async(**params)
+    return jsonify(result), result['status_code']
+
+@app.route('/list-keys', methods=['GET'])
+async def list_keys() -> (Response,str):
+    if not request_params.is_key_search(request.args):
+        result = await service.list_keys_async()
+        return jsonify(result), result['status_code']
+
+    params, error = request_params.parse_key_search(request.args)
+    # Served from the in-memory key index, no call to Tyk
+    result = request_params.bad_request(error) if error else service.search_keys(**params)
+    return jsonify(result), result['status_code']
+
+@app.route('/get-key/<key>', methods=['GET'])
+async def get_key_details(key:str) -> (Response,str):
+    result = await service.get_key_details_async(key)
+    return jsonify(result), result['status_code']
+
+@app.route('/update-plan', methods=['PUT'])
+async def update_key_plan() -> (Response,str):
+    params, error = request_params.parse_update_key_plan(await request.get_json())
+    result = request_params.bad_request(error) if error else await service.update_key_plan_async(**params)
+    return jsonify(result), result['status_code']
+
+@app.route('/delete-key/<key>', methods=['DELETE'])
+async def delete_key(key: str) -> (Response,str):
+    result = await service.delete_key_async(key)
+    return jsonify(result), result['status_code']
+
+@app.route('/keys/batch-create', methods=['POST'])
+async def batch_create_keys() -> (Response,str):
+    plans, error = request_params.parse_batch(await request.get_json(silent=True), "plans")
+    result = request_params.bad_request(error) if error else await service.batch_create_keys_async(plans)
+    return jsonify(result), result['status_code']
+
+@app.route('/keys/batch-update-plan', methods=['PUT'])
+async def batch_update_key_plan() -> (Response,str):
+    items, error = request_params.parse_batch(await request.get_json(silent=True), "items")
+    result = request_params.bad_request(error) if error else await service.batch_update_key_plan_async(items)
+    return jsonify(result), result['status_code']
+
+@app.route('/keys/batch-delete', methods=['DELETE'])
+async def batch_delete_keys() -> (Response,str):
+    keys, error = request_params.parse_batch(await request.get_json(silent=True), "keys")
+    result = request_params.bad_request(error) if error else await service.batch_delete_keys_async(keys)
+    return jsonify(result), result['status_code']
+
+@app.route('/keys/batch-get', methods=['POST'])
+async def batch_get_keys() -> (Response,str):
+    keys, error = request_params.parse_batch(await request.get_json(silent=True), "keys")
+    result = request_params.bad_request(error) if error else await service.batch_get_keys_async(keys)
+    return jsonify(result), result['status_code']
+
+@app.route('/analytics', methods=['GET'])
+async def get_analytics() -> (Response,str):
+    params, error = request_params.parse_analytics(request.args)
+    if error:
+        result = request_params.bad_request(error)
+    elif params.pop("mode") == "latency":
+        result = await service.get_latency_analytics_async(**params)
+    else:
+        result = await service.get_analytics_async(**params)
+    return await _cacheable_response(result, request_params.analytics_max_age(params))
+
+@app.route('/analytics/multi', methods=['GET'])
+async def get_multi_analytics() -> (Response,str):
+    params, error = request_params.parse_multi_analytics(request.args)
+    result = request_params.bad_request(error) if error else await service.get_multi_analytics_async(**params)
+    return await _cacheable_response(result, request_params.analytics_max_age(params))
+
+@app.route('/top-users', methods=['GET'])
+async def get_top_users() -> (Response,str):
+    params, error = request_params.parse_top_users(request.args)
+    result = request_params.bad_request(error) if error else await service.get_top_users_async(**params)
+    return await _cacheable_response(result, request_params.analytics_max_age(params))
+
+async def _cacheable_response(result: dict, max_age: int) -> Response:
+    # ETag, Cache-Control and compression, a 304 when the client has the same result
+    response = jsonify(result)
+    body, status_code, headers = http_caching.prepare(await response.get_data(), result['status_code'],
+                                                      request.headers, max_age)
+    response.set_data(body)
+    response.status_code = status_code
+    response.headers.update(headers)
+    return response
+
+@app.route('/export', methods=['GET'])
+async def export_analytics() -> (Response,str):
+    # Validate everything up front, once the stream has started the status can not change
+    params, error = request_params.parse_export(request.args)
+    if error:
+        result = request_params.bad_request(error)
+        return jsonify(result), result['status_code']
+
+    filename = service.export_filename(params["level"], params["export_format"],
+                                       params["start_date_str"], params["end_date_str"])
+    return Response(service.export_analytics_async(**params),
+                    mimetype=service.EXPORT_FORMATS[params["export_format"]],
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@app.route('/db-pool-stats', methods=['GET'])
+async def get_db_pool_stats() -> (Response,str):
+    import database
+
+    api_response = ApiResponse(message="Success",
+                               response=database.get_pool_metrics(),
+                               statuscode="200")
+    result = api_response.to_dictionary()
+    return jsonify(result), result['status_code']
+
+@app.route('/cache-stats', methods=['GET'])
+async def get_cache_stats() -> (Response,str):
+    api_response = ApiResponse(message="Success",
+                               response=result_cache.get_all_stats(),
+                               statuscode="200")
+    result = api_response.to_dictionary()
+    return jsonify(result), result['status_code']
+
+@app.route('/metrics', methods=['GET'])
+async def get_metrics() -> Response:
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+if __name__ == "__main__":
+    app.run(debug=True, port=5002)
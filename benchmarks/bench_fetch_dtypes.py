@@ -0,0 +1,87 @@
+"""
+Micro-benchmark for analytics_repository._to_data_frame
+
+Compares building the analytics frame from the fetched rows the previous way
+(pandas inference, then request_date converted with astype(str)) with the
+column by column build with explicit dtypes. Reports build time, the time of
+the service formatting that follows and the memory of the frame, and checks
+that both produce the same /analytics response.
+
+Run from the project folder:
+$ python benchmarks/bench_fetch_dtypes.py
+"""
+
+import os
+import sys
+import timeit
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+from pandas.core.frame import DataFrame
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import analytics_repository as repository
+import analytics_service
+
+COLUMNS = ["request_date", "ref_app", "cntr"]
+
+# (label, days, groups, fraction of (date, group) pairs that have traffic)
+SCENARIOS = [
+    ("tier, 30 days", 30, 5, 1.0),
+    ("ref_app, 30 days", 30, 1000, 0.5),
+    ("user_id, 30 days", 30, 20000, 0.3),
+]
+
+
+def legacy_to_data_frame(rows: list) -> DataFrame:
+    # Implementation before the dtype aware build, kept as the reference
+    data_frame = pd.DataFrame(rows, columns=COLUMNS)
+    data_frame['request_date'] = data_frame['request_date'].astype(str)
+    return data_frame
+
+
+def make_rows(days: int, groups: int, density: float, seed: int = 7) -> (list, list[str]):
+    # Same shape as the rows returned by the database driver for a daily query
+    rng = np.random.default_rng(seed)
+    start = date(2024, 10, 1)
+    rows = []
+    for day in range(days):
+        request_date = start + timedelta(days=day)
+        for group in np.flatnonzero(rng.random(groups) < density):
+            rows.append((request_date, f"app_{group:05d}", int(rng.integers(1, 5000))))
+    unique_dates = [(start + timedelta(days=day)).isoformat() for day in range(days)]
+    return rows, unique_dates
+
+
+def to_response(data_frame: DataFrame, unique_dates: list[str]) -> dict:
+    corrected_df = analytics_service._insert_missing_rows(data_frame, 'ref_app', unique_dates)
+    return analytics_service._get_analytics_data(corrected_df, 'ref_app', len(unique_dates))
+
+
+def main():
+    dtypes = repository._analytics_dtypes('ref_app')
+    print(f"{'scenario':<20}{'rows':>8}{'build ms':>18}{'format ms':>18}{'memory KiB':>20}")
+    print(f"{'':<28}{'legacy':>9}{'typed':>9}{'legacy':>9}{'typed':>9}{'legacy':>10}{'typed':>10}")
+    for label, days, groups, density in SCENARIOS:
+        rows, unique_dates = make_rows(days, groups, density)
+
+        legacy_df = legacy_to_data_frame(rows)
+        typed_df = repository._to_data_frame(COLUMNS, rows, dtypes)
+        assert to_response(legacy_df.copy(), unique_dates) == to_response(typed_df.copy(), unique_dates)
+
+        legacy_build = min(timeit.repeat(lambda: legacy_to_data_frame(rows), number=1, repeat=5))
+        typed_build = min(timeit.repeat(lambda: repository._to_data_frame(COLUMNS, rows, dtypes), number=1, repeat=5))
+        legacy_format = min(timeit.repeat(lambda: to_response(legacy_df.copy(), unique_dates), number=1, repeat=3))
+        typed_format = min(timeit.repeat(lambda: to_response(typed_df.copy(), unique_dates), number=1, repeat=3))
+        legacy_memory = legacy_df.memory_usage(deep=True).sum() / 1024
+        typed_memory = typed_df.memory_usage(deep=True).sum() / 1024
+
+        print(f"{label:<20}{len(rows):>8}{legacy_build * 1000:>9.1f}{typed_build * 1000:>9.1f}"
+              f"{legacy_format * 1000:>9.1f}{typed_format * 1000:>9.1f}"
+              f"{legacy_memory:>10.0f}{typed_memory:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
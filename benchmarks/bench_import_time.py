@@ -0,0 +1,129 @@
+"""
+Import time benchmark of the app.
+
+Imports the app in fresh interpreters and reports the median time of each
+scenario and which heavy modules it loaded:
+
+- controller: what a worker pays at startup, analytics dependencies are lazy
+- controller + warm up: controller followed by service.warm_up(), i.e. the
+  startup cost with WARM_UP=true, and the cost of the eager imports before
+- asgi: the ASGI app
+
+With --baseline REV the same scenarios also run against a git revision of the
+project (for eg. the commit before the lazy imports), extracted to a temporary
+folder, to show the reduction. With --importtime the slowest modules of the
+controller import are listed from python -X importtime.
+
+Run from the project folder, for eg.
+$ python benchmarks/bench_import_time.py
+$ python benchmarks/bench_import_time.py --baseline HEAD~1 --runs 20 --importtime 15
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ("pandas", "numpy", "sqlalchemy", "quart", "httpx")
+
+SCENARIOS = [
+    ("controller", "import controller"),
+    ("controller + warm up",
+     "import controller, service\n"
+     "warm_up = getattr(service, 'warm_up', None)\n"
+     "if warm_up is not None:\n"
+     "    warm_up()"),
+    ("asgi", "import asgi"),
+]
+
+# Runs in the child interpreter, prints the elapsed time and the heavy modules loaded
+MEASURE = """
+import json, sys, time
+started = time.perf_counter()
+{code}
+elapsed = time.perf_counter() - started
+loaded = [name for name in {heavy!r} if name in sys.modules]
+sys.__stdout__.write("\\n" + json.dumps({{"seconds": elapsed, "loaded": loaded}}) + "\\n")
+"""
+
+
+def measure(project_dir: str, code: str, runs: int) -> dict:
+    script = MEASURE.format(code=code, heavy=HEAVY_MODULES)
+    env = dict(os.environ, PYTHONPATH=project_dir)
+    timings, loaded = [], []
+    # The first run compiles the bytecode, it is not measured
+    for run in range(runs + 1):
+        completed = subprocess.run([sys.executable, "-c", script], cwd=project_dir, env=env,
+                                   capture_output=True, text=True)
+        if completed.returncode != 0:
+            raise RuntimeError(f"Import failed in {project_dir}:\n{completed.stderr}")
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        if run:
+            timings.append(result["seconds"])
+        loaded = result["loaded"]
+    return {"median_ms": statistics.median(timings) * 1000, "min_ms": min(timings) * 1000, "loaded": loaded}
+
+
+def slowest_imports(project_dir: str, module: str, limit: int) -> list[tuple]:
+    env = dict(os.environ, PYTHONPATH=project_dir)
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                               cwd=project_dir, env=env, capture_output=True, text=True)
+    rows = []
+    for line in completed.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Nested imports are indented by two spaces per level, keep the imports of module and theirs
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if 1 <= depth <= 2:
+            rows.append((name.strip(), int(cumulative) / 1000))
+    return sorted(rows, key=lambda row: row[1], reverse=True)[:limit]
+
+
+def extract_revision(revision: str) -> str:
+    target = tempfile.mkdtemp(prefix="bench-import-")
+    archive = subprocess.run(["git", "archive", revision], cwd=PROJECT_DIR, capture_output=True, check=True)
+    subprocess.run(["tar", "-x", "-C", target], input=archive.stdout, check=True)
+    return target
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the import time of the app")
+    parser.add_argument("--runs", type=int, default=10, help="measured imports per scenario")
+    parser.add_argument("--baseline", default=None, help="git revision to compare with, for eg. HEAD~1")
+    parser.add_argument("--importtime", type=int, default=0, help="list the N slowest imports of controller")
+    args = parser.parse_args()
+
+    projects = [("current", PROJECT_DIR)]
+    baseline_dir = None
+    if args.baseline:
+        baseline_dir = extract_revision(args.baseline)
+        projects.insert(0, (args.baseline, baseline_dir))
+
+    try:
+        print(f"{'scenario':<24}{'tree':<12}{'median ms':>11}{'min ms':>9}  loaded")
+        for label, code in SCENARIOS:
+            for tree, project_dir in projects:
+                result = measure(project_dir, code, args.runs)
+                print(f"{label:<24}{tree:<12}{result['median_ms']:>11.1f}{result['min_ms']:>9.1f}"
+                      f"  {', '.join(result['loaded']) or '-'}")
+
+        if args.importtime:
+            for tree, project_dir in projects:
+                print(f"\nslowest imports of controller ({tree}), cumulative")
+                for name, milliseconds in slowest_imports(project_dir, "controller", args.importtime):
+                    print(f"{name:<40}{milliseconds:>9.1f} ms")
+    finally:
+        if baseline_dir:
+            shutil.rmtree(baseline_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Micro-benchmark for analytics_service._insert_missing_rows
+
+Compares the previous per (date, group) loop with the vectorized MultiIndex
+reindex and checks that both return identical frames.
+
+Run from the project folder:
+$ python benchmarks/bench_insert_missing_rows.py
+"""
+
+import os
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+from pandas.core.frame import DataFrame
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import analytics_service
+
+# (label, days, groups, fraction of (date, group) pairs that have traffic)
+SCENARIOS = [
+    ("tier, 30 days", 30, 5, 0.8),
+    ("ref_app, 30 days", 30, 100, 0.5),
+    ("ref_app, 60 days", 60, 100, 0.5),
+    ("ref_app, 90 days, sparse", 90, 100, 0.1),
+]
+
+
+def legacy_insert_missing_rows(data_frame:DataFrame, group_by_column:str,unique_dates:list[str]) -> DataFrame:
+    # Implementation before the vectorized rewrite, kept as the reference
+    unique_groups = data_frame[group_by_column].unique()
+    new_rows = []
+    for dt in unique_dates:
+        for grp in unique_groups:
+            if not ((data_frame['request_date'] == dt) & (data_frame[group_by_column] == grp)).any():
+                new_rows.append({'request_date': dt, group_by_column: grp, 'cntr': 0})
+
+    if new_rows:
+        new_df = pd.DataFrame(new_rows)
+        return pd.concat([data_frame, new_df], ignore_index=True).sort_values(by=['request_date', group_by_column]).reset_index(drop=True)
+
+    return data_frame
+
+
+def make_frame(days: int, groups: int, density: float, seed: int = 7) -> (DataFrame, list[str]):
+    # Same shape as repository.get_analytics after request_date is converted to string
+    rng = np.random.default_rng(seed)
+    unique_dates = pd.date_range("2024-10-01", periods=days).strftime('%Y-%m-%d').tolist()
+    group_names = [f"app_{i:04d}" for i in range(groups)]
+
+    grid = pd.MultiIndex.from_product([unique_dates, group_names], names=['request_date', 'ref_app'])
+    data_frame = grid.to_frame(index=False)
+    data_frame = data_frame[rng.random(len(data_frame)) < density].reset_index(drop=True)
+    data_frame['cntr'] = rng.integers(1, 5000, len(data_frame))
+    return data_frame, unique_dates
+
+
+def main():
+    print(f"{'scenario':<28}{'rows':>8}{'legacy ms':>12}{'vectorized ms':>15}{'speedup':>9}")
+    for label, days, groups, density in SCENARIOS:
+        data_frame, unique_dates = make_frame(days, groups, density)
+
+        expected = legacy_insert_missing_rows(data_frame.copy(), 'ref_app', unique_dates)
+        actual = analytics_service._insert_missing_rows(data_frame.copy(), 'ref_app', unique_dates)
+        pd.testing.assert_frame_equal(actual, expected)
+
+        legacy = min(timeit.repeat(lambda: legacy_insert_missing_rows(data_frame, 'ref_app', unique_dates),
+                                   number=1, repeat=1))
+        vectorized = min(timeit.repeat(lambda: analytics_service._insert_missing_rows(data_frame, 'ref_app', unique_dates),
+                                       number=1, repeat=5))
+
+        print(f"{label:<28}{len(data_frame):>8}{legacy * 1000:>12.1f}{vectorized * 1000:>15.2f}{legacy / vectorized:>8.0f}x")
+
+
+if __name__ == "__main__":
+    main()
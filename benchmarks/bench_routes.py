@@ -0,0 +1,330 @@
+"""
+End to end benchmark of the controller routes.
+
+Seeds a SQLite analytics database (see seed_analytics.py), starts the fake
+Tyk admin API (see fake_tyk.py) and the Flask app in their own processes,
+then runs one scenario per route and reports latency percentiles,
+throughput and the peak RSS of the app process. Everything runs locally,
+no network access or real Tyk / MySQL is needed. Peak RSS is read from
+/proc, so it is reported on Linux only.
+
+The result caches are disabled unless --cache is given, so the scenarios
+measure the work behind each route rather than a cache lookup.
+
+Run from the project folder, for eg.
+$ python benchmarks/bench_routes.py
+$ python benchmarks/bench_routes.py --days 180 --requests-per-day 50000 --scenarios analytics_90d_user_id,top_users_30d
+$ python benchmarks/bench_routes.py --requests 200 --concurrency 8 --json results.json
+"""
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+import numpy as np
+import requests
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, PROJECT_DIR)
+
+import seed_analytics  # noqa: E402 (benchmarks folder is on sys.path when run as a script)
+
+TYK_SECRET = "benchmark"
+# Keys created in the fake Tyk before the run, for the get / update / delete scenarios
+EXISTING_KEYS = 200
+BATCH_SIZE = 50
+
+
+class Scenario:
+    def __init__(self, name: str, method: str, build, description: str):
+        self.name = name
+        self.method = method
+        # build(i) returns (path, json body) of the i-th request
+        self.build = build
+        self.description = description
+
+
+def build_scenarios(end_date: date, keys: list[str], deletable_keys: list[str], cursor: str) -> list[Scenario]:
+    def date_range(days: int) -> str:
+        start_date = end_date - timedelta(days=days - 1)
+        return f"start_date={start_date.isoformat()}&end_date={end_date.isoformat()}"
+
+    def key_batch(source: list[str], i: int) -> list[str]:
+        return source[i * BATCH_SIZE:(i + 1) * BATCH_SIZE]
+
+    return [
+        Scenario("create_key", "POST", lambda i: ("/create-key", {"plan": "FreeDesign"}), "POST /create-key"),
+        Scenario("list_keys", "GET", lambda i: ("/list-keys", None), "GET /list-keys"),
+        Scenario("get_key", "GET", lambda i: (f"/get-key/{keys[i % len(keys)]}", None), "GET /get-key/<key>"),
+        Scenario("update_plan", "PUT",
+                 lambda i: ("/update-plan", {"key": keys[i % len(keys)], "plan": "ProDesign"}), "PUT /update-plan"),
+        Scenario("delete_key", "DELETE", lambda i: (f"/delete-key/{deletable_keys[i]}", None),
+                 "DELETE /delete-key/<key>"),
+        Scenario("batch_create", "POST", lambda i: ("/keys/batch-create", {"plans": ["FreeDesign"] * BATCH_SIZE}),
+                 f"POST /keys/batch-create, {BATCH_SIZE} keys"),
+        Scenario("batch_update_plan", "PUT",
+                 lambda i: ("/keys/batch-update-plan",
+                            {"items": [{"key": key, "plan": "ProDeveloper"} for key in key_batch(keys, i % 4)]}),
+                 f"PUT /keys/batch-update-plan, {BATCH_SIZE} keys"),
+        Scenario("batch_delete", "DELETE", lambda i: ("/keys/batch-delete", {"keys": [f"Missing{i}-{n}" for n in range(BATCH_SIZE)]}),
+                 f"DELETE /keys/batch-delete, {BATCH_SIZE} unknown keys"),
+        Scenario("analytics_7d_tier", "GET", lambda i: (f"/analytics?group_by=tier&{date_range(7)}", None),
+                 "GET /analytics, 7 days by tier"),
+        Scenario("analytics_30d_ref_app", "GET", lambda i: (f"/analytics?group_by=ref_app&{date_range(30)}", None),
+                 "GET /analytics, 30 days by ref_app"),
+        Scenario("analytics_90d_user_id", "GET", lambda i: (f"/analytics?group_by=user_id&{date_range(90)}", None),
+                 "GET /analytics, 90 days by user_id (monthly)"),
+        Scenario("analytics_30d_one_user", "GET", lambda i: (f"/analytics?group_by=tier&user_id=1&{date_range(30)}", None),
+                 "GET /analytics, 30 days of one user"),
+        Scenario("top_users_30d", "GET", lambda i: (f"/top-users?group_by=tier&limit=10&{date_range(30)}", None),
+                 "GET /top-users, 30 days, first page"),
+        Scenario("top_users_90d_offset", "GET",
+                 lambda i: (f"/top-users?group_by=ref_app&limit=10&offset=50&{date_range(90)}", None),
+                 "GET /top-users, 90 days, offset 50"),
+        Scenario("top_users_cursor", "GET",
+                 lambda i: (f"/top-users?group_by=tier&limit=10&cursor={cursor}&{date_range(30)}", None),
+                 "GET /top-users, 30 days, second page by cursor"),
+        Scenario("export_30d_day_csv", "GET", lambda i: (f"/export?level=day&format=csv&{date_range(30)}", None),
+                 "GET /export, 30 days per key and day as CSV"),
+        Scenario("export_90d_user_ndjson", "GET", lambda i: (f"/export?level=user&format=ndjson&{date_range(90)}", None),
+                 "GET /export, 90 days per user as NDJSON"),
+        Scenario("db_pool_stats", "GET", lambda i: ("/db-pool-stats", None), "GET /db-pool-stats"),
+        Scenario("cache_stats", "GET", lambda i: ("/cache-stats", None), "GET /cache-stats"),
+    ]
+
+
+def run_scenario(base_url: str, scenario: Scenario, requests_count: int, warmup: int, concurrency: int,
+                 server_pid: int) -> dict:
+    sessions = threading.local()
+    counter = iter(range(warmup + requests_count))
+    counter_lock = threading.Lock()
+
+    def send() -> (float, int):
+        if not hasattr(sessions, "session"):
+            sessions.session = requests.Session()
+        with counter_lock:
+            i = next(counter)
+        path, body = scenario.build(i)
+        started = time.perf_counter()
+        response = sessions.session.request(scenario.method, base_url + path, json=body, timeout=300)
+        response.content  # read streamed bodies to the end
+        return time.perf_counter() - started, response.status_code
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(lambda _: send(), range(warmup)))
+
+        _reset_peak_rss(server_pid)
+        started = time.perf_counter()
+        results = list(executor.map(lambda _: send(), range(requests_count)))
+        elapsed = time.perf_counter() - started
+
+    latencies = np.array([latency for latency, _ in results]) * 1000
+    errors = sum(1 for _, status in results if status >= 400)
+    return {
+        "scenario": scenario.name,
+        "description": scenario.description,
+        "requests": requests_count,
+        "errors": errors,
+        "p50_ms": round(float(np.percentile(latencies, 50)), 2),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 2),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 2),
+        "throughput_rps": round(requests_count / elapsed, 1),
+        "peak_rss_mib": _read_peak_rss_mib(server_pid)
+    }
+
+
+def serve(port: int) -> None:
+    # Runs in the app process, the environment is set by start_app
+    from werkzeug.serving import make_server
+
+    import controller
+
+    make_server("127.0.0.1", port, controller.app, threaded=True).serve_forever()
+
+
+def start_app(port: int, env: dict, log_path: str) -> subprocess.Popen:
+    log_file = open(log_path, "w")
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", str(port)],
+                               cwd=PROJECT_DIR, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+    _wait_until_ready(f"http://127.0.0.1:{port}/cache-stats", process, log_path)
+    return process
+
+
+def start_fake_tyk(port: int, latency_ms: float, log_path: str) -> subprocess.Popen:
+    process = subprocess.Popen([sys.executable, os.path.join(BENCHMARKS_DIR, "fake_tyk.py"), "--port", str(port),
+                                "--secret", TYK_SECRET, "--latency-ms", str(latency_ms)],
+                               stdout=open(log_path, "w"), stderr=subprocess.STDOUT)
+    _wait_until_ready(f"http://127.0.0.1:{port}/tyk/keys", process, log_path)
+    return process
+
+
+def create_tyk_keys(tyk_url: str, count: int, prefix: str) -> list[str]:
+    session = requests.Session()
+    keys = [f"{prefix}{index:06d}" for index in range(count)]
+    for key in keys:
+        session.post(f"{tyk_url}/tyk/keys/{key}", json={"apply_policies": ["FreeDesign"]},
+                     headers={"x-tyk-authorization": TYK_SECRET}).raise_for_status()
+    return keys
+
+
+def first_page_cursor(base_url: str, end_date: date) -> str:
+    start_date = end_date - timedelta(days=29)
+    response = requests.get(f"{base_url}/top-users?group_by=tier&limit=10"
+                            f"&start_date={start_date.isoformat()}&end_date={end_date.isoformat()}", timeout=300)
+    response.raise_for_status()
+    data = response.json().get("response") or {}
+    return (data.get("data") or {}).get("next_cursor") or ""
+
+
+def print_results(results: list[dict]) -> None:
+    print(f"{'scenario':<26}{'requests':>9}{'errors':>7}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          f"{'req/s':>9}{'peak RSS MiB':>14}")
+    for result in results:
+        peak_rss = f"{result['peak_rss_mib']:.1f}" if result["peak_rss_mib"] is not None else "n/a"
+        print(f"{result['scenario']:<26}{result['requests']:>9}{result['errors']:>7}{result['p50_ms']:>9.1f}"
+              f"{result['p95_ms']:>9.1f}{result['p99_ms']:>9.1f}{result['throughput_rps']:>9.1f}{peak_rss:>14}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the controller routes against local stand-ins")
+    parser.add_argument("--database-url", default=None,
+                        help="benchmark database, default a sqlite file in a temporary folder")
+    parser.add_argument("--no-seed", action="store_true", help="use --database-url as it is, do not seed it")
+    parser.add_argument("--keys", type=int, default=200)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--days", type=int, default=90)
+    parser.add_argument("--requests-per-day", type=int, default=10000)
+    parser.add_argument("--end-date", type=date.fromisoformat, default=date(2024, 12, 31),
+                        help="last seeded day, YYYY-MM-DD")
+    parser.add_argument("--requests", type=int, default=50, help="measured requests per scenario")
+    parser.add_argument("--warmup", type=int, default=3, help="unmeasured requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--tyk-latency-ms", type=float, default=2.0, help="delay added by the fake Tyk")
+    parser.add_argument("--scenarios", default=None, help="comma separated scenario names, default all")
+    parser.add_argument("--cache", action="store_true", help="keep the result caches enabled")
+    parser.add_argument("--rollup", action="store_true", help="build and use the daily analytics rollup")
+    parser.add_argument("--json", default=None, help="also write the results to this file")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="flask-gateway-bench-")
+    database_url = args.database_url or f"sqlite:///{os.path.join(work_dir, 'analytics.db')}"
+    processes = []
+    try:
+        if not args.no_seed:
+            print("Seeding", database_url)
+            print(seed_analytics.seed(database_url, keys=args.keys, users=args.users, days=args.days,
+                                      requests_per_day=args.requests_per_day, end_date=args.end_date))
+
+        tyk_port, app_port = _free_port(), _free_port()
+        tyk_url = f"http://127.0.0.1:{tyk_port}"
+        processes.append(start_fake_tyk(tyk_port, args.tyk_latency_ms, os.path.join(work_dir, "fake_tyk.log")))
+
+        env = dict(os.environ,
+                   DATABASE_URL=database_url,
+                   TYK_BASE_URL=tyk_url,
+                   ORG_ID="Benchmark",
+                   LOG_LEVEL="WARNING",
+                   CACHE_BACKEND="memory",
+                   ANALYTICS_ROLLUP_ENABLED="true" if args.rollup else "false")
+        env["X-TYK-AUTHORIZATION"] = TYK_SECRET
+        if not args.cache:
+            env["CACHE_MAX_ENTRIES"] = "0"
+
+        if args.rollup:
+            for command in (["init"], ["refresh", "--until", args.end_date.isoformat()]):
+                subprocess.run([sys.executable, "analytics_rollup.py"] + command, cwd=PROJECT_DIR, env=env, check=True)
+
+        app_log = os.path.join(work_dir, "app.log")
+        app_process = start_app(app_port, env, app_log)
+        processes.append(app_process)
+        base_url = f"http://127.0.0.1:{app_port}"
+
+        scenarios = build_scenarios(args.end_date,
+                                    keys=create_tyk_keys(tyk_url, EXISTING_KEYS, "Existing"),
+                                    deletable_keys=create_tyk_keys(tyk_url, args.warmup + args.requests, "Deletable"),
+                                    cursor=first_page_cursor(base_url, args.end_date))
+        if args.scenarios:
+            selected = args.scenarios.split(",")
+            unknown = set(selected) - {scenario.name for scenario in scenarios}
+            if unknown:
+                parser.error(f"Unknown scenarios {sorted(unknown)}")
+            scenarios = [scenario for scenario in scenarios if scenario.name in selected]
+
+        results = []
+        for scenario in scenarios:
+            result = run_scenario(base_url, scenario, args.requests, args.warmup, args.concurrency, app_process.pid)
+            results.append(result)
+            print(f"{scenario.name}: p50 {result['p50_ms']} ms, {result['throughput_rps']} req/s", flush=True)
+
+        print()
+        print_results(results)
+
+        if args.json:
+            parameters = {name: value for name, value in vars(args).items() if name != "json"}
+            parameters["end_date"] = args.end_date.isoformat()
+            with open(args.json, "w") as json_file:
+                json.dump({"parameters": parameters, "results": results}, json_file, indent=2)
+            print(f"Results written to {args.json}")
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_until_ready(url: str, process: subprocess.Popen, log_path: str, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            break
+        try:
+            requests.get(url, headers={"x-tyk-authorization": TYK_SECRET}, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.1)
+
+    with open(log_path) as log_file:
+        raise RuntimeError(f"{url} did not start, log:\n{log_file.read()}")
+
+
+def _reset_peak_rss(pid: int) -> None:
+    # Writing 5 to clear_refs resets VmHWM, so the peak is measured per scenario
+    try:
+        with open(f"/proc/{pid}/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
+
+
+def _read_peak_rss_mib(pid: int) -> float:
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--serve":
+        serve(int(sys.argv[2]))
+    else:
+        main()
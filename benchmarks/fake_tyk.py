@@ -0,0 +1,136 @@
+"""
+Local stand-in for the Tyk gateway admin API, for benchmarks.
+
+Implements the /tyk/keys endpoints the service calls, keeps keys in memory
+and checks the x-tyk-authorization header. latency adds a fixed delay to
+every call, to mimic the network hop to a real gateway.
+
+Run standalone (Ctrl+C to stop):
+$ python benchmarks/fake_tyk.py --port 8080 --secret foo --latency-ms 5
+"""
+
+import argparse
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+KEYS_PATH = "/tyk/keys"
+
+
+class FakeTykHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out as separate writes, without this keep-alive calls stall on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        if self.path == KEYS_PATH:
+            with self.server.keys_lock:
+                keys = list(self.server.keys)
+            return self._send(200, {"keys": keys})
+
+        key = self._key_from_path()
+        with self.server.keys_lock:
+            session = self.server.keys.get(key)
+        if session is None:
+            return self._send(404, {"status": "error", "message": "Key not found"})
+        self._send(200, session)
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        session = self._read_body()
+        if session is None:
+            return self._send(400, {"status": "error", "message": "Request malformed"})
+
+        # POST /tyk/keys generates a key, POST /tyk/keys/{key} creates or replaces that key
+        key = self._key_from_path() if self.path != KEYS_PATH else f"{self.server.org_id}{uuid.uuid4().hex}"
+        with self.server.keys_lock:
+            self.server.keys[key] = session
+        self._send(200, {"key": key, "status": "ok", "action": "added"})
+
+    def do_DELETE(self):
+        if not self._authorized():
+            return
+        key = self._key_from_path()
+        with self.server.keys_lock:
+            session = self.server.keys.pop(key, None)
+        if session is None:
+            return self._send(404, {"status": "error", "message": "Key not found"})
+        self._send(200, {"key": key, "status": "ok", "action": "deleted"})
+
+    def log_message(self, format, *args):
+        # Keep benchmark output readable
+        pass
+
+    def _authorized(self) -> bool:
+        # Drain the body first, so the keep-alive connection stays usable after an error
+        self._body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.headers.get("x-tyk-authorization") != self.server.secret:
+            self._send(403, {"status": "error", "message": "Attempted administrative access with invalid or missing key!"})
+            return False
+        return True
+
+    def _read_body(self) -> dict:
+        try:
+            return json.loads(self._body or b"{}")
+        except ValueError:
+            return None
+
+    def _key_from_path(self) -> str:
+        return self.path[len(KEYS_PATH) + 1:] if self.path.startswith(KEYS_PATH + "/") else ""
+
+    def _send(self, status: int, body: dict) -> None:
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class FakeTykServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, secret: str = "benchmark",
+                 latency_ms: float = 0.0, org_id: str = "Benchmark"):
+        super().__init__((host, port), FakeTykHandler)
+        self.secret = secret
+        self.latency = latency_ms / 1000
+        self.org_id = org_id
+        self.keys = {}
+        self.keys_lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+def start(secret: str = "benchmark", latency_ms: float = 0.0, port: int = 0) -> FakeTykServer:
+    """
+    Start a fake Tyk server on a background thread and return it.
+    """
+    server = FakeTykServer(port=port, secret=secret, latency_ms=latency_ms)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local fake Tyk admin API")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--secret", default="benchmark", help="expected x-tyk-authorization header")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="delay added to every call")
+    args = parser.parse_args()
+
+    fake_tyk = FakeTykServer(port=args.port, secret=args.secret, latency_ms=args.latency_ms)
+    print(f"Fake Tyk listening on {fake_tyk.base_url}")
+    try:
+        fake_tyk.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,138 @@
+"""
+Seed a benchmark database with key_tbl, user_tbl and tyk_analytics_data.
+
+The data is generated from a fixed random seed, so two runs with the same
+arguments produce the same rows. Traffic per key follows a long tail (a few
+keys make most of the requests), like real api usage. The tables are dropped
+and created again, so only point it at a throwaway database. The SQL is
+plain enough for SQLite and Postgres.
+
+Run from the project folder, for eg.
+$ python benchmarks/seed_analytics.py --database-url sqlite:////tmp/analytics.db --keys 500 --days 90 --requests-per-day 20000
+"""
+
+import argparse
+import time
+from datetime import date, timedelta
+
+import numpy as np
+from sqlalchemy import create_engine, text
+
+TIERS = ["FreeDesign", "FreeDeveloper", "ProDesign", "ProDeveloper", "Enterprise"]
+REF_APPS = ["web", "chrome_extension", "figma_plugin", "vscode_extension", "mobile", "cli"]
+RESPONSE_CODES = [200, 201, 204, 400, 403, 404, 429, 500, 502]
+RESPONSE_CODE_WEIGHTS = [0.80, 0.04, 0.02, 0.03, 0.02, 0.03, 0.03, 0.02, 0.01]
+
+DDL_STATEMENTS = [
+    "DROP TABLE IF EXISTS tyk_analytics_data",
+    "DROP TABLE IF EXISTS key_tbl",
+    "DROP TABLE IF EXISTS user_tbl",
+    """
+    CREATE TABLE user_tbl (
+        user_id BIGINT NOT NULL PRIMARY KEY,
+        first_name VARCHAR(255),
+        last_name VARCHAR(255),
+        email VARCHAR(255)
+    )
+    """,
+    """
+    CREATE TABLE key_tbl (
+        value VARCHAR(255) NOT NULL PRIMARY KEY,
+        user_id BIGINT,
+        tier VARCHAR(255),
+        ref_app VARCHAR(255)
+    )
+    """,
+    """
+    CREATE TABLE tyk_analytics_data (
+        request_date DATE NOT NULL,
+        api_key VARCHAR(255) NOT NULL,
+        response_code INTEGER,
+        request_time INTEGER
+    )
+    """,
+    "CREATE INDEX idx_tyk_analytics_data_date_key ON tyk_analytics_data (request_date, api_key)"
+]
+
+
+def seed(database_url: str, keys: int = 200, users: int = 100, days: int = 90,
+         requests_per_day: int = 10000, end_date: date = date(2024, 12, 31), random_seed: int = 42) -> dict:
+    """
+    Create and fill the tables. Returns what was written.
+    """
+    rng = np.random.default_rng(random_seed)
+    engine = create_engine(database_url)
+    started = time.perf_counter()
+
+    key_values = [f"Benchmark{index:08d}" for index in range(keys)]
+    key_users = rng.integers(1, users + 1, keys)
+    key_tiers = rng.choice(TIERS, keys)
+    key_ref_apps = rng.choice(REF_APPS, keys)
+
+    # Long tail: the key of rank r gets a share proportional to 1 / r
+    weights = 1.0 / np.arange(1, keys + 1)
+    weights /= weights.sum()
+
+    start_date = end_date - timedelta(days=days - 1)
+    rows = 0
+    with engine.begin() as connection:
+        for statement in DDL_STATEMENTS:
+            connection.execute(text(statement))
+
+        connection.execute(text("INSERT INTO user_tbl (user_id, first_name, last_name, email) "
+                                "VALUES (:user_id, :first_name, :last_name, :email)"),
+                           [{"user_id": user_id, "first_name": f"First{user_id}", "last_name": f"Last{user_id}",
+                             "email": f"user{user_id}@example.com"} for user_id in range(1, users + 1)])
+
+        connection.execute(text("INSERT INTO key_tbl (value, user_id, tier, ref_app) "
+                                "VALUES (:value, :user_id, :tier, :ref_app)"),
+                           [{"value": value, "user_id": int(user_id), "tier": str(tier), "ref_app": str(ref_app)}
+                            for value, user_id, tier, ref_app in zip(key_values, key_users, key_tiers, key_ref_apps)])
+
+        insert_request = text("INSERT INTO tyk_analytics_data (request_date, api_key, response_code, request_time) "
+                              "VALUES (:request_date, :api_key, :response_code, :request_time)")
+        for day in range(days):
+            request_date = start_date + timedelta(days=day)
+            # Traffic varies +-20% from day to day
+            count = int(requests_per_day * rng.uniform(0.8, 1.2))
+            key_indexes = rng.choice(keys, count, p=weights)
+            response_codes = rng.choice(RESPONSE_CODES, count, p=RESPONSE_CODE_WEIGHTS)
+            request_times = rng.lognormal(mean=4.0, sigma=0.8, size=count).astype(np.int64) + 1
+
+            connection.execute(insert_request, [
+                {"request_date": request_date, "api_key": key_values[key_index],
+                 "response_code": int(response_code), "request_time": int(request_time)}
+                for key_index, response_code, request_time in zip(key_indexes, response_codes, request_times)
+            ])
+            rows += count
+
+    engine.dispose()
+    return {
+        "keys": keys,
+        "users": users,
+        "days": days,
+        "start_date": start_date.isoformat(),
+        "end_date": end_date.isoformat(),
+        "analytics_rows": rows,
+        "seconds": round(time.perf_counter() - started, 1)
+    }
+
+
+def _parse_date(value: str) -> date:
+    return date.fromisoformat(value)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Seed a benchmark analytics database")
+    parser.add_argument("--database-url", required=True, help="for eg. sqlite:////tmp/analytics.db")
+    parser.add_argument("--keys", type=int, default=200)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--days", type=int, default=90)
+    parser.add_argument("--requests-per-day", type=int, default=10000)
+    parser.add_argument("--end-date", type=_parse_date, default=date(2024, 12, 31), help="last seeded day, YYYY-MM-DD")
+    parser.add_argument("--seed", type=int, default=42, help="random seed")
+    args = parser.parse_args()
+
+    summary = seed(args.database_url, keys=args.keys, users=args.users, days=args.days,
+                   requests_per_day=args.requests_per_day, end_date=args.end_date, random_seed=args.seed)
+    print(summary)
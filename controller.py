@@ -1,29 +1,54 @@
-from flask import Flask,request,jsonify,Response
+import logging
+import time
+
+from flask import Flask,request,jsonify,Response,g
 import service as service
+import http_caching
+import metrics
+import request_params
+import result_cache
+import settings
 
 from api_response import ApiResponse
+from json_provider import FastJSONProvider
+
+logging.basicConfig(level=settings.get_settings().log_level,
+                    format="%(asctime)s %(levelname)s %(name)s %(message)s")
 
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
+
+
+@app.before_request
+def start_request_timer() -> None:
+    g.request_started = time.perf_counter()
+    metrics.start_request()
+
+
+@app.after_request
+def add_request_timing(response: Response) -> Response:
+    elapsed = time.perf_counter() - g.request_started
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    metrics.REQUEST_DURATION.observe(elapsed, request.method, route, str(response.status_code))
+    response.headers["Server-Timing"] = metrics.server_timing_header(elapsed)
+    return response
 
 
 @app.route('/create-key', methods=['POST'])
 def create_key() -> (Response,str):
-    api_response: ApiResponse
-    result : dict
-
-    post_data = request.get_json()
-    if not post_data or "plan" not in post_data:
-        api_response = ApiResponse(error="Missing 'plan' in request body",
-                                   statuscode=400)
-        result = api_response.to_dictionary()
-    else:
-        result = service.create_key(post_data["plan"])
-
+    params, error = request_params.parse_create_key(request.get_json())
+    result = request_params.bad_request(error) if error else service.create_key(**params)
     return jsonify(result), result['status_code']
 
 @app.route('/list-keys', methods=['GET'])
 def list_keys() -> (Response,str):
-    result = service.list_keys()
+    if not request_params.is_key_search(request.args):
+        result = service.list_keys()
+        return jsonify(result), result['status_code']
+
+    params, error = request_params.parse_key_search(request.args)
+    # Served from the in-memory key index, no call to Tyk
+    result = request_params.bad_request(error) if error else service.search_keys(**params)
     return jsonify(result), result['status_code']
 
 @app.route('/get-key/<key>', methods=['GET'])
@@ -33,17 +58,8 @@ def get_key_details(key:str) -> (Response,str):
 
 @app.route('/update-plan', methods=['PUT'])
 def update_key_plan() -> (Response,str):
-    api_response: ApiResponse = None
-    result : dict = None
-
-    post_data = request.get_json()
-    if not post_data or "plan" not in post_data or "key" not in post_data:
-        api_response = ApiResponse(error="Missing 'plan' or 'key' in request body",
-                                   statuscode=400)
-        result = api_response.to_dictionary()
-    else:
-        result = service.update_key_plan(post_data)
-
+    params, error = request_params.parse_update_key_plan(request.get_json())
+    result = request_params.bad_request(error) if error else service.update_key_plan(**params)
     return jsonify(result), result['status_code']
 
 @app.route('/delete-key/<key>', methods=['DELETE'])
@@ -51,52 +67,99 @@ def delete_key(key: str) -> (Response,str):
     result = service.delete_key(key)
     return jsonify(result), result['status_code']
 
-@app.route('/analytics', methods=['GET'])
-def get_analytics() -> (Response,str):
+@app.route('/keys/batch-create', methods=['POST'])
+def batch_create_keys() -> (Response,str):
+    plans, error = request_params.parse_batch(request.get_json(silent=True), "plans")
+    result = request_params.bad_request(error) if error else service.batch_create_keys(plans)
+    return jsonify(result), result['status_code']
 
-    group_by = request.args.get('group_by', default="tier")  # tier if not provided
+@app.route('/keys/batch-update-plan', methods=['PUT'])
+def batch_update_key_plan() -> (Response,str):
+    items, error = request_params.parse_batch(request.get_json(silent=True), "items")
+    result = request_params.bad_request(error) if error else service.batch_update_key_plan(items)
+    return jsonify(result), result['status_code']
+
+@app.route('/keys/batch-delete', methods=['DELETE'])
+def batch_delete_keys() -> (Response,str):
+    keys, error = request_params.parse_batch(request.get_json(silent=True), "keys")
+    result = request_params.bad_request(error) if error else service.batch_delete_keys(keys)
+    return jsonify(result), result['status_code']
 
-    start_date_str = request.args.get('start_date')  # Required parameter
-    end_date_str = request.args.get('end_date')  # Required parameter
-    user_id = request.args.get('user_id', default=None)
+@app.route('/keys/batch-get', methods=['POST'])
+def batch_get_keys() -> (Response,str):
+    keys, error = request_params.parse_batch(request.get_json(silent=True), "keys")
+    result = request_params.bad_request(error) if error else service.batch_get_keys(keys)
+    return jsonify(result), result['status_code']
 
-    if not start_date_str:
-        api_response = ApiResponse(error="Missing 'start_date' in request parameter",
-                                   statuscode=400)
-        result = api_response.to_dictionary()
-    elif not end_date_str:
-        api_response = ApiResponse(error="Missing 'end_date' in request parameter",
-                                   statuscode=400)
-        result = api_response.to_dictionary()
+@app.route('/analytics', methods=['GET'])
+def get_analytics() -> (Response,str):
+    params, error = request_params.parse_analytics(request.args)
+    if error:
+        result = request_params.bad_request(error)
+    elif params.pop("mode") == "latency":
+        result = service.get_latency_analytics(**params)
     else:
-        result = service.get_analytics(group_by,start_date_str,end_date_str,user_id)
+        result = service.get_analytics(**params)
+    return _cacheable_response(result, request_params.analytics_max_age(params))
 
-    return jsonify(result), result['status_code']
+@app.route('/analytics/multi', methods=['GET'])
+def get_multi_analytics() -> (Response,str):
+    params, error = request_params.parse_multi_analytics(request.args)
+    result = request_params.bad_request(error) if error else service.get_multi_analytics(**params)
+    return _cacheable_response(result, request_params.analytics_max_age(params))
 
 @app.route('/top-users', methods=['GET'])
 def get_top_users() -> (Response,str):
+    params, error = request_params.parse_top_users(request.args)
+    result = request_params.bad_request(error) if error else service.get_top_users(**params)
+    return _cacheable_response(result, request_params.analytics_max_age(params))
+
+def _cacheable_response(result: dict, max_age: int) -> Response:
+    # ETag, Cache-Control and compression, a 304 when the client has the same result
+    response = jsonify(result)
+    body, status_code, headers = http_caching.prepare(response.get_data(), result['status_code'],
+                                                      request.headers, max_age)
+    response.set_data(body)
+    response.status_code = status_code
+    response.headers.update(headers)
+    return response
+
+@app.route('/export', methods=['GET'])
+def export_analytics() -> (Response,str):
+    # Validate everything up front, once the stream has started the status can not change
+    params, error = request_params.parse_export(request.args)
+    if error:
+        result = request_params.bad_request(error)
+        return jsonify(result), result['status_code']
+
+    filename = service.export_filename(params["level"], params["export_format"],
+                                       params["start_date_str"], params["end_date_str"])
+    return Response(service.export_analytics(**params),
+                    mimetype=service.EXPORT_FORMATS[params["export_format"]],
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@app.route('/db-pool-stats', methods=['GET'])
+def get_db_pool_stats() -> (Response,str):
+    # Imported here, sqlalchemy is loaded only by the analytics routes
+    import database
+
+    api_response = ApiResponse(message="Success",
+                               response=database.get_pool_metrics(),
+                               statuscode="200")
+    result = api_response.to_dictionary()
+    return jsonify(result), result['status_code']
 
-    group_by = request.args.get('group_by', default="tier")  # tier if not provided
-
-    start_date_str = request.args.get('start_date')  # Required parameter
-    end_date_str = request.args.get('end_date')  # Required parameter
-    limit = int(request.args.get('limit', default=10))
-    offset = int(request.args.get('offset', default=0))
-    filter_by = request.args.get('filter_by', default=None)
-
-
-    if not start_date_str:
-        api_response = ApiResponse(error="Missing 'start_date' in request parameter",
-                                   statuscode=400)
-        result = api_response.to_dictionary()
-    elif not end_date_str:
-        api_response = ApiResponse(error="Missing 'end_date' in request parameter",
-                                   statuscode=400)
-        result = api_response.to_dictionary()
-    else:
-        result = service.get_top_users(group_by,start_date_str,end_date_str,limit,offset,filter_by)
-
+@app.route('/cache-stats', methods=['GET'])
+def get_cache_stats() -> (Response,str):
+    api_response = ApiResponse(message="Success",
+                               response=result_cache.get_all_stats(),
+                               statuscode="200")
+    result = api_response.to_dictionary()
     return jsonify(result), result['status_code']
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics() -> Response:
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 if __name__ == "__main__":
     app.run(debug=True, port=5002)
@@ -0,0 +1,283 @@
+"""
+Process-wide SQLAlchemy engine registry.
+
+Engines are created lazily on first use and cached per database url, so every
+query in a worker shares one connection pool instead of paying for a new
+engine and a fresh TCP/auth handshake per request.
+
+The ASGI app (asgi.py) uses an async engine instead, built the same way on top of
+asyncmy (MySQL) or asyncpg (Postgres), see requirements-async.txt.
+
+Gunicorn forks its workers from the master process. Pooled connections must
+never be shared across processes, so the registry is cleared in the child
+right after the fork and each worker builds its own pool on first use.
+"""
+
+import logging
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+import settings
+
+_settings = settings.get_settings()
+
+# Database connection parameters
+db_config = {
+    'host': _settings.db_host,
+    'port': _settings.db_port,
+    'user': _settings.db_user,
+    'password': _settings.db_password,
+    'database': _settings.db_database
+}
+
+# Connection pool parameters, sized per worker process
+pool_config = {
+    'pool_size': _settings.db_pool_size,
+    'max_overflow': _settings.db_max_overflow,
+    'pool_timeout': _settings.db_pool_timeout,
+    'pool_recycle': _settings.db_pool_recycle,
+    'pool_pre_ping': _settings.db_pool_pre_ping
+}
+
+# 0 disables the per statement timeout
+STATEMENT_TIMEOUT_MS = _settings.db_statement_timeout_ms
+
+# Full SQLAlchemy url, overrides db_config when set. Used by the benchmarks with a sqlite file,
+# for eg. DATABASE_URL=sqlite:////tmp/analytics.db
+DATABASE_URL = _settings.database_url
+
+logger = logging.getLogger(__name__)
+
+_engines: dict[str, Engine] = {}
+_engines_lock = threading.Lock()
+_async_engines: dict = {}
+
+_metrics_lock = threading.Lock()
+_metrics = {
+    "connects": 0,
+    "checkouts": 0,
+    "checkins": 0,
+    "timeouts": 0,
+    "wait_count": 0,
+    "wait_seconds_total": 0.0,
+    "wait_seconds_max": 0.0
+}
+
+
+def get_dialect() -> str:
+    if DATABASE_URL:
+        return DATABASE_URL.split(":", 1)[0].split("+", 1)[0]
+
+    if db_config["port"] == "3306":
+        return "mysql"
+    elif db_config["port"] == "5432":
+        return "postgresql"
+    else:
+        raise ValueError(f"Invalid port: {db_config['port']}. Expected 3306 for MySQL or 5432 for PostgreSQL.")
+
+
+def get_db_url() -> str:
+    if DATABASE_URL:
+        return DATABASE_URL
+
+    suffix = f"{db_config['user']}:{db_config['password']}@{db_config['host']}:{db_config['port']}/{db_config['database']}"
+
+    if get_dialect() == "mysql":
+        return "mysql+pymysql://" + suffix
+    else:
+        return "postgresql://" + suffix
+
+
+def get_async_db_url() -> str:
+    if DATABASE_URL:
+        # Same database through the async driver of its dialect
+        async_drivers = {"mysql": "mysql+asyncmy", "postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+        return async_drivers[get_dialect()] + ":" + DATABASE_URL.split(":", 1)[1]
+
+    suffix = f"{db_config['user']}:{db_config['password']}@{db_config['host']}:{db_config['port']}/{db_config['database']}"
+
+    if get_dialect() == "mysql":
+        return "mysql+asyncmy://" + suffix
+    else:
+        return "postgresql+asyncpg://" + suffix
+
+
+def get_engine() -> Engine:
+    """
+    Return the engine of this process, creating it on first use.
+    """
+    db_url = get_db_url()
+    engine = _engines.get(db_url)
+    if engine is not None:
+        return engine
+
+    with _engines_lock:
+        engine = _engines.get(db_url)
+        if engine is None:
+            logger.info("Creating %s engine with pool config %s", get_dialect(), pool_config)
+            engine = create_engine(db_url, **pool_config)
+            _register_pool_events(engine, get_dialect())
+            _engines[db_url] = engine
+
+    return engine
+
+
+@contextmanager
+def connect() -> Connection:
+    """
+    Check out a pooled connection, recording how long the checkout waited.
+    """
+    engine = get_engine()
+    started = time.perf_counter()
+    try:
+        connection = engine.connect()
+    except PoolTimeoutError:
+        with _metrics_lock:
+            _metrics["timeouts"] += 1
+        raise
+
+    waited = time.perf_counter() - started
+    with _metrics_lock:
+        _metrics["wait_count"] += 1
+        _metrics["wait_seconds_total"] += waited
+        _metrics["wait_seconds_max"] = max(_metrics["wait_seconds_max"], waited)
+
+    with connection:
+        yield connection
+
+
+def get_async_engine():
+    """
+    Return the async engine of this process, creating it on first use.
+    Only called from the event loop, so no lock is needed.
+    """
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+    db_url = get_async_db_url()
+    engine = _async_engines.get(db_url)
+    if engine is None:
+        logger.info("Creating async %s engine with pool config %s", get_dialect(), pool_config)
+        options = dict(pool_config)
+        if get_dialect() == "sqlite":
+            # aiosqlite defaults to NullPool, which takes no pool arguments
+            options["poolclass"] = AsyncAdaptedQueuePool
+        engine = create_async_engine(db_url, **options)
+        # Pool events are emitted by the sync engine the async engine wraps
+        _register_pool_events(engine.sync_engine, get_dialect())
+        _async_engines[db_url] = engine
+    return engine
+
+
+@asynccontextmanager
+async def connect_async():
+    engine = get_async_engine()
+    started = time.perf_counter()
+    try:
+        connection = await engine.connect()
+    except PoolTimeoutError:
+        with _metrics_lock:
+            _metrics["timeouts"] += 1
+        raise
+
+    waited = time.perf_counter() - started
+    with _metrics_lock:
+        _metrics["wait_count"] += 1
+        _metrics["wait_seconds_total"] += waited
+        _metrics["wait_seconds_max"] = max(_metrics["wait_seconds_max"], waited)
+
+    try:
+        yield connection
+    finally:
+        await connection.close()
+
+
+async def dispose_async_engines() -> None:
+    for engine in _async_engines.values():
+        await engine.dispose()
+    _async_engines.clear()
+
+
+def get_pool_metrics() -> dict:
+    """
+    Snapshot of pool occupancy and checkout counters for this process.
+    Use it to size workers * (pool_size + max_overflow) against the
+    connection limit of the database.
+    """
+    with _metrics_lock:
+        metrics = dict(_metrics)
+
+    metrics["pid"] = os.getpid()
+    metrics["pool_size"] = pool_config["pool_size"]
+    metrics["max_overflow"] = pool_config["max_overflow"]
+    metrics["wait_seconds_avg"] = (metrics["wait_seconds_total"] / metrics["wait_count"]
+                                   if metrics["wait_count"] else 0.0)
+
+    engine = next(iter(_engines.values()), None)
+    if engine is None and _async_engines:
+        engine = next(iter(_async_engines.values())).sync_engine
+    if engine is not None:
+        metrics["checked_out"] = engine.pool.checkedout()
+        metrics["checked_in"] = engine.pool.checkedin()
+        metrics["overflow"] = max(engine.pool.overflow(), 0)
+    else:
+        metrics["checked_out"] = metrics["checked_in"] = metrics["overflow"] = 0
+
+    return metrics
+
+
+def dispose_engines() -> None:
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+
+
+def _register_pool_events(engine: Engine, dialect: str) -> None:
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        with _metrics_lock:
+            _metrics["connects"] += 1
+
+        if STATEMENT_TIMEOUT_MS > 0:
+            cursor = dbapi_connection.cursor()
+            if dialect == "mysql":
+                cursor.execute(f"SET SESSION max_execution_time = {STATEMENT_TIMEOUT_MS}")
+            elif dialect == "postgresql":
+                cursor.execute(f"SET statement_timeout = {STATEMENT_TIMEOUT_MS}")
+            cursor.close()
+
+    @event.listens_for(engine, "checkout")
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        with _metrics_lock:
+            _metrics["checkouts"] += 1
+
+    @event.listens_for(engine, "checkin")
+    def on_checkin(dbapi_connection, connection_record):
+        with _metrics_lock:
+            _metrics["checkins"] += 1
+
+
+def _reset_after_fork() -> None:
+    # Leave the parent's sockets alone (close=False) and start with an empty registry
+    for engine in _engines.values():
+        engine.dispose(close=False)
+    _engines.clear()
+    _async_engines.clear()
+
+    global _engines_lock, _metrics_lock
+    _engines_lock = threading.Lock()
+    _metrics_lock = threading.Lock()
+    for name in _metrics:
+        _metrics[name] = 0.0 if isinstance(_metrics[name], float) else 0
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
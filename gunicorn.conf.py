@@ -0,0 +1,33 @@
+"""
+Gunicorn hooks of the Flask app, for eg.
+
+$ gunicorn -c gunicorn.conf.py controller:app
+$ WARM_UP=true gunicorn -c gunicorn.conf.py --preload --workers 4 controller:app
+
+Importing controller loads only what the key management routes need, the
+analytics dependencies (pandas, numpy, sqlalchemy) are imported by the first
+analytics request of each worker. With WARM_UP=true they are imported at
+startup instead: once in the master with --preload, so the forked workers
+share the loaded modules, otherwise in every worker before it accepts requests.
+With --preload the master also loads the key index (see key_index.load), so
+the workers do not each read every key from Tyk and answer 503 meanwhile.
+"""
+
+import settings
+
+
+def when_ready(server) -> None:
+    if server.cfg.preload_app and settings.get_settings().warm_up:
+        import key_index
+        import service
+
+        service.warm_up()
+        key_index.load()
+
+
+def post_worker_init(worker) -> None:
+    # Without --preload every worker imports the app itself
+    if not worker.cfg.preload_app and settings.get_settings().warm_up:
+        import service
+
+        service.warm_up()
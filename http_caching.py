@@ -0,0 +1,134 @@
+"""
+HTTP caching and compression of analytics responses.
+
+A successful /analytics, /analytics/multi or /top-users response gets a weak
+ETag (a hash of its JSON body) and a Cache-Control max-age of
+result_cache.ttl_for_range: a day for ranges that ended before today, a
+minute for ranges that include today. A request whose If-None-Match holds
+the ETag gets a 304 without a body, so a dashboard refreshing every minute
+downloads a result again only when it changed.
+
+Bodies of HTTP_COMPRESSION_MIN_SIZE bytes or more are compressed with the
+encoding the client accepts, brotli (when installed, pip install brotli)
+before gzip. The compressed bodies of the last HTTP_COMPRESSION_CACHE_ENTRIES
+results are kept, the same result is not compressed again for every client.
+"""
+
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+
+import metrics
+import settings
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+_settings = settings.get_settings()
+
+HTTP_COMPRESSION_MIN_SIZE = _settings.http_compression_min_size
+HTTP_GZIP_LEVEL = _settings.http_gzip_level
+HTTP_BROTLI_QUALITY = _settings.http_brotli_quality
+HTTP_COMPRESSION_CACHE_ENTRIES = _settings.http_compression_cache_entries
+
+# Encodings this app can produce, preferred first
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+# (etag, encoding) -> compressed body
+_compressed = OrderedDict()
+_compressed_lock = threading.Lock()
+
+
+def prepare(body: bytes, status_code, request_headers, max_age: int) -> (bytes, int, dict):
+    """
+    Apply conditional GET and compression to an encoded JSON response.
+    Returns the body, status code and headers to send.
+    """
+    status_code = int(status_code)
+    if status_code != 200:
+        # Errors are never cached, a failed query is retried by the next request
+        return body, status_code, {"Cache-Control": "no-store"}
+
+    etag = make_etag(body)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"max-age={max_age}",
+        "Vary": "Accept-Encoding"
+    }
+    if etag_matches(request_headers.get("If-None-Match"), etag):
+        return b"", 304, headers
+
+    encoding = negotiate_encoding(request_headers.get("Accept-Encoding")) \
+        if len(body) >= HTTP_COMPRESSION_MIN_SIZE else None
+    if encoding is not None:
+        body = _compress(body, encoding, etag)
+        headers["Content-Encoding"] = encoding
+    return body, 200, headers
+
+
+def make_etag(body: bytes) -> str:
+    # Weak, the compressed and uncompressed bodies of a result share it
+    return f'W/"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    opaque_tag = etag[2:]
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == opaque_tag:
+            return True
+    return False
+
+
+def negotiate_encoding(accept_encoding: str) -> str:
+    """
+    The encoding of ENCODINGS with the highest q value in Accept-Encoding, None for identity.
+    """
+    if not accept_encoding:
+        return None
+
+    qualities = {}
+    for part in accept_encoding.split(","):
+        coding, _, parameters = part.partition(";")
+        quality = 1.0
+        parameters = parameters.strip()
+        if parameters.startswith("q="):
+            try:
+                quality = float(parameters[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[coding.strip().lower()] = quality
+
+    best, best_quality = None, 0.0
+    for encoding in ENCODINGS:
+        quality = qualities.get(encoding, qualities.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def _compress(body: bytes, encoding: str, etag: str) -> bytes:
+    cache_key = (etag, encoding)
+    with _compressed_lock:
+        compressed = _compressed.get(cache_key)
+        if compressed is not None:
+            _compressed.move_to_end(cache_key)
+            return compressed
+
+    with metrics.stage("response", "compress"):
+        if encoding == "br":
+            compressed = brotli.compress(body, quality=HTTP_BROTLI_QUALITY)
+        else:
+            compressed = gzip.compress(body, compresslevel=HTTP_GZIP_LEVEL, mtime=0)
+
+    if HTTP_COMPRESSION_CACHE_ENTRIES > 0:
+        with _compressed_lock:
+            _compressed[cache_key] = compressed
+            while len(_compressed) > HTTP_COMPRESSION_CACHE_ENTRIES:
+                _compressed.popitem(last=False)
+    return compressed
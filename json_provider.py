@@ -0,0 +1,122 @@
+"""
+Response encoding for the Flask app.
+
+Responses are serialized exactly once, by this provider. orjson is used when
+it is installed, otherwise the standard json module. Both understand NumPy
+and pandas values (numpy scalars and arrays, Series, Index, pd.NA), so the
+service layer can hand over results without converting them first.
+orjson always writes UTF-8, its non-ASCII characters are escaped afterwards
+as json does with ensure_ascii, so the bytes (and ETags) are the same with
+either backend. dumps() passes sort_keys and default on to orjson, a call
+with an argument orjson has no equivalent for is served by json.dumps.
+"""
+
+import json
+import re
+from json.encoder import encode_basestring_ascii
+
+from flask.json.provider import DefaultJSONProvider
+
+import metrics
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+# Runs of non-ASCII characters, they only occur inside strings of the JSON output
+_NON_ASCII = re.compile(r"[^\x00-\x7f]+")
+
+# dumps() arguments orjson can honour, with any other one the call goes to json.dumps
+_ORJSON_DUMPS_ARGUMENTS = {"indent", "sort_keys", "default", "ensure_ascii", "separators"}
+
+
+def _default(o):
+    # numpy scalars/arrays and pandas Series/Index/Categorical all carry a dtype and convert via tolist()
+    if hasattr(o, "dtype") and hasattr(o, "tolist"):
+        return o.tolist()
+    # pd.NA and pd.NaT
+    if type(o).__name__ in ("NAType", "NaTType"):
+        return None
+    # dates, uuids, dataclasses etc. keep Flask's default encoding
+    return DefaultJSONProvider.default(o)
+
+
+def _escape_non_ascii(body: bytes) -> bytes:
+    # Same \uXXXX escapes (and surrogate pairs) as json.dumps with ensure_ascii
+    if body.isascii():
+        return body
+    return _NON_ASCII.sub(lambda match: encode_basestring_ascii(match.group())[1:-1],
+                          body.decode("utf-8")).encode("ascii")
+
+
+def dumps_bytes(obj) -> bytes:
+    """
+    Compact ASCII JSON of obj, for writing records outside a request (for eg. NDJSON lines).
+    """
+    if orjson is None:
+        return json.dumps(obj, default=_default, separators=(",", ":")).encode("utf-8")
+    return _escape_non_ascii(orjson.dumps(obj, default=_default,
+                                          option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS))
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    default = staticmethod(_default)
+
+    def dumps(self, obj, **kwargs) -> str:
+        if orjson is None or not _orjson_can_dump(kwargs):
+            kwargs.setdefault("default", self.default)
+            kwargs.setdefault("ensure_ascii", self.ensure_ascii)
+            kwargs.setdefault("sort_keys", self.sort_keys)
+            return json.dumps(obj, **kwargs)
+
+        return self._orjson_dumps(obj, indent=kwargs.get("indent"),
+                                  sort_keys=kwargs.get("sort_keys", self.sort_keys),
+                                  default=kwargs.get("default", self.default),
+                                  ensure_ascii=kwargs.get("ensure_ascii", self.ensure_ascii)).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return json.loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            with metrics.stage("response", "serialize"):
+                return super().response(*args, **kwargs)
+
+        if args and kwargs:
+            raise TypeError("app.json.response() takes either args or kwargs, not both")
+        if not args and not kwargs:
+            obj = None
+        elif len(args) == 1:
+            obj = args[0]
+        else:
+            obj = args or kwargs
+
+        indent = 2 if (self.compact is None and self._app.debug) or self.compact is False else None
+        with metrics.stage("response", "serialize"):
+            body = self._orjson_dumps(obj, indent=indent) + b"\n"
+        # Hand the encoded bytes straight to the response, no str round trip
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+    def _orjson_dumps(self, obj, indent: int = None, sort_keys: bool = None, default=None,
+                      ensure_ascii: bool = None) -> bytes:
+        option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys if sort_keys is None else sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        body = orjson.dumps(obj, default=default or self.default, option=option)
+        return _escape_non_ascii(body) if (self.ensure_ascii if ensure_ascii is None else ensure_ascii) else body
+
+
+def _orjson_can_dump(kwargs: dict) -> bool:
+    # orjson writes compact JSON or an indent of 2, the separators must be the ones json.dumps uses for that
+    if not set(kwargs) <= _ORJSON_DUMPS_ARGUMENTS:
+        return False
+    indent = kwargs.get("indent")
+    if indent not in (None, 2):
+        return False
+    separators = (",", ": ") if indent else (",", ":")
+    return tuple(kwargs.get("separators", separators)) == separators
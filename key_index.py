@@ -0,0 +1,342 @@
+"""
+In-memory index of Tyk key metadata.
+
+Tyk's /tyk/keys only lists key ids, so finding the keys of a plan, a tag or
+a creation date means reading every key. This module keeps a snapshot of
+the metadata of every key (apply_policies, tags, org_id, date_created) with
+an index per field, and a background thread keeps it current:
+
+- every KEY_INDEX_REFRESH_INTERVAL seconds the key list is read again, keys
+  that disappeared are dropped and new keys are read,
+- KEY_INDEX_RECHECK_KEYS known keys are read again on each refresh, in
+  rotation, so changes made directly in Tyk are picked up eventually,
+- keys created, updated or deleted through this app are applied right away.
+
+With TYK_REDIS_ENABLED the sessions are read from Tyk's Redis in pipelined
+MGETs (see tyk_redis.py), only the keys Redis cannot answer go to the admin
+API one by one.
+
+Each worker process keeps its own index. It is started on first use, the
+first filtered /list-keys calls of a worker answer 503 until it is loaded.
+load() builds it ahead of time, for eg. in the gunicorn master with
+--preload (see gunicorn.conf.py): the forked workers start from that
+snapshot and only refresh it.
+"""
+
+import bisect
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import settings
+import tyk_client
+import tyk_redis
+
+_settings = settings.get_settings()
+
+KEY_INDEX_REFRESH_INTERVAL = _settings.key_index_refresh_interval
+KEY_INDEX_RECHECK_KEYS = _settings.key_index_recheck_keys
+KEY_INDEX_CONCURRENCY = _settings.key_index_concurrency
+
+# Keys without a date_created sort first and never match a date filter
+_NO_DATE = datetime.min.replace(tzinfo=timezone.utc)
+_FIRST_DATE = _NO_DATE + timedelta(microseconds=1)
+
+logger = logging.getLogger(__name__)
+
+
+class KeyIndex:
+    """
+    Thread safe key metadata store with lookups by policy, tag, org and
+    creation date.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._records = {}
+        self._by_policy = defaultdict(set)
+        self._by_tag = defaultdict(set)
+        self._by_org = defaultdict(set)
+        # (date_created, key) in ascending order, for date ranges and a stable page order
+        self._by_date = []
+        # key -> time.monotonic() of its last upsert
+        self._indexed_at = {}
+        self._recheck_position = 0
+        self.refreshed_at = None
+
+    @property
+    def ready(self) -> bool:
+        return self.refreshed_at is not None
+
+    def upsert(self, key: str, session: dict) -> None:
+        """
+        Store the metadata of a key from its Tyk session. Fields missing from
+        session keep their indexed value (an update may only send apply_policies).
+        """
+        with self._lock:
+            previous = self._records.get(key)
+            if previous:
+                self._unindex(previous)
+            self._index(self._store(key, previous, session))
+
+    def upsert_many(self, sessions: dict) -> None:
+        """
+        upsert() of every key -> session of sessions, for eg. the keys read by
+        a refresh. The date order is sorted once, not once per key.
+        """
+        with self._lock:
+            for key, session in sessions.items():
+                previous = self._records.get(key)
+                if previous:
+                    self._unindex(previous, by_date=False)
+                self._index(self._store(key, previous, session), by_date=False)
+            # The kept entries are already in order, the sort merges the new ones in
+            self._by_date = [entry for entry in self._by_date if entry[1] not in sessions]
+            self._by_date.extend((_parse_date(self._records[key]["date_created"]), key) for key in sessions)
+            self._by_date.sort()
+
+    def remove(self, key: str) -> None:
+        with self._lock:
+            record = self._records.pop(key, None)
+            self._indexed_at.pop(key, None)
+            if record:
+                self._unindex(record)
+
+    def remove_missing(self, current_keys: set, listed_at: float) -> None:
+        """
+        Drop the keys that are not in Tyk's key list any more. Keys indexed
+        after the list was read (for eg. just created through this app) are kept.
+        """
+        with self._lock:
+            missing = [key for key in self._records
+                       if key not in current_keys and self._indexed_at.get(key, 0.0) < listed_at]
+            for key in missing:
+                self._unindex(self._records.pop(key))
+                self._indexed_at.pop(key, None)
+
+    def known_keys(self) -> set:
+        with self._lock:
+            return set(self._records)
+
+    def next_recheck(self, count: int) -> list[str]:
+        # The next count keys in date order, wrapping around
+        with self._lock:
+            if not self._by_date:
+                return []
+            keys = [key for _, key in self._by_date]
+            start = self._recheck_position % len(keys)
+            self._recheck_position = start + count
+            return (keys[start:] + keys[:start])[:count]
+
+    def query(self, policy: str = None, tag: str = None, org_id: str = None,
+              created_from: datetime = None, created_to: datetime = None,
+              limit: int = 100, offset: int = 0) -> (int, list[dict]):
+        """
+        Return (total, page) of the keys matching every given filter,
+        ordered by date_created and key. created_to is exclusive.
+        """
+        with self._lock:
+            candidates = None
+            for index, value in ((self._by_policy, policy), (self._by_tag, tag), (self._by_org, org_id)):
+                if value is None:
+                    continue
+                matches = index.get(value, set())
+                candidates = matches if candidates is None else candidates & matches
+
+            # Narrow the date ordered list to the requested range first
+            low, high = 0, len(self._by_date)
+            if created_from is not None or created_to is not None:
+                low = bisect.bisect_left(self._by_date, (max(created_from or _FIRST_DATE, _FIRST_DATE), ""))
+            if created_to is not None:
+                high = bisect.bisect_left(self._by_date, (created_to, ""))
+            entries = self._by_date[low:high]
+
+            if candidates is not None:
+                entries = [entry for entry in entries if entry[1] in candidates]
+
+            page = [dict(self._records[key]) for _, key in entries[offset:offset + limit]]
+            return len(entries), page
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "keys": len(self._records),
+                "policies": len(self._by_policy),
+                "tags": len(self._by_tag),
+                "refreshed_at": self.refreshed_at
+            }
+
+    def _store(self, key: str, previous: dict, session: dict) -> dict:
+        record = dict(previous) if previous else {"key": key, "apply_policies": [], "tags": [],
+                                                   "org_id": None, "date_created": None}
+        for field in ("apply_policies", "tags"):
+            if field in session:
+                record[field] = list(session[field] or [])
+        for field in ("org_id", "date_created"):
+            if field in session:
+                record[field] = session[field] or None
+
+        self._records[key] = record
+        self._indexed_at[key] = time.monotonic()
+        return record
+
+    def _index(self, record: dict, by_date: bool = True) -> None:
+        key = record["key"]
+        for policy in record["apply_policies"]:
+            self._by_policy[policy].add(key)
+        for tag in record["tags"]:
+            self._by_tag[tag].add(key)
+        if record["org_id"] is not None:
+            self._by_org[record["org_id"]].add(key)
+        if by_date:
+            bisect.insort(self._by_date, (_parse_date(record["date_created"]), key))
+
+    def _unindex(self, record: dict, by_date: bool = True) -> None:
+        key = record["key"]
+        for index, values in ((self._by_policy, record["apply_policies"]), (self._by_tag, record["tags"]),
+                              (self._by_org, [record["org_id"]] if record["org_id"] is not None else [])):
+            for value in values:
+                keys = index.get(value)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del index[value]
+        if not by_date:
+            return
+        entry = (_parse_date(record["date_created"]), key)
+        position = bisect.bisect_left(self._by_date, entry)
+        if position < len(self._by_date) and self._by_date[position] == entry:
+            del self._by_date[position]
+
+
+def refresh(index: KeyIndex) -> None:
+    """
+    Bring the index in line with Tyk: drop deleted keys, read new keys and
+    re-read the next KEY_INDEX_RECHECK_KEYS known keys.
+    """
+    client = tyk_client.get_client()
+    listed_at = time.monotonic()
+    response = client.get("/tyk/keys")
+    response.raise_for_status()
+    current_keys = response.json().get("keys") or []
+
+    current = set(current_keys)
+    index.remove_missing(current, listed_at)
+    known_keys = index.known_keys()
+
+    to_read = [key for key in current_keys if key not in known_keys]
+    to_read.extend(key for key in index.next_recheck(KEY_INDEX_RECHECK_KEYS) if key in current)
+
+    # One round trip for the sessions in Tyk's Redis, the admin API for the rest
+    sessions = dict(zip(to_read, tyk_redis.get_sessions(to_read))) if tyk_redis.TYK_REDIS_ENABLED else {}
+    from_api = [key for key in to_read if sessions.get(key) is None]
+
+    def read(key: str) -> dict:
+        key_response = client.get(f"/tyk/keys/{key}")
+        if key_response.status_code == 200:
+            return key_response.json()
+        if key_response.status_code == 404:
+            index.remove(key)
+        else:
+            logger.warning("Key index could not read key=%s status=%s", key, key_response.status_code)
+        return None
+
+    if from_api:
+        with ThreadPoolExecutor(max_workers=KEY_INDEX_CONCURRENCY) as executor:
+            sessions.update(zip(from_api, executor.map(read, from_api)))
+    # All at once, the first load of a large index would otherwise insert into the date order key by key
+    index.upsert_many({key: session for key, session in sessions.items() if session is not None})
+
+    index.refreshed_at = datetime.now(timezone.utc).isoformat()
+    logger.info("Key index refreshed keys=%d read=%d admin_api=%d", len(current), len(to_read), len(from_api))
+
+
+_index: KeyIndex = None
+_refresher: threading.Thread = None
+_index_lock = threading.Lock()
+
+
+def get_index() -> KeyIndex:
+    """
+    Return the index of this process, starting its refresh thread on first use.
+    """
+    global _index, _refresher
+    if _refresher is None:
+        with _index_lock:
+            if _refresher is None:
+                if _index is None:
+                    _index = KeyIndex()
+                refresher = threading.Thread(target=_refresh_forever, args=(_index,), name="key-index-refresh",
+                                             daemon=True)
+                refresher.start()
+                _refresher = refresher
+    return _index
+
+
+def load() -> KeyIndex:
+    """
+    Load the index of this process now, without starting its refresh thread.
+    A failed load is logged, the index then loads on first use as usual.
+    """
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = KeyIndex()
+    try:
+        refresh(_index)
+    except Exception as e:
+        logger.warning("Key index load failed error=%s", e)
+    return _index
+
+
+def get_started_index() -> KeyIndex:
+    """
+    Return the index only if it was started, for updates that must not start it.
+    """
+    return _index
+
+
+def _refresh_forever(index: KeyIndex) -> None:
+    # An index loaded before the fork is current, its first refresh waits the full interval
+    if index.ready:
+        time.sleep(KEY_INDEX_REFRESH_INTERVAL)
+    while True:
+        started = time.monotonic()
+        try:
+            refresh(index)
+        except Exception as e:
+            logger.warning("Key index refresh failed error=%s", e)
+        # Retry a failed first load soon, later refreshes wait the full interval
+        interval = KEY_INDEX_REFRESH_INTERVAL if index.ready else min(KEY_INDEX_REFRESH_INTERVAL, 10)
+        time.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+
+def _parse_date(value) -> datetime:
+    if not value:
+        return _NO_DATE
+    try:
+        parsed = datetime.fromisoformat(str(value))
+    except ValueError:
+        return _NO_DATE
+    # Naive dates are taken as UTC, so every date in the index compares
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def _reset_after_fork() -> None:
+    # The refresh thread does not survive a fork, a worker starts its own on first use.
+    # A loaded index is kept, only a partly loaded one (its refresh thread was running) is dropped
+    global _index, _refresher, _index_lock
+    if _refresher is not None:
+        _index = None
+    elif _index is not None:
+        _index._lock = threading.Lock()
+    _refresher = None
+    _index_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
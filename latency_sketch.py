@@ -0,0 +1,77 @@
+"""
+Mergeable latency sketches, in the style of DDSketch.
+
+A latency of t milliseconds is counted in bucket ceil(log(t) / log(gamma)),
+with gamma = (1 + a) / (1 - a) for a relative accuracy a (default 1%). Any
+quantile read back from the bucket counts is within a of the true latency,
+however many requests were counted.
+
+Sketches merge by adding the counts of equal buckets, so the latency rollup
+keeps one row per (day, key, bucket) and the percentiles of a group over a
+month are read from a SUM per bucket instead of every raw row. Buckets are
+computed by the database (bucket_expression), the percentiles here with
+pandas, for every group at once.
+
+Changing ANALYTICS_LATENCY_ACCURACY changes the buckets, rebuild the latency
+rollup afterwards (analytics_rollup.py refresh --rollup latency --rebuild-from ...).
+"""
+
+import math
+
+import numpy as np
+import pandas as pd
+from pandas.core.frame import DataFrame
+
+import settings
+
+RELATIVE_ACCURACY = settings.get_settings().analytics_latency_accuracy
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+
+PERCENTILES = (50, 95, 99)
+
+
+def bucket_expression(column: str) -> str:
+    """
+    SQL expression of the bucket of a latency column (LN and CEIL exist in
+    MySQL, Postgres and SQLite 3.35+). Latencies under 1 ms share bucket 0.
+    """
+    return f"CASE WHEN {column} < 1 THEN 0 ELSE CEIL(LN({column}) / {LOG_GAMMA!r}) END"
+
+
+def bucket_values(buckets) -> np.ndarray:
+    # The point of a bucket with the same relative error to both of its bounds
+    return 2 * np.power(GAMMA, np.asarray(buckets, dtype=np.float64)) / (GAMMA + 1)
+
+
+def summarize(data_frame: DataFrame, group_columns: list[str], percentiles: tuple = PERCENTILES) -> DataFrame:
+    """
+    Percentiles of the sketch of every group. data_frame has the group
+    columns, bucket and cntr (several rows of one bucket are merged).
+    Returns the group columns, requests and p50, p95... in milliseconds.
+    """
+    group_columns = list(group_columns)
+    if not group_columns:
+        # One group holding every row
+        data_frame = data_frame.assign(_all=0)
+        group_columns = ["_all"]
+
+    merged = (data_frame.groupby(group_columns + ["bucket"], observed=True, sort=True, dropna=False)["cntr"]
+              .sum()
+              .reset_index())
+    merged = merged[merged["cntr"] > 0]
+    groups = merged.groupby(group_columns, observed=True, sort=False, dropna=False)
+    cumulative = groups["cntr"].cumsum()
+    total = groups["cntr"].transform("sum")
+
+    summary = groups["cntr"].sum().rename("requests").reset_index()
+    for percentile in percentiles:
+        # The bucket holding the request of rank q * (n - 1), counting from 0
+        rank = (percentile / 100) * (total - 1)
+        first = merged[cumulative > rank].groupby(group_columns, observed=True, sort=False, dropna=False)["bucket"].first()
+        values = pd.Series(bucket_values(first.to_numpy()), index=first.index, name=f"p{percentile}")
+        summary = summary.merge(values.reset_index(), on=group_columns, how="left")
+
+    if "_all" in summary.columns:
+        summary = summary.drop(columns="_all")
+    return summary
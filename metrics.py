@@ -0,0 +1,162 @@
+"""
+Request timing metrics.
+
+Histograms are kept in process and rendered in the Prometheus text format
+on /metrics. Every gunicorn worker keeps its own histograms, so scrape the
+workers individually or sum the series over the pid label.
+
+The timings of the current request (database, Tyk, service stages) are also
+collected in a context variable and returned in a Server-Timing header, so
+the breakdown of a slow request is visible in the browser dev tools or with
+curl -v.
+"""
+
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds, from 1 ms to 30 s
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_histograms: dict = {}
+_histograms_lock = threading.Lock()
+
+# (name, seconds) of the timings recorded while serving the current request
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+class Histogram:
+    """
+    Thread safe histogram with a fixed set of labels, cumulative buckets as
+    in the Prometheus exposition format.
+    """
+
+    def __init__(self, name: str, documentation: str, label_names: tuple, buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        # label values -> [count per bucket..., count of +Inf], sum
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float, *label_values) -> None:
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts = series[0]
+            for index, upper_bound in enumerate(self.buckets):
+                if seconds <= upper_bound:
+                    counts[index] += 1
+                    break
+            else:
+                counts[-1] += 1
+            series[1] += seconds
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(label_values, list(counts), total) for label_values, (counts, total) in self._series.items()]
+
+        pid = str(os.getpid())
+        for label_values, counts, total in sorted(series):
+            labels = ",".join(f'{name}="{_escape(value)}"'
+                              for name, value in zip(self.label_names + ("pid",), label_values + (pid,)))
+            cumulative = 0
+            for upper_bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if upper_bound == float("inf") else repr(upper_bound)
+                lines.append(f'{self.name}_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{labels}}} {total}")
+            lines.append(f"{self.name}_count{{{labels}}} {cumulative}")
+        return lines
+
+
+def histogram(name: str, documentation: str, label_names: tuple) -> Histogram:
+    """
+    Create (or return the already created) histogram of that name.
+    """
+    with _histograms_lock:
+        if name not in _histograms:
+            _histograms[name] = Histogram(name, documentation, label_names)
+        return _histograms[name]
+
+
+REQUEST_DURATION = histogram("gateway_http_request_duration_seconds",
+                             "Time to serve a request, by route", ("method", "route", "status"))
+STAGE_DURATION = histogram("gateway_stage_duration_seconds",
+                           "Time spent in a stage of a service operation", ("operation", "stage"))
+DB_QUERY_DURATION = histogram("gateway_db_query_duration_seconds",
+                              "Time to run a query and fetch its rows, connection checkout included", ("query",))
+TYK_REQUEST_DURATION = histogram("gateway_tyk_request_duration_seconds",
+                                 "Time of a call to the Tyk admin api, retries included", ("method", "path", "status"))
+
+
+def start_request() -> None:
+    _request_timings.set([])
+
+
+def record(name: str, seconds: float) -> None:
+    # Outside a request (cron scripts, benchmarks) there is nothing to report
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append((name, seconds))
+
+
+@contextmanager
+def stage(operation: str, name: str):
+    """
+    Time a stage of a service operation, for eg.
+    with metrics.stage("analytics", "pivot"): ...
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_DURATION.observe(elapsed, operation, name)
+        record(name, elapsed)
+
+
+def observe_db_query(query: str, seconds: float) -> None:
+    DB_QUERY_DURATION.observe(seconds, query)
+    record("db", seconds)
+
+
+def observe_tyk_request(method: str, path: str, status: str, seconds: float) -> None:
+    # One series per endpoint, not per key
+    if path.startswith("/tyk/keys/"):
+        path = "/tyk/keys/{key}"
+    TYK_REQUEST_DURATION.observe(seconds, method, path, status)
+    record("tyk", seconds)
+
+
+def server_timing_header(total_seconds: float = None) -> str:
+    """
+    Server-Timing value of the current request. Timings recorded more than
+    once (for eg. the Tyk calls of a batch) are summed.
+    """
+    durations = {}
+    for name, seconds in _request_timings.get() or []:
+        durations[name] = durations.get(name, 0.0) + seconds
+    if total_seconds is not None:
+        durations["total"] = total_seconds
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in durations.items())
+
+
+def render() -> str:
+    with _histograms_lock:
+        histograms = list(_histograms.values())
+    lines = []
+    for metric in histograms:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
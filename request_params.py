@@ -0,0 +1,230 @@
+"""
+Request parsing and validation shared by the Flask (controller.py) and ASGI
+(asgi.py) apps.
+
+Each parse_* function takes the query args or the JSON body of a request and
+returns (params, error): the keyword arguments of the service call, or the
+message of the 400 response when the request is invalid. The apps only read
+the request, call the service and write the response.
+"""
+
+from datetime import datetime
+
+import result_cache
+import service
+from api_response import ApiResponse
+
+# Any of these on /list-keys switches it from Tyk's key list to the key index
+KEY_SEARCH_PARAMETERS = ("policy", "tag", "org_id", "created_from", "created_to", "limit", "offset", "details")
+
+# Items of each batch endpoint, with the check of one item and its error
+BATCH_ITEMS = {
+    "plans": (lambda plan: isinstance(plan, str) and plan, "Every item in 'plans' must be a plan name"),
+    "items": (lambda item: isinstance(item, dict) and "plan" in item and "key" in item,
+              "Every item in 'items' must have 'plan' and 'key'"),
+    "keys": (lambda key: isinstance(key, str) and key, "Every item in 'keys' must be a key")
+}
+
+
+def parse_create_key(post_data) -> (dict, str):
+    if not post_data or "plan" not in post_data:
+        return None, "Missing 'plan' in request body"
+    return {"plan": post_data["plan"]}, None
+
+
+def parse_update_key_plan(post_data) -> (dict, str):
+    if not post_data or "plan" not in post_data or "key" not in post_data:
+        return None, "Missing 'plan' or 'key' in request body"
+    return {"request_body": post_data}, None
+
+
+def parse_batch(post_data, name: str) -> (list, str):
+    """
+    The list name of a batch request body, for eg. parse_batch(body, "keys").
+    """
+    items = post_data.get(name) if isinstance(post_data, dict) else None
+    if not isinstance(items, list) or not items:
+        return None, f"Missing '{name}' list in request body"
+    if len(items) > service.TYK_BATCH_MAX_ITEMS:
+        return None, f"At most {service.TYK_BATCH_MAX_ITEMS} '{name}' are allowed per request"
+    is_valid, error = BATCH_ITEMS[name]
+    if not all(is_valid(item) for item in items):
+        return None, error
+    return items, None
+
+
+def is_key_search(args) -> bool:
+    # Without filter or paging parameters /list-keys is Tyk's full key list, as before
+    return any(name in args for name in KEY_SEARCH_PARAMETERS)
+
+
+def parse_key_search(args) -> (dict, str):
+    for name in ("limit", "offset"):
+        if name in args and not args[name].isdigit():
+            return None, f"'{name}' must be a number"
+    if int(args.get("limit", 100)) > service.KEY_SEARCH_MAX_LIMIT:
+        return None, f"'limit' must not exceed {service.KEY_SEARCH_MAX_LIMIT}"
+    for name in ("created_from", "created_to"):
+        if args.get(name):
+            try:
+                datetime.fromisoformat(args[name])
+            except ValueError:
+                return None, f"'{name}' must be a date (YYYY-MM-DD) or an ISO timestamp"
+
+    return {
+        "policy": args.get("policy"),
+        "tag": args.get("tag"),
+        "org_id": args.get("org_id"),
+        "created_from": args.get("created_from"),
+        "created_to": args.get("created_to"),
+        "limit": int(args.get("limit", 100)),
+        "offset": int(args.get("offset", 0)),
+        "details": args.get("details", "false").lower() == "true"
+    }, None
+
+
+def parse_analytics(args) -> (dict, str):
+    group_by = args.get("group_by", "tier")  # tier if not provided
+    start_date_str = args.get("start_date")  # Required parameter
+    end_date_str = args.get("end_date")  # Required parameter
+    user_id = args.get("user_id")
+    # requests (request counts, default) or latency (p50/p95/p99 latency and response codes)
+    mode = args.get("mode", "requests")
+
+    if not start_date_str:
+        return None, "Missing 'start_date' in request parameter"
+    if not end_date_str:
+        return None, "Missing 'end_date' in request parameter"
+    if mode not in service.ANALYTICS_MODES:
+        return None, f"Invalid 'mode', expected one of {', '.join(service.ANALYTICS_MODES)}"
+    if group_by not in service.ANALYTICS_GROUP_COLUMNS:
+        return None, f"Invalid 'group_by', expected one of {', '.join(service.ANALYTICS_GROUP_COLUMNS)}"
+    if user_id is not None and not user_id.isdigit():
+        return None, "'user_id' must be a number"
+
+    return {
+        "mode": mode,
+        "group_by_column": group_by,
+        "start_date_str": start_date_str,
+        "end_date_str": end_date_str,
+        "user_id": user_id
+    }, None
+
+
+def parse_multi_analytics(args) -> (dict, str):
+    # Comma separated groupings, for eg. tier,ref_app,user_id
+    group_by = args.get("group_by", "tier")
+    # Optional comma separated start:end ranges to compare with, for eg. 2024-11-01:2024-11-30
+    compare = args.get("compare", "")
+    user_id = args.get("user_id")
+
+    group_by_columns = list(dict.fromkeys(column.strip().lower() for column in group_by.split(",") if column.strip()))
+    date_ranges = [(args.get("start_date"), args.get("end_date"))]
+    date_ranges += [tuple(date_range.split(":", 1)) for date_range in compare.split(",") if date_range.strip()]
+
+    if not group_by_columns:
+        return None, "Missing 'group_by' in request parameter"
+    for column in group_by_columns:
+        if column not in service.MULTI_ANALYTICS_GROUP_COLUMNS:
+            return None, (f"Invalid 'group_by' {column}, expected one of "
+                          f"{', '.join(service.MULTI_ANALYTICS_GROUP_COLUMNS)}")
+    if not date_ranges[0][0]:
+        return None, "Missing 'start_date' in request parameter"
+    if not date_ranges[0][1]:
+        return None, "Missing 'end_date' in request parameter"
+    if len(date_ranges) > service.MULTI_ANALYTICS_MAX_RANGES:
+        return None, f"At most {service.MULTI_ANALYTICS_MAX_RANGES} date ranges are allowed per request"
+    for date_range in date_ranges:
+        if len(date_range) != 2:
+            return None, "'compare' ranges must be start_date:end_date"
+        try:
+            start_date, end_date = (datetime.strptime(value.strip(), "%Y-%m-%d") for value in date_range)
+        except ValueError:
+            return None, "Dates must be in YYYY-MM-DD format"
+        # Averages are per day between the two dates, a range needs at least two days
+        if start_date >= end_date:
+            return None, "'start_date' must be before 'end_date'"
+    if user_id is not None and not user_id.isdigit():
+        return None, "'user_id' must be a number"
+
+    # Dates as YYYY-MM-DD, so that ranges compare and slice as strings
+    date_ranges = [tuple(datetime.strptime(value.strip(), "%Y-%m-%d").date().isoformat() for value in date_range)
+                   for date_range in date_ranges]
+    return {
+        "group_by_columns": group_by_columns,
+        "date_ranges": date_ranges,
+        "user_id": user_id
+    }, None
+
+
+def parse_top_users(args) -> (dict, str):
+    group_by = args.get("group_by", "tier")  # tier if not provided
+    start_date_str = args.get("start_date")  # Required parameter
+    end_date_str = args.get("end_date")  # Required parameter
+
+    if not start_date_str:
+        return None, "Missing 'start_date' in request parameter"
+    if not end_date_str:
+        return None, "Missing 'end_date' in request parameter"
+    if group_by not in service.ANALYTICS_GROUP_COLUMNS:
+        return None, f"Invalid 'group_by', expected one of {', '.join(service.ANALYTICS_GROUP_COLUMNS)}"
+    for name in ("limit", "offset"):
+        if name in args and not args[name].isdigit():
+            return None, f"'{name}' must be a number"
+
+    return {
+        "group_by_column": group_by,
+        "start_date_str": start_date_str,
+        "end_date_str": end_date_str,
+        "limit": int(args.get("limit", 10)),
+        "offset": int(args.get("offset", 0)),
+        "group_by_filter": args.get("filter_by"),
+        "cursor": args.get("cursor")  # next_cursor of the previous page, replaces offset
+    }, None
+
+
+def parse_export(args) -> (dict, str):
+    level = args.get("level", "day")  # day, key or user
+    export_format = args.get("format", "ndjson")  # ndjson or csv
+    start_date_str = args.get("start_date")  # Required parameter
+    end_date_str = args.get("end_date")  # Required parameter
+    user_id = args.get("user_id")
+
+    if level not in service.EXPORT_LEVELS:
+        return None, f"Invalid 'level', expected one of {', '.join(service.EXPORT_LEVELS)}"
+    if export_format not in service.EXPORT_FORMATS:
+        return None, f"Invalid 'format', expected one of {', '.join(service.EXPORT_FORMATS)}"
+    if not start_date_str:
+        return None, "Missing 'start_date' in request parameter"
+    if not end_date_str:
+        return None, "Missing 'end_date' in request parameter"
+    try:
+        if datetime.strptime(start_date_str, "%Y-%m-%d") > datetime.strptime(end_date_str, "%Y-%m-%d"):
+            return None, "'start_date' must not be after 'end_date'"
+    except ValueError:
+        return None, "Dates must be in YYYY-MM-DD format"
+    if user_id is not None and not user_id.isdigit():
+        return None, "'user_id' must be a number"
+
+    return {
+        "level": level,
+        "export_format": export_format,
+        "start_date_str": start_date_str,
+        "end_date_str": end_date_str,
+        "user_id": user_id
+    }, None
+
+
+def analytics_max_age(params: dict) -> int:
+    """
+    Cache-Control max-age of an analytics response, the range ending last decides.
+    """
+    if params is None:
+        return 0
+    if "date_ranges" in params:
+        return result_cache.ttl_for_range(max(end for _, end in params["date_ranges"]))
+    return result_cache.ttl_for_range(params["end_date_str"])
+
+
+def bad_request(error: str) -> dict:
+    return ApiResponse(error=error, statuscode=400).to_dictionary()
@@ -0,0 +1,209 @@
+"""
+Result caches for the service layer.
+
+Two backends share one small interface (get/set/delete/stats):
+an in-process LRU with per-entry TTL, and an optional Redis backend that is
+shared by all gunicorn workers. The backend is chosen with CACHE_BACKEND
+(memory or redis) in .env.
+
+Analytics for a date range that ended before today never change, so those
+results are kept for ANALYTICS_CACHE_HISTORICAL_TTL seconds. Ranges that
+include today are kept only for ANALYTICS_CACHE_CURRENT_TTL seconds.
+"""
+
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime
+
+import settings
+
+_settings = settings.get_settings()
+
+CACHE_BACKEND = _settings.cache_backend
+CACHE_MAX_ENTRIES = _settings.cache_max_entries
+REDIS_URL = _settings.redis_url
+ANALYTICS_CACHE_HISTORICAL_TTL = _settings.analytics_cache_historical_ttl
+ANALYTICS_CACHE_CURRENT_TTL = _settings.analytics_cache_current_ttl
+
+logger = logging.getLogger(__name__)
+
+_caches: dict = {}
+
+
+class TTLCache:
+    """
+    Thread safe LRU cache with a TTL per entry.
+    """
+
+    def __init__(self, namespace: str, max_entries: int = CACHE_MAX_ENTRIES):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self._stats["expirations"] += 1
+                self._stats["misses"] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return value
+
+    def set(self, key: str, value, ttl: int) -> None:
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        stats["backend"] = "memory"
+        stats["max_entries"] = self.max_entries
+        return stats
+
+
+class RedisCache:
+    """
+    Cache shared by all workers. Values are stored as JSON with a Redis expiry,
+    eviction is left to the Redis maxmemory policy. Redis errors are logged and
+    treated as a miss so the caller falls back to computing the result.
+    """
+
+    def __init__(self, namespace: str, client):
+        self.namespace = namespace
+        self.prefix = f"flask-gateway:{namespace}:"
+        self.client = client
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "errors": 0}
+
+    def get(self, key: str):
+        try:
+            raw = self.client.get(self.prefix + key)
+        except Exception as e:
+            logger.warning("Redis cache read failed namespace=%s error=%s", self.namespace, e)
+            self._count("errors")
+            raw = None
+
+        if raw is None:
+            self._count("misses")
+            return None
+
+        self._count("hits")
+        return json.loads(raw)
+
+    def set(self, key: str, value, ttl: int) -> None:
+        try:
+            self.client.set(self.prefix + key, json.dumps(value, default=str), ex=ttl)
+        except Exception as e:
+            logger.warning("Redis cache write failed namespace=%s error=%s", self.namespace, e)
+            self._count("errors")
+
+    def delete(self, key: str) -> None:
+        try:
+            self.client.delete(self.prefix + key)
+        except Exception as e:
+            logger.warning("Redis cache delete failed namespace=%s error=%s", self.namespace, e)
+            self._count("errors")
+
+    def clear(self) -> None:
+        for key in self.client.scan_iter(match=self.prefix + "*"):
+            self.client.delete(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats["backend"] = "redis"
+        return stats
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._stats[name] += 1
+
+
+def get_redis_client():
+    import redis
+
+    return redis.Redis.from_url(REDIS_URL)
+
+
+def create_cache(namespace: str, backend: str = None):
+    """
+    Create (or return the already created) cache for a namespace.
+    """
+    if namespace not in _caches:
+        if (backend or CACHE_BACKEND) == "redis":
+            _caches[namespace] = RedisCache(namespace, get_redis_client())
+        else:
+            _caches[namespace] = TTLCache(namespace)
+    return _caches[namespace]
+
+
+def get_all_stats() -> dict:
+    return {namespace: cache.stats() for namespace, cache in _caches.items()}
+
+
+def make_key(namespace: str, **params) -> str:
+    """
+    Build a cache key from normalized query parameters, so that for eg.
+    group_by=Tier&start_date=2024-12-1 and group_by=tier&start_date=2024-12-01
+    share one entry.
+    """
+    parts = [namespace]
+    for name in sorted(params):
+        parts.append(f"{name}={_normalize(name, params[name])}")
+    return "|".join(parts)
+
+
+def ttl_for_range(end_date_str: str) -> int:
+    try:
+        end_date = datetime.strptime(end_date_str, "%Y-%m-%d").date()
+    except (TypeError, ValueError):
+        return ANALYTICS_CACHE_CURRENT_TTL
+
+    if end_date < date.today():
+        return ANALYTICS_CACHE_HISTORICAL_TTL
+    return ANALYTICS_CACHE_CURRENT_TTL
+
+
+def _normalize(name: str, value) -> str:
+    if value is None or value == "":
+        return ""
+    if name.endswith("date"):
+        try:
+            return datetime.strptime(str(value).strip(), "%Y-%m-%d").date().isoformat()
+        except ValueError:
+            return str(value)
+    if name == "group_by":
+        return str(value).strip().lower()
+    if name in ("user_id", "limit", "offset"):
+        try:
+            return str(int(value))
+        except ValueError:
+            return str(value)
+    return str(value)
@@ -1,370 +1,391 @@
+"""
+Service layer of the api.
+
+The key management functions are defined here. The analytics functions
+(get_analytics, get_top_users, export_analytics, ...) live in
+analytics_service.py, which pulls in pandas and the database drivers, and are
+imported on first use through the module __getattr__ below. Callers keep
+using service.get_analytics etc. as before.
+"""
+
+import asyncio
+import contextvars
+import importlib
 import json
-import os
-
-import requests
-from dotenv import load_dotenv
+import logging
 
 from api_response import ApiResponse
 from utils import get_current_timestamp
-from datetime import datetime
-import pandas as pd
-from pandas.core.frame import DataFrame
-import analytics_repository as repository
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import key_index
+import metrics
+import result_cache
+import settings
+import tyk_client
+import tyk_redis
+from tyk_client import TYK_BASE_URL
+
+_settings = settings.get_settings()
+
+ORG_ID = _settings.org_id
+INTERNAL_SERVER_ERROR = "500"
+SERVICE_UNAVAILABLE = "503"
+MULTI_STATUS = "207"
 
-load_dotenv()
+# Parallel Tyk calls per batch request, keep it at or below TYK_POOL_SIZE
+TYK_BATCH_CONCURRENCY = _settings.tyk_batch_concurrency
+TYK_BATCH_MAX_ITEMS = _settings.tyk_batch_max_items
 
-TYK_AUTHORIZATION = os.getenv("X-TYK-AUTHORIZATION")
-TYK_BASE_URL = os.getenv("TYK_BASE_URL")
-ORG_ID = os.getenv("ORG_ID")
-INTERNAL_SERVER_ERROR = "500"
+# Keys only change through this app, the TTLs bound staleness for changes made directly in Tyk
+KEY_CACHE_TTL = _settings.key_cache_ttl
+KEY_LIST_CACHE_TTL = _settings.key_list_cache_ttl
+KEY_LIST_CACHE_KEY = "key_list"
+KEY_SEARCH_MAX_LIMIT = _settings.key_search_max_limit
+
+logger = logging.getLogger(__name__)
+
+_key_details_cache = result_cache.create_cache("key_details")
+_key_list_cache = result_cache.create_cache("key_list")
+
+
+def __getattr__(name: str):
+    # Called only for names not defined here, i.e. the analytics functions and constants
+    if name.startswith("__"):
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    analytics_service = importlib.import_module("analytics_service")
+    try:
+        return getattr(analytics_service, name)
+    except AttributeError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
 
-print(f"authorization={TYK_AUTHORIZATION}")
-print(f"baseUrl={TYK_BASE_URL}")
-print(f"OrgId={ORG_ID}")
 
+def warm_up() -> None:
+    """
+    Import the analytics dependencies ahead of the first request, for eg. in
+    the gunicorn master with --preload so the workers share them after the fork.
+    """
+    with metrics.stage("startup", "warm_up"):
+        importlib.import_module("analytics_service")
+    logger.info("Service warmed up base_url=%s org_id=%s", TYK_BASE_URL, ORG_ID)
 
 
 def create_key(plan: str) -> dict:
-    api_response: ApiResponse = None
-    post_data = {
-        "allowance": 0,
-        "apply_policies": [plan],
-        "enable_detailed_recording": True,
-        "date_created": get_current_timestamp(),
-        "org_id": ORG_ID,
-        "tags": [
-            "security",
-            "edge",
-            "edge-eu"
-        ],
-        "throttle_interval": 10,
-        "throttle_retry_limit": 10
-    }
+    post_data = _new_key_data(plan)
+    return _key_created(post_data, _call_tyk("POST", "/tyk/keys", json.dumps(post_data)))
 
-    try:
-        tyk_response = requests.post(
-            f"{TYK_BASE_URL}/tyk/keys",
-            headers={
-                "Content-Type": "application/json",
-                "x-tyk-authorization": TYK_AUTHORIZATION
-            },
-            data=json.dumps(post_data)
-        )
-
-        if tyk_response.status_code == 200 or tyk_response.status_code == 201:
-            api_response = ApiResponse(message="Key creation successful",
-                                       statuscode=tyk_response.status_code,
-                                       response=tyk_response.json())
-        else:
-            api_response = ApiResponse(error="Key creation Failed",
-                                       statuscode=tyk_response.status_code,
-                                       response=tyk_response.text)
+async def create_key_async(plan: str) -> dict:
+    post_data = _new_key_data(plan)
+    return _key_created(post_data, await _call_tyk_async("POST", "/tyk/keys", json.dumps(post_data)))
 
-    except Exception as e:
-        api_response = ApiResponse(error="Request failed",
-                                   statuscode=INTERNAL_SERVER_ERROR,
-                                   response=str(e)
-                                   )
+def _key_created(post_data: dict, outcome) -> dict:
+    api_response = _to_api_response(outcome, "Key creation successful", "Key creation Failed")
+    _after_key_created(api_response, post_data)
     return api_response.to_dictionary()
 
 def list_keys() -> dict:
-    api_response : ApiResponse = None
+    result = _key_list_cache.get(KEY_LIST_CACHE_KEY)
+    if result is None:
+        result = _key_list_fetched(_call_tyk("GET", "/tyk/keys"))
+    return result
+
+async def list_keys_async() -> dict:
+    result = _key_list_cache.get(KEY_LIST_CACHE_KEY)
+    if result is None:
+        result = _key_list_fetched(await _call_tyk_async("GET", "/tyk/keys"))
+    return result
+
+def _key_list_fetched(outcome) -> dict:
+    result = _to_api_response(outcome, "Keys retrieved successfully", "Keys retrieval Failed").to_dictionary()
+    if "message" in result:
+        _key_list_cache.set(KEY_LIST_CACHE_KEY, result, KEY_LIST_CACHE_TTL)
+    return result
+
+def search_keys(policy:str = None, tag:str = None, org_id:str = None,
+                created_from:str = None, created_to:str = None,
+                limit:int = 100, offset:int = 0, details:bool = False) -> dict:
+    """
+    Filter and page the keys through the local key index (see key_index.py)
+    instead of Tyk's full key list. created_from and created_to are dates
+    (YYYY-MM-DD, both inclusive) or ISO timestamps, a created_to timestamp
+    is exclusive.
+    """
+    index = key_index.get_index()
+    if not index.ready:
+        api_response = ApiResponse(error="Key index is loading, retry shortly",
+                                   statuscode=SERVICE_UNAVAILABLE)
+        return api_response.to_dictionary()
 
     try:
-        tyk_response = requests.get(
-            f"{TYK_BASE_URL}/tyk/keys",
-            headers={
-                "Content-Type": "application/json",
-                "x-tyk-authorization": TYK_AUTHORIZATION
-            }
-        )
-
-        if tyk_response.status_code == 200 or tyk_response.status_code == 201:
-            api_response = ApiResponse(message="Keys retrieved successfully",
-                                       statuscode=tyk_response.status_code,
-                                       response=tyk_response.json())
-        else:
-            api_response = ApiResponse(error="Keys retrieval Failed",
-                                       statuscode=tyk_response.status_code,
-                                       response=tyk_response.text)
-
+        total, records = index.query(policy=policy, tag=tag, org_id=org_id,
+                                     created_from=_to_created_bound(created_from),
+                                     created_to=_to_created_bound(created_to, end_of_day=True),
+                                     limit=limit, offset=offset)
+        keys_data = {
+            "keys": [record["key"] for record in records],
+            "total": total,
+            "limit": limit,
+            "offset": offset,
+            "index": index.stats()
+        }
+        if details:
+            keys_data["key_details"] = records
+        api_response = ApiResponse(message="Keys retrieved successfully",
+                                   response=keys_data,
+                                   statuscode="200")
     except Exception as e:
         api_response = ApiResponse(error="Request failed",
                                    statuscode=INTERNAL_SERVER_ERROR,
-                                   response=str(e)
-                                   )
+                                   response=str(e))
 
     return api_response.to_dictionary()
 
-def get_key_details(key: str) -> dict:
-    api_response : ApiResponse = None
-
-    try:
-        tyk_response = requests.get(
-            f"{TYK_BASE_URL}/tyk/keys/{key}",
-            headers={
-                "Content-Type": "application/json",
-                "x-tyk-authorization": TYK_AUTHORIZATION
-            }
-        )
-
-        if tyk_response.status_code == 200 or tyk_response.status_code == 201:
-            api_response = ApiResponse(message=f"Key {key} retrieved successfully",
-                                       statuscode=tyk_response.status_code,
-                                       response=tyk_response.json())
-        else:
-            api_response = ApiResponse(error=f"Key {key} retrieval Failed",
-                                       statuscode=tyk_response.status_code,
-                                       response=tyk_response.text)
-
-    except Exception as e:
-        api_response = ApiResponse(error=f"Request failed for Key {key}",
-                                   statuscode=INTERNAL_SERVER_ERROR,
-                                   response=str(e)
-                                   )
+def _to_created_bound(value:str, end_of_day:bool = False) -> datetime:
+    if not value:
+        return None
+    bound = datetime.fromisoformat(value)
+    if bound.tzinfo is None:
+        bound = bound.replace(tzinfo=timezone.utc)
+    # A plain date as the upper bound includes that whole day
+    if end_of_day and len(value) == 10:
+        bound += timedelta(days=1)
+    return bound
 
-    return api_response.to_dictionary()
+def get_key_details(key: str) -> dict:
+    # Tyk's Redis is always current, its sessions are not cached here
+    if tyk_redis.TYK_REDIS_ENABLED:
+        result = _to_key_details(key, tyk_redis.get_sessions([key])[0])
+        if result is not None:
+            return result
+    return _get_key_details_from_api(key)
+
+async def get_key_details_async(key: str) -> dict:
+    if tyk_redis.TYK_REDIS_ENABLED:
+        result = _to_key_details(key, (await tyk_redis.get_sessions_async([key]))[0])
+        if result is not None:
+            return result
+    return await _get_key_details_from_api_async(key)
+
+def _get_key_details_from_api(key: str) -> dict:
+    result = _key_details_cache.get(_key_details_cache_key(key))
+    if result is None:
+        result = _key_details_fetched(key, _call_tyk("GET", f"/tyk/keys/{key}"))
+    return result
+
+async def _get_key_details_from_api_async(key: str) -> dict:
+    result = _key_details_cache.get(_key_details_cache_key(key))
+    if result is None:
+        result = _key_details_fetched(key, await _call_tyk_async("GET", f"/tyk/keys/{key}"))
+    return result
+
+def _key_details_cache_key(key: str) -> str:
+    return result_cache.make_key("key_details", key=key)
+
+def _key_details_fetched(key: str, outcome) -> dict:
+    result = _to_api_response(outcome, f"Key {key} retrieved successfully", f"Key {key} retrieval Failed",
+                              request_error=f"Request failed for Key {key}").to_dictionary()
+    # Missing keys are not cached, a key created in Tyk directly shows up on the next call
+    if "message" in result:
+        _key_details_cache.set(_key_details_cache_key(key), result, KEY_CACHE_TTL)
+    return result
+
+def _to_key_details(key: str, session: dict) -> dict:
+    # Same response as a successful GET /tyk/keys/{key}, None for a key Redis could not answer
+    if session is None:
+        return None
+    return ApiResponse(message=f"Key {key} retrieved successfully",
+                       statuscode=200,
+                       response=session).to_dictionary()
+
+def batch_get_keys(keys: list[str]) -> dict:
+    # One pipelined MGET for the whole batch, the misses go to the admin API
+    sessions = tyk_redis.get_sessions(keys) if tyk_redis.TYK_REDIS_ENABLED else [None] * len(keys)
+    results = [_to_key_details(key, session) for key, session in zip(keys, sessions)]
+    missing = _missing_keys(keys, results)
+    return _key_details_batch(results, _map_parallel(missing, _get_key_details_from_api))
+
+async def batch_get_keys_async(keys: list[str]) -> dict:
+    sessions = await tyk_redis.get_sessions_async(keys) if tyk_redis.TYK_REDIS_ENABLED else [None] * len(keys)
+    results = [_to_key_details(key, session) for key, session in zip(keys, sessions)]
+    missing = _missing_keys(keys, results)
+    return _key_details_batch(results, await _map_parallel_async(missing, _get_key_details_from_api_async))
+
+def _missing_keys(keys: list[str], results: list[dict]) -> list[str]:
+    return [key for key, result in zip(keys, results) if result is None]
+
+def _key_details_batch(results: list[dict], fetched: list[dict]) -> dict:
+    # The fetched results fill the gaps, in order
+    fetched = iter(fetched)
+    return _to_batch_response("Key retrieval", [next(fetched) if result is None else result for result in results])
 
 def update_key_plan(request_body:dict) -> dict:
-    api_response: ApiResponse = None
+    key, post_data = _plan_update(request_body)
+    return _plan_updated(key, post_data, _call_tyk("POST", f"/tyk/keys/{key}", json.dumps(post_data)))
 
-    plan = request_body["plan"]
-    key = request_body["key"]
+async def update_key_plan_async(request_body:dict) -> dict:
+    key, post_data = _plan_update(request_body)
+    return _plan_updated(key, post_data, await _call_tyk_async("POST", f"/tyk/keys/{key}", json.dumps(post_data)))
+
+def _plan_update(request_body:dict) -> (str, dict):
     post_data = {
-        "apply_policies": [plan]
+        "apply_policies": [request_body["plan"]]
     }
+    return request_body["key"], post_data
 
-    try:
-        tyk_response = requests.post(
-            f"{TYK_BASE_URL}/tyk/keys/{key}",
-            headers={
-                "Content-Type": "application/json",
-                "x-tyk-authorization": TYK_AUTHORIZATION
-            },
-            data=json.dumps(post_data)
-        )
-
-        if tyk_response.status_code == 200 or tyk_response.status_code == 201:
-            api_response = ApiResponse(message=f"Plan updation for key {key} successful",
-                                       statuscode=tyk_response.status_code,
-                                       response=tyk_response.json())
-        else:
-            api_response = ApiResponse(error=f"Plan updation for key {key} Failed",
-                                       statuscode=tyk_response.status_code,
-                                       response=tyk_response.text)
-
-    except Exception as e:
-        api_response = ApiResponse(error="Request failed",
-                                   statuscode=INTERNAL_SERVER_ERROR,
-                                   response=str(e)
-                                   )
+def _plan_updated(key: str, post_data: dict, outcome) -> dict:
+    api_response = _to_api_response(outcome, f"Plan updation for key {key} successful",
+                                    f"Plan updation for key {key} Failed")
+    _after_key_updated(key, api_response, post_data)
     return api_response.to_dictionary()
 
 def delete_key(key:str) -> dict:
-    api_response : ApiResponse = None
+    return _key_deleted(key, _call_tyk("DELETE", f"/tyk/keys/{key}"))
 
-    try:
-        tyk_response = requests.delete(
-            f"{TYK_BASE_URL}/tyk/keys/{key}",
-            headers={
-                "Content-Type": "application/json",
-                "x-tyk-authorization": TYK_AUTHORIZATION
-            }
-        )
-
-        if tyk_response.status_code == 200 or tyk_response.status_code == 201:
-            api_response = ApiResponse(message=f"Key {key} deleted successfully",
-                                       statuscode=tyk_response.status_code,
-                                       response=tyk_response.json())
-        else:
-            api_response = ApiResponse(error=f"Key {key} deletion failed",
-                                       statuscode=tyk_response.status_code,
-                                       response=tyk_response.text)
-
-    except Exception as e:
-        api_response = ApiResponse(error="Request failed",
-                                   statuscode=INTERNAL_SERVER_ERROR,
-                                   response=str(e)
-                                   )
+async def delete_key_async(key:str) -> dict:
+    return _key_deleted(key, await _call_tyk_async("DELETE", f"/tyk/keys/{key}"))
 
+def _key_deleted(key: str, outcome) -> dict:
+    api_response = _to_api_response(outcome, f"Key {key} deleted successfully", f"Key {key} deletion failed")
+    _after_key_deleted(key, api_response)
     return api_response.to_dictionary()
 
-def get_analytics(group_by_column:str, start_date_str:str, end_date_str:str,user_id: int = None) -> dict:
-
+def _call_tyk(method: str, path: str, data: str = None):
+    """
+    One admin API call. Returns the Tyk response, or the exception when the
+    call failed, for the response builders shared with _call_tyk_async.
+    """
     try:
-        analytics_data_frame = repository.get_analytics(group_by_column, start_date_str, end_date_str, user_id)
-
-        if analytics_data_frame.empty:
-            print("No records found")
-            api_response = ApiResponse(message="No Data Found",
-                                       response=None,
-                                       statuscode="200")
-        else:
-            print("df from source=\n", analytics_data_frame)
-
-            days_count = _count_dates_between(start_date_str, end_date_str)
-            if days_count > 30:
-                print("Input range exceeds 30 days. Regrouping by month")
-
-                aggregate_month = True
-
-                # Convert request_date to string in 'YYYY-mm-dd' format and drop the day part from date
-                analytics_data_frame['request_date'] = analytics_data_frame['request_date'].astype(str).str.slice(0, 7)
-
-                # form the group again and calculate fresh sum
-                analytics_data_frame = analytics_data_frame.groupby(["request_date", group_by_column], as_index=False)['cntr'].sum()
-            else:
-
-                aggregate_month = False
-
-                # Convert request_date to string in 'YYYY-mm-dd' format
-                analytics_data_frame['request_date'] = analytics_data_frame['request_date'].astype(str)
-
-            print("df after converting to string=\n", analytics_data_frame)
-
-            unique_dates = _get_date_range(start_date_str, end_date_str, aggregate_month)
-            corrected_df = _insert_missing_rows(analytics_data_frame, group_by_column,unique_dates)
-            print("corrected_df after insert=\n", corrected_df)
-
-            analytics_data = _get_analytics_data(corrected_df, group_by_column, days_count)
-
-            api_response = ApiResponse(message="Success",
-                                       response = json.loads(json.dumps(analytics_data, indent=4)),
-                                       statuscode="200")
+        return _send(tyk_client.get_client(), method, path, data)
     except Exception as e:
-        api_response = ApiResponse(error="Request failed",
-                                   statuscode=INTERNAL_SERVER_ERROR,
-                                   response=str(e))
-    return api_response.to_dictionary()
-
-def get_top_users(group_by_column:str, start_date_str:str, end_date_str:str,
-                  limit:int,offset:int, group_by_filter:str = None) -> dict:
+        return e
 
+async def _call_tyk_async(method: str, path: str, data: str = None):
     try:
-        top_users_data_frame = repository.get_top_users(group_by_column, start_date_str, end_date_str,
-                                             limit,offset,group_by_filter)
-
-        if top_users_data_frame.empty:
-            api_response = ApiResponse(message="No Data Found",
-                                       response=None,
-                                       statuscode="200")
-        else:
-            top_users_data = _get_top_users(top_users_data_frame,group_by_column)
-            api_response = ApiResponse(message="Success",
-                                       response = json.loads(json.dumps(top_users_data, indent=4)),
-                                       statuscode="200")
-
+        return await _send(tyk_client.get_async_client(), method, path, data)
     except Exception as e:
-        api_response = ApiResponse(error="Request failed",
-                                   statuscode=INTERNAL_SERVER_ERROR,
-                                   response=str(e))
-
-    return api_response.to_dictionary()
-
-def _get_analytics_data(data_frame:DataFrame,group_by_column:str,total_days:int ) -> dict:
-
-    # Calculate total_requests and average_daily_requests
-    total_requests = int(data_frame['cntr'].sum())
-    average_daily_requests = int(total_requests // total_days)
-
-    # Create the analytics_data dictionary
-    analytics_data = {
-        "range": data_frame['request_date'].unique().tolist(),
-        "cumulative": data_frame.groupby('request_date')['cntr'].sum().tolist(),
-        "trend": []
-    }
-
-    # Group by given column and create trend data
-    for app in data_frame[group_by_column].unique():
-        trend_data = {
-            "group": app,
-            "data": data_frame[data_frame[group_by_column] == app]['cntr'].tolist()
-        }
-        analytics_data["trend"].append(trend_data)
-
-    # Create the final output structure
-    final_result = {
-        "data": {
-            "summary": {
-                "total_requests": total_requests,
-                "average_daily_requests": average_daily_requests
-            },
-            "analytics_data": analytics_data
-        }
+        return e
+
+def _send(client, method: str, path: str, data: str = None):
+    # TykClient and AsyncTykClient have the same methods, the async ones return awaitables
+    if method == "POST":
+        return client.post(path, data=data)
+    if method == "DELETE":
+        return client.delete(path)
+    return client.get(path)
+
+def _new_key_data(plan: str) -> dict:
+    return {
+        "allowance": 0,
+        "apply_policies": [plan],
+        "enable_detailed_recording": True,
+        "date_created": get_current_timestamp(),
+        "org_id": ORG_ID,
+        "tags": [
+            "security",
+            "edge",
+            "edge-eu"
+        ],
+        "throttle_interval": 10,
+        "throttle_retry_limit": 10
     }
 
-    return final_result
-
-def _insert_missing_rows(data_frame:DataFrame, group_by_column:str,unique_dates:list[str]) -> DataFrame:
-
-    #Get unique values for group_by_column
-    unique_groups = data_frame[group_by_column].unique()
-
-    #create a list to hold new rows
-    new_rows = []
-    # Loop through each unique request date and check for each unique group
-    for dt in unique_dates:
-        for grp in unique_groups:
-            # Check if the combination exists
-            if not ((data_frame['request_date'] == dt) & (data_frame[group_by_column] == grp)).any():
-                # Insert a new row with cntr as 0
-                new_rows.append({'request_date': dt, group_by_column: grp, 'cntr': 0})
-
-    if new_rows:
-        new_df = pd.DataFrame(new_rows)
-        return pd.concat([data_frame, new_df], ignore_index=True).sort_values(by=['request_date', group_by_column]).reset_index(drop=True)
-
-    return data_frame  #return original if no new changes
-
-def _count_dates_between(start_date_str, end_date_str) -> int:
-    # Convert the date strings to datetime objects
-    start_date = datetime.strptime(start_date_str, "%Y-%m-%d")
-    end_date = datetime.strptime(end_date_str, "%Y-%m-%d")
-
-    # Calculate the difference in days
-    delta = (end_date - start_date).days
-
-    return delta
-
-def _get_top_users(data_frame: DataFrame, group_by_column: str) -> dict:
-    result_dict = {
-        "data": {
-            "total_users": int(data_frame['total_records'].iloc[0]),  # Get total_records from the first row
-            "users": []
-        }
+def _to_api_response(outcome, message: str, error: str, request_error: str = "Request failed") -> ApiResponse:
+    # outcome is a requests or httpx response, or the exception of a failed call
+    try:
+        if isinstance(outcome, Exception):
+            raise outcome
+        if outcome.status_code == 200 or outcome.status_code == 201:
+            return ApiResponse(message=message,
+                               statuscode=outcome.status_code,
+                               response=outcome.json())
+        return ApiResponse(error=error,
+                           statuscode=outcome.status_code,
+                           response=outcome.text)
+    except Exception as e:
+        return ApiResponse(error=request_error,
+                           statuscode=INTERNAL_SERVER_ERROR,
+                           response=str(e)
+                           )
+
+def _after_key_created(api_response: ApiResponse, post_data: dict) -> None:
+    if api_response.message is not None:
+        _key_list_cache.delete(KEY_LIST_CACHE_KEY)
+        index = key_index.get_started_index()
+        if index is not None and isinstance(api_response.response, dict) and api_response.response.get("key"):
+            index.upsert(api_response.response["key"], post_data)
+
+def _after_key_updated(key: str, api_response: ApiResponse, post_data: dict) -> None:
+    # Invalidate even on failure, the update may have been applied before the error
+    _key_details_cache.delete(_key_details_cache_key(key))
+    index = key_index.get_started_index()
+    if index is not None and api_response.message is not None:
+        index.upsert(key, post_data)
+
+def _after_key_deleted(key: str, api_response: ApiResponse) -> None:
+    _key_details_cache.delete(_key_details_cache_key(key))
+    _key_list_cache.delete(KEY_LIST_CACHE_KEY)
+    index = key_index.get_started_index()
+    if index is not None and api_response.message is not None:
+        index.remove(key)
+
+def batch_create_keys(plans: list[str]) -> dict:
+    return _run_batch("Key creation", plans, create_key)
+
+def batch_update_key_plan(request_bodies: list[dict]) -> dict:
+    return _run_batch("Plan updation", request_bodies, update_key_plan)
+
+def batch_delete_keys(keys: list[str]) -> dict:
+    return _run_batch("Key deletion", keys, delete_key)
+
+async def batch_create_keys_async(plans: list[str]) -> dict:
+    return await _run_batch_async("Key creation", plans, create_key_async)
+
+async def batch_update_key_plan_async(request_bodies: list[dict]) -> dict:
+    return await _run_batch_async("Plan updation", request_bodies, update_key_plan_async)
+
+async def batch_delete_keys_async(keys: list[str]) -> dict:
+    return await _run_batch_async("Key deletion", keys, delete_key_async)
+
+def _run_batch(operation: str, items: list, key_operation) -> dict:
+    return _to_batch_response(operation, _map_parallel(items, key_operation))
+
+async def _run_batch_async(operation: str, items: list, key_operation) -> dict:
+    return _to_batch_response(operation, await _map_parallel_async(items, key_operation))
+
+def _map_parallel(items: list, key_operation) -> list:
+    # Fan the single key operations out over a bounded pool, results keep the order of the items
+    # Each call runs in a copy of the request context, so its Tyk timings reach the Server-Timing header
+    if not items:
+        return []
+    contexts = [contextvars.copy_context() for _ in items]
+    with ThreadPoolExecutor(max_workers=max(1, min(TYK_BATCH_CONCURRENCY, len(items)))) as executor:
+        return list(executor.map(lambda context, item: context.run(key_operation, item), contexts, items))
+
+async def _map_parallel_async(items: list, key_operation) -> list:
+    # Same fan out on the event loop, bounded by a semaphore instead of a thread pool
+    semaphore = asyncio.Semaphore(TYK_BATCH_CONCURRENCY)
+
+    async def run(item):
+        async with semaphore:
+            return await key_operation(item)
+
+    return list(await asyncio.gather(*(run(item) for item in items)))
+
+def _to_batch_response(operation: str, results: list[dict]) -> dict:
+    failed = sum(1 for result in results if "error" in result)
+    batch_result = {
+        "total": len(results),
+        "succeeded": len(results) - failed,
+        "failed": failed,
+        "results": results
     }
 
-    # Populate the users list
-    for _, row in data_frame.iterrows():
-        user_info = {
-            "group": row[group_by_column],
-            "user_id": int(row['user_id']),
-            "first_name": row['first_name'],
-            "last_name": row['last_name'],
-            "email": row['email'],
-            "usage": int(row['cntr'])
-        }
-        result_dict["data"]["users"].append(user_info)
-
-    return result_dict
-
-def _get_date_range(start_date_str:str, end_date_str:str,aggregate_month:bool = False) -> list[str] :
-    if aggregate_month:
-        date_range = pd.date_range(start=start_date_str, end=end_date_str).strftime('%Y-%m').unique().tolist()
+    if failed:
+        api_response = ApiResponse(error=f"{operation} failed for {failed} of {len(results)} items",
+                                   statuscode=MULTI_STATUS,
+                                   response=batch_result)
     else:
-        date_range = pd.date_range(start=start_date_str, end=end_date_str).strftime('%Y-%m-%d').tolist()
-    return date_range
-
-if __name__ == "__main__":
-
-    group_by_column_name = "tier";
-    #group_by_column_name = "ref_app";
-    start_date_str = "2024-12-01"
-    end_date_str = "2025-01-02"
-
-    result = get_analytics(group_by_column_name, start_date_str,end_date_str)
-    print("analytics_data=\n", json.dumps(result, indent=4))
-
-    filter_by = None  #"chrome_extension"
-    result = get_top_users(group_by_column_name, start_date_str, end_date_str,limit=10,offset=0,group_by_filter=filter_by)
-    print("top users=\n", json.dumps(result, indent=4))
+        api_response = ApiResponse(message=f"{operation} successful for {len(results)} items",
+                                   statuscode="200",
+                                   response=batch_result)
+    return api_response.to_dictionary()
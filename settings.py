@@ -0,0 +1,234 @@
+"""
+Application settings.
+
+Every setting is read from the environment (and .env, loaded once here) into
+one typed, read only Settings object on first use. Modules take their
+constants from get_settings() instead of calling os.getenv themselves, so a
+malformed value fails at startup with the name of the variable.
+"""
+
+import os
+import threading
+from dataclasses import dataclass, field
+
+from dotenv import load_dotenv
+
+
+@dataclass(frozen=True)
+class Settings:
+    log_level: str = "INFO"
+    # Import the analytics dependencies at startup instead of on the first analytics request
+    warm_up: bool = False
+
+    # Tyk gateway admin api
+    tyk_base_url: str = None
+    tyk_authorization: str = field(default=None, repr=False)
+    org_id: str = None
+    tyk_pool_size: int = 20
+    tyk_connect_timeout: float = 3.05
+    tyk_read_timeout: float = 10.0
+    tyk_max_retries: int = 3
+    tyk_backoff_factor: float = 0.3
+    tyk_batch_concurrency: int = 16
+    tyk_batch_max_items: int = 10000
+    # Read only key lookups from Tyk's Redis (tyk_redis.py)
+    tyk_redis_enabled: bool = False
+    tyk_redis_url: str = field(default="redis://localhost:6379/0", repr=False)
+    tyk_redis_key_prefix: str = "apikey-"
+    tyk_redis_timeout: float = 0.5
+    tyk_redis_mget_chunk: int = 1000
+
+    # Keys
+    key_cache_ttl: int = 30
+    key_list_cache_ttl: int = 30
+    key_search_max_limit: int = 1000
+    key_index_refresh_interval: int = 300
+    key_index_recheck_keys: int = 5000
+    key_index_concurrency: int = 8
+
+    # Database
+    database_url: str = field(default=None, repr=False)
+    db_host: str = None
+    db_port: str = None
+    db_user: str = None
+    db_password: str = field(default=None, repr=False)
+    db_database: str = None
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_timeout: int = 30
+    db_pool_recycle: int = 1800
+    db_pool_pre_ping: bool = True
+    db_statement_timeout_ms: int = 0
+
+    # Result caches and request coalescing
+    cache_backend: str = "memory"
+    cache_max_entries: int = 1024
+    redis_url: str = field(default="redis://localhost:6379/1", repr=False)
+    analytics_cache_historical_ttl: int = 86400
+    analytics_cache_current_ttl: int = 60
+    single_flight_backend: str = "memory"
+    single_flight_lock_ttl: float = 30.0
+    single_flight_result_ttl: float = 5.0
+    single_flight_poll_interval: float = 0.05
+    # ETags and compression of analytics responses
+    http_compression_min_size: int = 1024
+    http_gzip_level: int = 6
+    http_brotli_quality: int = 5
+    http_compression_cache_entries: int = 128
+
+    # Analytics
+    analytics_group_columns: tuple = ("tier", "ref_app", "user_id")
+    analytics_rollup_enabled: bool = True
+    analytics_rollup_coverage_ttl: int = 60
+    analytics_rollup_chunk_days: int = 7
+    analytics_latency_column: str = "request_time"
+    analytics_status_column: str = "response_code"
+    analytics_latency_accuracy: float = 0.01
+    analytics_arrow_strings: bool = False
+    multi_analytics_max_ranges: int = 4
+    export_batch_size: int = 5000
+
+    # Ingestion of Tyk's analytics records from Redis (analytics_ingest.py)
+    analytics_ingest_redis_url: str = field(default="redis://localhost:6379/0", repr=False)
+    analytics_ingest_key: str = "analytics-tyk-system-analytics"
+    analytics_ingest_consumer: str = "default"
+    analytics_ingest_batch_size: int = 10000
+    analytics_ingest_flush_interval: float = 5.0
+    analytics_ingest_max_retry_delay: float = 60.0
+
+
+_settings: Settings = None
+_settings_lock = threading.Lock()
+
+
+def get_settings() -> Settings:
+    """
+    Return the settings of this process, read from the environment on first use.
+    """
+    global _settings
+    if _settings is None:
+        with _settings_lock:
+            if _settings is None:
+                _settings = _load()
+    return _settings
+
+
+def _load() -> Settings:
+    # Values already in the environment win over .env
+    load_dotenv()
+    defaults = Settings()
+    return Settings(
+        log_level=_get_str("LOG_LEVEL", defaults.log_level),
+        warm_up=_get_bool("WARM_UP", defaults.warm_up),
+
+        tyk_base_url=_get_str("TYK_BASE_URL"),
+        tyk_authorization=_get_str("X-TYK-AUTHORIZATION"),
+        org_id=_get_str("ORG_ID"),
+        tyk_pool_size=_get_int("TYK_POOL_SIZE", defaults.tyk_pool_size),
+        tyk_connect_timeout=_get_float("TYK_CONNECT_TIMEOUT", defaults.tyk_connect_timeout),
+        tyk_read_timeout=_get_float("TYK_READ_TIMEOUT", defaults.tyk_read_timeout),
+        tyk_max_retries=_get_int("TYK_MAX_RETRIES", defaults.tyk_max_retries),
+        tyk_backoff_factor=_get_float("TYK_BACKOFF_FACTOR", defaults.tyk_backoff_factor),
+        tyk_batch_concurrency=_get_int("TYK_BATCH_CONCURRENCY", defaults.tyk_batch_concurrency),
+        tyk_batch_max_items=_get_int("TYK_BATCH_MAX_ITEMS", defaults.tyk_batch_max_items),
+        tyk_redis_enabled=_get_bool("TYK_REDIS_ENABLED", defaults.tyk_redis_enabled),
+        tyk_redis_url=_get_str("TYK_REDIS_URL", defaults.tyk_redis_url),
+        tyk_redis_key_prefix=_get_str("TYK_REDIS_KEY_PREFIX", defaults.tyk_redis_key_prefix),
+        tyk_redis_timeout=_get_float("TYK_REDIS_TIMEOUT", defaults.tyk_redis_timeout),
+        tyk_redis_mget_chunk=_get_int("TYK_REDIS_MGET_CHUNK", defaults.tyk_redis_mget_chunk),
+
+        key_cache_ttl=_get_int("KEY_CACHE_TTL", defaults.key_cache_ttl),
+        key_list_cache_ttl=_get_int("KEY_LIST_CACHE_TTL", defaults.key_list_cache_ttl),
+        key_search_max_limit=_get_int("KEY_SEARCH_MAX_LIMIT", defaults.key_search_max_limit),
+        key_index_refresh_interval=_get_int("KEY_INDEX_REFRESH_INTERVAL", defaults.key_index_refresh_interval),
+        key_index_recheck_keys=_get_int("KEY_INDEX_RECHECK_KEYS", defaults.key_index_recheck_keys),
+        key_index_concurrency=_get_int("KEY_INDEX_CONCURRENCY", defaults.key_index_concurrency),
+
+        database_url=_get_str("DATABASE_URL"),
+        db_host=_get_str("DB_HOST"),
+        db_port=_get_str("DB_PORT"),
+        db_user=_get_str("DB_USER"),
+        db_password=_get_str("DB_PASSWORD"),
+        db_database=_get_str("DB_DATABASE"),
+        db_pool_size=_get_int("DB_POOL_SIZE", defaults.db_pool_size),
+        db_max_overflow=_get_int("DB_MAX_OVERFLOW", defaults.db_max_overflow),
+        db_pool_timeout=_get_int("DB_POOL_TIMEOUT", defaults.db_pool_timeout),
+        db_pool_recycle=_get_int("DB_POOL_RECYCLE", defaults.db_pool_recycle),
+        db_pool_pre_ping=_get_bool("DB_POOL_PRE_PING", defaults.db_pool_pre_ping),
+        db_statement_timeout_ms=_get_int("DB_STATEMENT_TIMEOUT_MS", defaults.db_statement_timeout_ms),
+
+        cache_backend=_get_str("CACHE_BACKEND", defaults.cache_backend),
+        cache_max_entries=_get_int("CACHE_MAX_ENTRIES", defaults.cache_max_entries),
+        redis_url=_get_str("REDIS_URL", defaults.redis_url),
+        analytics_cache_historical_ttl=_get_int("ANALYTICS_CACHE_HISTORICAL_TTL",
+                                                defaults.analytics_cache_historical_ttl),
+        analytics_cache_current_ttl=_get_int("ANALYTICS_CACHE_CURRENT_TTL", defaults.analytics_cache_current_ttl),
+        single_flight_backend=_get_str("SINGLE_FLIGHT_BACKEND", defaults.single_flight_backend),
+        single_flight_lock_ttl=_get_float("SINGLE_FLIGHT_LOCK_TTL", defaults.single_flight_lock_ttl),
+        single_flight_result_ttl=_get_float("SINGLE_FLIGHT_RESULT_TTL", defaults.single_flight_result_ttl),
+        single_flight_poll_interval=_get_float("SINGLE_FLIGHT_POLL_INTERVAL", defaults.single_flight_poll_interval),
+        http_compression_min_size=_get_int("HTTP_COMPRESSION_MIN_SIZE", defaults.http_compression_min_size),
+        http_gzip_level=_get_int("HTTP_GZIP_LEVEL", defaults.http_gzip_level),
+        http_brotli_quality=_get_int("HTTP_BROTLI_QUALITY", defaults.http_brotli_quality),
+        http_compression_cache_entries=_get_int("HTTP_COMPRESSION_CACHE_ENTRIES",
+                                                defaults.http_compression_cache_entries),
+
+        analytics_group_columns=_get_list("ANALYTICS_GROUP_COLUMNS", defaults.analytics_group_columns),
+        analytics_rollup_enabled=_get_bool("ANALYTICS_ROLLUP_ENABLED", defaults.analytics_rollup_enabled),
+        analytics_rollup_coverage_ttl=_get_int("ANALYTICS_ROLLUP_COVERAGE_TTL", defaults.analytics_rollup_coverage_ttl),
+        analytics_rollup_chunk_days=_get_int("ANALYTICS_ROLLUP_CHUNK_DAYS", defaults.analytics_rollup_chunk_days),
+        analytics_latency_column=_get_str("ANALYTICS_LATENCY_COLUMN", defaults.analytics_latency_column),
+        analytics_status_column=_get_str("ANALYTICS_STATUS_COLUMN", defaults.analytics_status_column),
+        analytics_latency_accuracy=_get_float("ANALYTICS_LATENCY_ACCURACY", defaults.analytics_latency_accuracy),
+        analytics_arrow_strings=_get_bool("ANALYTICS_ARROW_STRINGS", defaults.analytics_arrow_strings),
+        multi_analytics_max_ranges=_get_int("MULTI_ANALYTICS_MAX_RANGES", defaults.multi_analytics_max_ranges),
+        export_batch_size=_get_int("EXPORT_BATCH_SIZE", defaults.export_batch_size),
+
+        analytics_ingest_redis_url=_get_str("ANALYTICS_INGEST_REDIS_URL", defaults.analytics_ingest_redis_url),
+        analytics_ingest_key=_get_str("ANALYTICS_INGEST_KEY", defaults.analytics_ingest_key),
+        analytics_ingest_consumer=_get_str("ANALYTICS_INGEST_CONSUMER", defaults.analytics_ingest_consumer),
+        analytics_ingest_batch_size=_get_int("ANALYTICS_INGEST_BATCH_SIZE", defaults.analytics_ingest_batch_size),
+        analytics_ingest_flush_interval=_get_float("ANALYTICS_INGEST_FLUSH_INTERVAL",
+                                                   defaults.analytics_ingest_flush_interval),
+        analytics_ingest_max_retry_delay=_get_float("ANALYTICS_INGEST_MAX_RETRY_DELAY",
+                                                    defaults.analytics_ingest_max_retry_delay)
+    )
+
+
+def _get_str(name: str, default: str = None) -> str:
+    return os.getenv(name, default)
+
+
+def _get_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer, got {value!r}") from None
+
+
+def _get_float(name: str, default: float) -> float:
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(f"{name} must be a number, got {value!r}") from None
+
+
+def _get_list(name: str, default: tuple) -> tuple:
+    # Comma separated values
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return default
+    return tuple(item.strip() for item in value.split(",") if item.strip())
+
+
+def _get_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    return value.lower() == "true"
@@ -0,0 +1,238 @@
+"""
+Coalescing of concurrent identical computations (single-flight).
+
+When many requests for the same result arrive together (for eg. every tab of
+a dashboard refreshing at the top of the hour) and the result is not cached,
+only the first one runs the computation, the others wait for it and get the
+same result.
+
+Within a worker this is done with an in-flight table per group. With
+SINGLE_FLIGHT_BACKEND=redis the workers also coordinate through Redis: the
+worker that takes the lock computes the result and stores it under a short
+lived result key (SINGLE_FLIGHT_RESULT_TTL seconds), the other workers poll
+that key. Failed results are shared as well, so a failing query is not
+retried by every waiting request at once. Redis errors are logged and the
+computation runs locally, as without Redis.
+"""
+
+import asyncio
+import json
+import logging
+import threading
+import time
+import uuid
+
+import metrics
+import result_cache
+import settings
+
+_settings = settings.get_settings()
+
+SINGLE_FLIGHT_BACKEND = _settings.single_flight_backend
+# Longest computation a lock is held for, a worker that dies while holding it blocks others at most this long
+SINGLE_FLIGHT_LOCK_TTL = _settings.single_flight_lock_ttl
+SINGLE_FLIGHT_RESULT_TTL = _settings.single_flight_result_ttl
+SINGLE_FLIGHT_POLL_INTERVAL = _settings.single_flight_poll_interval
+
+logger = logging.getLogger(__name__)
+
+_groups: dict = {}
+
+# Delete the lock only if it is still ours, it may have expired and been taken by another worker
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Runs one computation per key at a time, concurrent callers of the same
+    key share its result. redis_client enables the coordination between workers.
+    """
+
+    def __init__(self, namespace: str, redis_client=None, async_redis_client=None):
+        self.namespace = namespace
+        self.prefix = f"flask-gateway:single-flight:{namespace}:"
+        self.redis_client = redis_client
+        self.async_redis_client = async_redis_client
+        self._calls = {}
+        self._async_calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, compute):
+        """
+        Return compute(), or the result of the computation of key already in flight.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            with metrics.stage(self.namespace, "coalesced"):
+                call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._compute_shared(key, compute)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    async def do_async(self, key: str, compute):
+        """
+        Return await compute(), or the result of the computation of key already in flight.
+        """
+        task = self._async_calls.get(key)
+        if task is not None:
+            with metrics.stage(self.namespace, "coalesced"):
+                return await asyncio.shield(task)
+
+        # The computation runs as its own task, so a cancelled caller (for eg. a closed connection)
+        # does not cancel it for the callers waiting on it
+        task = asyncio.ensure_future(self._compute_shared_async(key, compute))
+        self._async_calls[key] = task
+        task.add_done_callback(lambda done: self._forget(key, done))
+        return await asyncio.shield(task)
+
+    def _forget(self, key: str, task) -> None:
+        if self._async_calls.get(key) is task:
+            del self._async_calls[key]
+
+    def _compute_shared(self, key: str, compute):
+        if self.redis_client is None:
+            return compute()
+
+        client = self.redis_client
+        lock_key, result_key = self.prefix + "lock:" + key, self.prefix + "result:" + key
+        token = uuid.uuid4().hex
+        try:
+            raw = client.get(result_key)
+            if raw is not None:
+                return json.loads(raw)
+            locked = client.set(lock_key, token, nx=True, px=int(SINGLE_FLIGHT_LOCK_TTL * 1000))
+        except Exception as e:
+            logger.warning("Single flight lock failed namespace=%s error=%s", self.namespace, e)
+            return compute()
+
+        if locked:
+            try:
+                result = compute()
+                self._publish(client, result_key, result)
+                return result
+            finally:
+                try:
+                    client.eval(_RELEASE_SCRIPT, 1, lock_key, token)
+                except Exception as e:
+                    logger.warning("Single flight unlock failed namespace=%s error=%s", self.namespace, e)
+
+        # Another worker computes it, wait for its result while it holds the lock
+        with metrics.stage(self.namespace, "coalesced"):
+            deadline = time.monotonic() + SINGLE_FLIGHT_LOCK_TTL
+            try:
+                while time.monotonic() < deadline:
+                    raw = client.get(result_key)
+                    if raw is not None:
+                        return json.loads(raw)
+                    if not client.exists(lock_key):
+                        # Released between the two reads, or the other worker stopped without a result
+                        raw = client.get(result_key)
+                        if raw is not None:
+                            return json.loads(raw)
+                        break
+                    time.sleep(SINGLE_FLIGHT_POLL_INTERVAL)
+            except Exception as e:
+                logger.warning("Single flight wait failed namespace=%s error=%s", self.namespace, e)
+        return compute()
+
+    async def _compute_shared_async(self, key: str, compute):
+        if self.async_redis_client is None:
+            return await compute()
+
+        client = self.async_redis_client
+        lock_key, result_key = self.prefix + "lock:" + key, self.prefix + "result:" + key
+        token = uuid.uuid4().hex
+        try:
+            raw = await client.get(result_key)
+            if raw is not None:
+                return json.loads(raw)
+            locked = await client.set(lock_key, token, nx=True, px=int(SINGLE_FLIGHT_LOCK_TTL * 1000))
+        except Exception as e:
+            logger.warning("Single flight lock failed namespace=%s error=%s", self.namespace, e)
+            return await compute()
+
+        if locked:
+            try:
+                result = await compute()
+                await self._publish_async(client, result_key, result)
+                return result
+            finally:
+                try:
+                    await client.eval(_RELEASE_SCRIPT, 1, lock_key, token)
+                except Exception as e:
+                    logger.warning("Single flight unlock failed namespace=%s error=%s", self.namespace, e)
+
+        with metrics.stage(self.namespace, "coalesced"):
+            deadline = time.monotonic() + SINGLE_FLIGHT_LOCK_TTL
+            try:
+                while time.monotonic() < deadline:
+                    raw = await client.get(result_key)
+                    if raw is not None:
+                        return json.loads(raw)
+                    if not await client.exists(lock_key):
+                        raw = await client.get(result_key)
+                        if raw is not None:
+                            return json.loads(raw)
+                        break
+                    await asyncio.sleep(SINGLE_FLIGHT_POLL_INTERVAL)
+            except Exception as e:
+                logger.warning("Single flight wait failed namespace=%s error=%s", self.namespace, e)
+        return await compute()
+
+    def _publish(self, client, result_key: str, result) -> None:
+        try:
+            client.set(result_key, json.dumps(result, default=str), px=int(SINGLE_FLIGHT_RESULT_TTL * 1000))
+        except Exception as e:
+            logger.warning("Single flight publish failed namespace=%s error=%s", self.namespace, e)
+
+    async def _publish_async(self, client, result_key: str, result) -> None:
+        try:
+            await client.set(result_key, json.dumps(result, default=str), px=int(SINGLE_FLIGHT_RESULT_TTL * 1000))
+        except Exception as e:
+            logger.warning("Single flight publish failed namespace=%s error=%s", self.namespace, e)
+
+
+def get_async_redis_client():
+    import redis.asyncio
+
+    return redis.asyncio.Redis.from_url(result_cache.REDIS_URL)
+
+
+def create_group(namespace: str, backend: str = None) -> SingleFlight:
+    """
+    Create (or return the already created) single flight group for a namespace.
+    """
+    if namespace not in _groups:
+        if (backend or SINGLE_FLIGHT_BACKEND) == "redis":
+            _groups[namespace] = SingleFlight(namespace, result_cache.get_redis_client(), get_async_redis_client())
+        else:
+            _groups[namespace] = SingleFlight(namespace)
+    return _groups[namespace]
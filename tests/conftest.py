@@ -0,0 +1,60 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# The app modules live at the project root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Settings are read once per process, so the test database is set before any app module is imported
+_DATABASE_FILE = os.path.join(tempfile.mkdtemp(prefix="gateway-tests-"), "analytics.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{_DATABASE_FILE}"
+os.environ["ANALYTICS_ROLLUP_ENABLED"] = "false"
+os.environ["CACHE_BACKEND"] = "memory"
+os.environ["SINGLE_FLIGHT_BACKEND"] = "memory"
+
+TABLES = [
+    "CREATE TABLE user_tbl (user_id BIGINT PRIMARY KEY, first_name VARCHAR(255), last_name VARCHAR(255), "
+    "email VARCHAR(255))",
+    "CREATE TABLE key_tbl (value VARCHAR(255) PRIMARY KEY, user_id BIGINT, tier VARCHAR(255), ref_app VARCHAR(255))",
+    "CREATE TABLE tyk_analytics_data (request_date DATE NOT NULL, api_key VARCHAR(255) NOT NULL, "
+    "response_code INTEGER, request_time INTEGER)"
+]
+
+
+@pytest.fixture
+def analytics_db():
+    """
+    Empty analytics tables and result caches. Returns insert(users, keys, requests) taking
+    lists of (user_id, first_name), (value, user_id, tier, ref_app) and (request_date, api_key).
+    """
+    from sqlalchemy import text
+
+    import database
+    import result_cache
+
+    with database.connect() as connection:
+        for table in ("tyk_analytics_data", "key_tbl", "user_tbl"):
+            connection.execute(text(f"DROP TABLE IF EXISTS {table}"))
+        for statement in TABLES:
+            connection.execute(text(statement))
+        connection.commit()
+    for cache in result_cache._caches.values():
+        cache.clear()
+
+    def insert(users=(), keys=(), requests=()):
+        with database.connect() as connection:
+            for user_id, first_name in users:
+                connection.execute(text("INSERT INTO user_tbl VALUES (:user_id, :first_name, 'Doe', :email)"),
+                                   {"user_id": user_id, "first_name": first_name,
+                                    "email": f"{first_name.lower()}@example.com"})
+            for value, user_id, tier, ref_app in keys:
+                connection.execute(text("INSERT INTO key_tbl VALUES (:value, :user_id, :tier, :ref_app)"),
+                                   {"value": value, "user_id": user_id, "tier": tier, "ref_app": ref_app})
+            for request_date, api_key in requests:
+                connection.execute(text("INSERT INTO tyk_analytics_data VALUES (:request_date, :api_key, 200, 10)"),
+                                   {"request_date": request_date, "api_key": api_key})
+            connection.commit()
+
+    return insert
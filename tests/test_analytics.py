@@ -0,0 +1,51 @@
+import pytest
+
+import controller
+
+
+@pytest.fixture
+def client():
+    return controller.app.test_client()
+
+
+def _analytics(client, start_date, end_date):
+    response = client.get(f"/analytics?group_by=tier&start_date={start_date}&end_date={end_date}")
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()["response"]["data"]
+
+
+def _group_totals(data):
+    return {trend["group"]: sum(trend["data"]) for trend in data["analytics_data"]["trend"]}
+
+
+def test_monthly_counts_keys_without_a_group_like_daily(client, analytics_db):
+    # k2 has no tier, its requests form the null group at both granularities
+    analytics_db(users=[(1, "Alice")],
+                 keys=[("k1", 1, "FreeDesign", "web"), ("k2", 1, None, "web")],
+                 requests=[("2024-11-05", "k1")] * 2 + [("2024-11-06", "k2")] * 3 + [("2024-12-05", "k2")] * 4)
+
+    monthly = _analytics(client, "2024-11-01", "2024-12-31")
+    november = _analytics(client, "2024-11-01", "2024-11-30")
+    december = _analytics(client, "2024-12-01", "2024-12-31")
+
+    assert monthly["analytics_data"]["range"] == ["2024-11", "2024-12"]
+    assert _group_totals(monthly) == {"FreeDesign": 2, None: 7}
+    assert _group_totals(november) == {"FreeDesign": 2, None: 3}
+    assert _group_totals(december) == {None: 4}
+    assert monthly["summary"]["total_requests"] == sum(monthly["analytics_data"]["cumulative"]) == 9
+
+
+def test_latency_trend_keeps_keys_without_a_group(client, analytics_db):
+    analytics_db(users=[(1, "Alice")],
+                 keys=[("k1", 1, "FreeDesign", "web"), ("k2", 1, None, "web")],
+                 requests=[("2024-12-05", "k1")] * 2 + [("2024-12-06", "k2")] * 3)
+
+    response = client.get("/analytics?mode=latency&group_by=tier&start_date=2024-12-01&end_date=2024-12-07")
+    assert response.status_code == 200, response.get_json()
+    data = response.get_json()["response"]["data"]
+
+    trend = data["latency_data"]["trend"]
+    assert [(group["group"], group["summary"]["total_requests"]) for group in trend] == [(None, 3), ("FreeDesign", 2)]
+    assert trend[0]["data"]["requests"] == [0, 0, 0, 0, 0, 3, 0]
+    assert trend[0]["summary"]["p50_ms"] is not None
+    assert data["summary"]["total_requests"] == sum(group["summary"]["total_requests"] for group in trend)
@@ -0,0 +1,26 @@
+from sqlalchemy import text
+
+import analytics_indexes
+import analytics_repository
+import analytics_rollup
+import database
+
+
+def test_check_explains_the_raw_and_the_rollup_statements(analytics_db):
+    # Without rollup coverage /analytics sends the raw statement, the one check explains first
+    raw = [("raw", "2024-12-01", "2024-12-07")]
+    assert (analytics_repository.analytics_query("tier", "2024-12-01", "2024-12-07")
+            == analytics_repository.analytics_query("tier", "2024-12-01", "2024-12-07", segments=raw))
+
+    with database.connect() as connection:
+        connection.execute(text(f"DROP TABLE IF EXISTS {analytics_rollup.ROLLUP_TABLE}"))
+        connection.commit()
+    analytics_indexes.create_indexes()
+    assert set(analytics_indexes.check_indexes("tier", "2024-12-01", "2024-12-07")) == {
+        "analytics", "analytics_user", "top_users"}
+
+    analytics_rollup.create_tables()
+    report = analytics_indexes.check_indexes("tier", "2024-12-01", "2024-12-07")
+    assert set(report) == {"analytics", "analytics_user", "top_users", "analytics_rollup", "top_users_rollup"}
+    for result in report.values():
+        assert result["indexes"]["idx_tyk_analytics_data_date_key"], result["plan"]
@@ -0,0 +1,27 @@
+import pytest
+from sqlalchemy import text
+
+import analytics_ingest
+import database
+
+
+def test_init_adds_the_columns_the_worker_writes(analytics_db):
+    # The original table, without response_code and request_time
+    with database.connect() as connection:
+        connection.execute(text(f"DROP TABLE IF EXISTS {analytics_ingest.STATE_TABLE}"))
+        connection.execute(text("DROP TABLE tyk_analytics_data"))
+        connection.execute(text("CREATE TABLE tyk_analytics_data (request_date DATE NOT NULL, "
+                                "api_key VARCHAR(255) NOT NULL)"))
+        connection.commit()
+
+    with pytest.raises(RuntimeError, match="run python analytics_ingest.py init"):
+        analytics_ingest.check_tables()
+
+    analytics_ingest.create_tables()
+    analytics_ingest.create_tables()
+    analytics_ingest.check_tables()
+
+    analytics_ingest._write_batch([("2024-12-01", "k1", 200, 12)], "default", "batch-1")
+    with database.connect() as connection:
+        rows = connection.execute(text("SELECT * FROM tyk_analytics_data")).fetchall()
+    assert [tuple(row) for row in rows] == [("2024-12-01", "k1", 200, 12)]
@@ -0,0 +1,45 @@
+import json
+
+import pytest
+
+import controller
+import json_provider
+
+pytest.importorskip("orjson")
+
+RESULT = {
+    "message": "Success",
+    "response": [{"first_name": "José", "last_name": "Müller", "email": "élodie@例え.jp", "note": "😀"}],
+    "status_code": 200
+}
+
+
+def test_response_bytes_do_not_depend_on_orjson(monkeypatch):
+    with controller.app.app_context():
+        fast = controller.app.json.response(RESULT).get_data()
+        monkeypatch.setattr(json_provider, "orjson", None)
+        standard = controller.app.json.response(RESULT).get_data()
+
+    assert fast == standard
+    assert fast.isascii()
+    assert json.loads(fast) == RESULT
+
+
+def test_dumps_bytes_does_not_depend_on_orjson(monkeypatch):
+    fast = json_provider.dumps_bytes(RESULT)
+    monkeypatch.setattr(json_provider, "orjson", None)
+    assert fast == json_provider.dumps_bytes(RESULT)
+
+
+def test_dumps_honours_the_json_arguments():
+    provider = controller.app.json
+    data = {"b": 1, "a": {"d": 2, "c": 3}}
+
+    assert provider.dumps(data, sort_keys=True) == '{"a":{"c":3,"d":2},"b":1}'
+    assert provider.dumps(data, sort_keys=False) == '{"b":1,"a":{"d":2,"c":3}}'
+    assert provider.dumps(data, sort_keys=True, indent=2) == json.dumps(data, sort_keys=True, indent=2)
+    assert provider.dumps({"at": {1, 2}}, default=sorted) == '{"at":[1,2]}'
+    # orjson has no equivalent, these go to json.dumps
+    assert provider.dumps(data, separators=(", ", ": "), sort_keys=False) == json.dumps(data)
+    assert provider.dumps(data, indent=4, sort_keys=False) == json.dumps(data, indent=4)
+    assert provider.dumps(["é"], ensure_ascii=False, allow_nan=False) == '["é"]'
@@ -0,0 +1,77 @@
+from datetime import datetime, timezone
+
+import key_index
+
+SESSIONS = {
+    "k1": {"apply_policies": ["Pro"], "tags": ["edge"], "org_id": "o1", "date_created": "2024-03-02T10:00:00Z"},
+    "k2": {"apply_policies": ["Free"], "tags": [], "org_id": "o1", "date_created": "2024-03-01T10:00:00Z"},
+    "k3": {"apply_policies": ["Pro"], "tags": [], "org_id": "o2", "date_created": None},
+    "k4": {"apply_policies": ["Pro"], "tags": ["edge"], "org_id": "o2", "date_created": "2024-03-02T10:00:00Z"},
+}
+
+
+def test_upsert_many_orders_keys_like_single_upserts():
+    one_by_one = key_index.KeyIndex()
+    for key, session in SESSIONS.items():
+        one_by_one.upsert(key, session)
+
+    at_once = key_index.KeyIndex()
+    at_once.upsert_many({"k1": {"date_created": "2025-01-01"}, "k3": SESSIONS["k3"]})
+    at_once.upsert_many(SESSIONS)
+
+    assert at_once._by_date == one_by_one._by_date
+    assert at_once.query(policy="Pro") == one_by_one.query(policy="Pro")
+    assert at_once.query(created_to=datetime(2024, 3, 2, tzinfo=timezone.utc))[0] == 1
+
+
+class FakeResponse:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeTyk:
+    def __init__(self, sessions):
+        self.sessions = sessions
+        self.paths = []
+
+    def get(self, path):
+        self.paths.append(path)
+        if path == "/tyk/keys":
+            return FakeResponse(200, {"keys": list(self.sessions)})
+        key = path.rsplit("/", 1)[-1]
+        return FakeResponse(200, self.sessions[key]) if key in self.sessions else FakeResponse(404, {})
+
+
+def test_refresh_reads_the_sessions_from_tyk_redis(monkeypatch):
+    tyk = FakeTyk(SESSIONS)
+    monkeypatch.setattr(key_index.tyk_client, "get_client", lambda: tyk)
+    monkeypatch.setattr(key_index.tyk_redis, "TYK_REDIS_ENABLED", True)
+    # k3 is not in Redis, for eg. a hashed key
+    monkeypatch.setattr(key_index.tyk_redis, "get_sessions",
+                        lambda keys: [None if key == "k3" else SESSIONS[key] for key in keys])
+
+    index = key_index.KeyIndex()
+    key_index.refresh(index)
+
+    assert tyk.paths == ["/tyk/keys", "/tyk/keys/k3"]
+    assert index.query(policy="Pro")[0] == 3
+
+
+def test_a_loaded_index_survives_the_fork(monkeypatch):
+    monkeypatch.setattr(key_index.tyk_client, "get_client", lambda: FakeTyk(SESSIONS))
+    monkeypatch.setattr(key_index.tyk_redis, "TYK_REDIS_ENABLED", False)
+    monkeypatch.setattr(key_index, "_index", None)
+    monkeypatch.setattr(key_index, "_refresher", None)
+
+    index = key_index.load()
+    key_index._reset_after_fork()
+
+    assert key_index.get_started_index() is index
+    assert index.ready and index.query()[0] == len(SESSIONS)
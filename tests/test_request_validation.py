@@ -0,0 +1,46 @@
+import asyncio
+
+import pytest
+
+import asgi
+import controller
+
+INVALID_REQUESTS = [
+    ("POST", "/create-key", {}),
+    ("PUT", "/update-plan", {"plan": "FreeDesign"}),
+    ("POST", "/keys/batch-get", {"keys": []}),
+    ("POST", "/keys/batch-get", {"keys": ["k1", 2]}),
+    ("PUT", "/keys/batch-update-plan", {"items": [{"plan": "FreeDesign"}]}),
+    ("GET", "/list-keys?limit=ten", None),
+    ("GET", "/list-keys?created_to=yesterday", None),
+    ("GET", "/analytics?start_date=2024-12-01", None),
+    ("GET", "/analytics?start_date=2024-12-01&end_date=2024-12-31&group_by=email", None),
+    ("GET", "/analytics?start_date=2024-12-01&end_date=2024-12-31&mode=errors", None),
+    ("GET", "/analytics/multi?start_date=2024-12-01&end_date=2024-12-31&compare=2024-11-01", None),
+    ("GET", "/analytics/multi?start_date=2024-12-31&end_date=2024-12-01", None),
+    ("GET", "/top-users?start_date=2024-12-01&end_date=2024-12-31&limit=ten", None),
+    ("GET", "/export?start_date=2024-12-31&end_date=2024-12-01", None),
+    ("GET", "/export?start_date=2024-12-01&end_date=2024-12-31&format=xml", None),
+]
+
+
+def _flask_response(method, url, body):
+    response = controller.app.test_client().open(url, method=method, json=body)
+    return response.status_code, response.get_json()
+
+
+def _asgi_response(method, url, body):
+    async def send():
+        response = await asgi.app.test_client().open(url, method=method, json=body)
+        return response.status_code, await response.get_json()
+
+    return asyncio.run(send())
+
+
+@pytest.mark.parametrize("method, url, body", INVALID_REQUESTS)
+def test_both_apps_reject_invalid_requests_alike(method, url, body):
+    status_code, result = _flask_response(method, url, body)
+
+    assert status_code == 400
+    assert result["error"]
+    assert _asgi_response(method, url, body) == (status_code, result)
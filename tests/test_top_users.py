@@ -0,0 +1,59 @@
+import pytest
+
+import controller
+
+RANGE = "start_date=2024-12-01&end_date=2024-12-31"
+
+
+@pytest.fixture
+def client():
+    return controller.app.test_client()
+
+
+def _requests(api_key, count, request_date="2024-12-05"):
+    return [(request_date, api_key)] * count
+
+
+def _all_pages(client, query, limit):
+    users, cursor = [], None
+    while True:
+        url = f"/top-users?{query}&limit={limit}" + (f"&cursor={cursor}" if cursor else "")
+        response = client.get(url)
+        assert response.status_code == 200, response.get_json()
+        data = (response.get_json()["response"] or {}).get("data")
+        if data is None:
+            return users
+        users += data["users"]
+        cursor = data["next_cursor"]
+        if cursor is None:
+            return users
+
+
+def test_cursor_pages_keep_a_user_tied_across_groups(client, analytics_db):
+    # Alice makes 2 requests in each of FreeDesign, ProDesign and a key without a tier,
+    # so (usage, user_id) ties on three rows and the first page ends inside the tie
+    analytics_db(users=[(1, "Alice"), (2, "Bob")],
+                 keys=[("k1", 1, "FreeDesign", "web"), ("k2", 1, "ProDesign", "web"),
+                       ("k3", 1, None, "web"), ("k4", 2, "FreeDesign", "cli")],
+                 requests=_requests("k1", 2) + _requests("k2", 2) + _requests("k3", 2) + _requests("k4", 3))
+
+    every_user = client.get(f"/top-users?{RANGE}&limit=10").get_json()["response"]["data"]["users"]
+    assert [(user["user_id"], user["group"]) for user in every_user] == \
+        [(2, "FreeDesign"), (1, None), (1, "FreeDesign"), (1, "ProDesign")]
+
+    for limit in (1, 2, 3):
+        assert _all_pages(client, RANGE, limit) == every_user
+
+
+def test_group_by_user_id(client, analytics_db):
+    analytics_db(users=[(1, "Alice"), (2, "Bob")],
+                 keys=[("k1", 1, "FreeDesign", "web"), ("k2", 1, "ProDesign", "web"), ("k3", 2, "FreeDesign", "cli")],
+                 requests=_requests("k1", 2) + _requests("k2", 1) + _requests("k3", 2))
+
+    response = client.get(f"/top-users?{RANGE}&group_by=user_id&limit=1")
+
+    assert response.status_code == 200, response.get_json()
+    data = response.get_json()["response"]["data"]
+    assert data["total_users"] == 2
+    assert [(user["group"], user["user_id"], user["usage"]) for user in data["users"]] == [(1, 1, 3)]
+    assert [user["group"] for user in _all_pages(client, f"{RANGE}&group_by=user_id", 1)] == [1, 2]
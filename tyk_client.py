@@ -0,0 +1,190 @@
+"""
+Reusable client for the Tyk gateway admin API.
+
+All calls share one keep-alive requests.Session per process, with a pooled
+HTTPAdapter, connect/read timeouts and bounded retries with exponential
+backoff. Retries only apply to idempotent methods (GET, DELETE, ...), so a
+key creation is never sent twice.
+
+AsyncTykClient offers the same calls on httpx for the ASGI app (asgi.py).
+"""
+
+import asyncio
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+import settings
+
+_settings = settings.get_settings()
+
+TYK_AUTHORIZATION = _settings.tyk_authorization
+TYK_BASE_URL = _settings.tyk_base_url
+
+# Connection pool and timeout parameters
+tyk_client_config = {
+    'pool_size': _settings.tyk_pool_size,
+    'connect_timeout': _settings.tyk_connect_timeout,
+    'read_timeout': _settings.tyk_read_timeout,
+    'max_retries': _settings.tyk_max_retries,
+    'backoff_factor': _settings.tyk_backoff_factor
+}
+
+# Gateway side failures worth retrying on an idempotent call
+RETRY_STATUS_CODES = (502, 503, 504)
+
+
+class TykClient:
+    def __init__(self, base_url: str, authorization: str, config: dict):
+        self.base_url = base_url
+        self.timeout = (config['connect_timeout'], config['read_timeout'])
+
+        retry = Retry(total=config['max_retries'],
+                      backoff_factor=config['backoff_factor'],
+                      status_forcelist=RETRY_STATUS_CODES,
+                      allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=config['pool_size'],
+                              max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "x-tyk-authorization": authorization
+        })
+
+    def get(self, path: str) -> requests.Response:
+        return self._send("GET", path)
+
+    def post(self, path: str, data: str) -> requests.Response:
+        return self._send("POST", path, data=data)
+
+    def delete(self, path: str) -> requests.Response:
+        return self._send("DELETE", path)
+
+    def close(self) -> None:
+        self.session.close()
+
+    def _send(self, method: str, path: str, data: str = None) -> requests.Response:
+        started = time.perf_counter()
+        status = "error"
+        try:
+            response = self.session.request(method, f"{self.base_url}{path}", data=data, timeout=self.timeout)
+            status = str(response.status_code)
+            return response
+        finally:
+            metrics.observe_tyk_request(method, path, status, time.perf_counter() - started)
+
+
+class AsyncTykClient:
+    def __init__(self, base_url: str, authorization: str, config: dict):
+        import httpx
+
+        self._transport_errors = (httpx.TransportError,)
+        self.max_retries = config['max_retries']
+        self.backoff_factor = config['backoff_factor']
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            headers={
+                "Content-Type": "application/json",
+                "x-tyk-authorization": authorization
+            },
+            timeout=httpx.Timeout(config['read_timeout'], connect=config['connect_timeout']),
+            limits=httpx.Limits(max_connections=config['pool_size'],
+                                max_keepalive_connections=config['pool_size'])
+        )
+
+    async def get(self, path: str):
+        return await self._send("GET", path)
+
+    async def post(self, path: str, data: str):
+        return await self._send("POST", path, data)
+
+    async def delete(self, path: str):
+        return await self._send("DELETE", path)
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+    async def _send(self, method: str, path: str, data: str = None):
+        started = time.perf_counter()
+        status = "error"
+        try:
+            if method == "POST":
+                response = await self.client.post(path, content=data)
+            else:
+                response = await self._send_idempotent(method, path)
+            status = str(response.status_code)
+            return response
+        finally:
+            metrics.observe_tyk_request(method, path, status, time.perf_counter() - started)
+
+    async def _send_idempotent(self, method: str, path: str):
+        # Same policy as the urllib3 Retry of TykClient: connection errors and 502/503/504, exponential backoff
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await self.client.request(method, path)
+            except self._transport_errors:
+                if attempt == self.max_retries:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                    return response
+            await asyncio.sleep(self.backoff_factor * (2 ** attempt))
+
+
+_client: TykClient = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> TykClient:
+    """
+    Return the client of this process, creating it on first use.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = TykClient(TYK_BASE_URL, TYK_AUTHORIZATION, tyk_client_config)
+    return _client
+
+
+_async_client: AsyncTykClient = None
+
+
+def get_async_client() -> AsyncTykClient:
+    """
+    Return the async client of this process, creating it on first use.
+    Only called from the event loop, so no lock is needed.
+    """
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncTykClient(TYK_BASE_URL, TYK_AUTHORIZATION, tyk_client_config)
+    return _async_client
+
+
+async def close_async_client() -> None:
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+
+def _reset_after_fork() -> None:
+    # Pooled sockets inherited from the parent must not be reused by a worker
+    global _client, _client_lock, _async_client
+    _client = None
+    _async_client = None
+    _client_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
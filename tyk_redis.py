@@ -0,0 +1,136 @@
+"""
+Read only key lookups from Tyk's Redis.
+
+With storage.type redis and hash_keys false (see tyk.standalone.conf) the
+gateway keeps the session of each key as JSON under apikey-{key}, the object
+GET /tyk/keys/{key} returns. Reading it from Redis skips the HTTP round trip
+to the gateway, and MGET reads thousands of keys in one round trip.
+
+Nothing is ever written here, key changes still go through the admin API.
+A key that is missing or does not decode comes back as None and a Redis error
+is logged, in both cases the caller falls back to the admin API.
+Enable with TYK_REDIS_ENABLED=true and TYK_REDIS_URL pointing at the Redis
+database of the gateway.
+"""
+
+import json
+import logging
+import os
+import threading
+
+import metrics
+import settings
+
+_settings = settings.get_settings()
+
+TYK_REDIS_ENABLED = _settings.tyk_redis_enabled
+TYK_REDIS_URL = _settings.tyk_redis_url
+TYK_REDIS_KEY_PREFIX = _settings.tyk_redis_key_prefix
+# Socket timeout, a slow Redis falls back to the admin API instead of stalling the request
+TYK_REDIS_TIMEOUT = _settings.tyk_redis_timeout
+# Keys per MGET, the chunks of a bulk lookup are pipelined in one round trip
+TYK_REDIS_MGET_CHUNK = _settings.tyk_redis_mget_chunk
+
+logger = logging.getLogger(__name__)
+
+
+def get_sessions(keys: list[str]) -> list[dict]:
+    """
+    Read the sessions of keys, in the order of keys. None for a key that is
+    missing, does not decode, or when Redis cannot be read.
+    """
+    try:
+        with metrics.stage("tyk_redis", "mget"):
+            pipeline = get_client().pipeline(transaction=False)
+            for chunk in _chunks(keys):
+                pipeline.mget([TYK_REDIS_KEY_PREFIX + key for key in chunk])
+            values = [value for chunk_values in pipeline.execute() for value in chunk_values]
+    except Exception as e:
+        logger.warning("Tyk redis read failed keys=%d error=%s", len(keys), e)
+        return [None] * len(keys)
+    return [_decode(key, value) for key, value in zip(keys, values)]
+
+
+async def get_sessions_async(keys: list[str]) -> list[dict]:
+    try:
+        with metrics.stage("tyk_redis", "mget"):
+            pipeline = get_async_client().pipeline(transaction=False)
+            for chunk in _chunks(keys):
+                pipeline.mget([TYK_REDIS_KEY_PREFIX + key for key in chunk])
+            values = [value for chunk_values in await pipeline.execute() for value in chunk_values]
+    except Exception as e:
+        logger.warning("Tyk redis read failed keys=%d error=%s", len(keys), e)
+        return [None] * len(keys)
+    return [_decode(key, value) for key, value in zip(keys, values)]
+
+
+def _chunks(keys: list[str]):
+    for start in range(0, len(keys), TYK_REDIS_MGET_CHUNK):
+        yield keys[start:start + TYK_REDIS_MGET_CHUNK]
+
+
+def _decode(key: str, value: bytes) -> dict:
+    if value is None:
+        return None
+    try:
+        session = json.loads(value)
+    except ValueError as e:
+        logger.warning("Tyk redis session does not decode key=%s error=%s", key, e)
+        return None
+    # Anything but a session object (for eg. a hashed key layout) goes to the admin API
+    return session if isinstance(session, dict) else None
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Return the Redis client of this process, creating it on first use.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                import redis
+
+                _client = redis.Redis.from_url(TYK_REDIS_URL, socket_timeout=TYK_REDIS_TIMEOUT,
+                                               socket_connect_timeout=TYK_REDIS_TIMEOUT)
+    return _client
+
+
+_async_client = None
+
+
+def get_async_client():
+    """
+    Return the async Redis client of this process, creating it on first use.
+    Only called from the event loop, so no lock is needed.
+    """
+    global _async_client
+    if _async_client is None:
+        import redis.asyncio
+
+        _async_client = redis.asyncio.Redis.from_url(TYK_REDIS_URL, socket_timeout=TYK_REDIS_TIMEOUT,
+                                                     socket_connect_timeout=TYK_REDIS_TIMEOUT)
+    return _async_client
+
+
+async def close_async_client() -> None:
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+
+def _reset_after_fork() -> None:
+    # Connections inherited from the parent must not be reused by a worker
+    global _client, _client_lock, _async_client
+    _client = None
+    _async_client = None
+    _client_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)